@@ -0,0 +1,7 @@
+"""Benchmarks for the slow parts of the pipeline, on synthetic data so they can
+run anywhere without the real videos or network. Run them with
+
+    python -m matsemanns_streetview_tools.benchmarks
+
+and compare against the stored baseline.json. The video benchmarks need ffmpeg.
+"""
@@ -0,0 +1,60 @@
+import sys
+
+import click
+
+from matsemanns_streetview_tools.benchmarks.runner import (
+    find_regressions,
+    format_results,
+    load_baseline,
+    missing_baselines,
+    run_benchmarks,
+    save_baseline,
+)
+from matsemanns_streetview_tools.util import log
+
+
+@click.command()
+@click.option(
+    "--filter",
+    "name_filter",
+    default=None,
+    help="Only run benchmarks with this in their name, like gpx.",
+)
+@click.option("--repeat", type=click.IntRange(min=1), default=None)
+@click.option(
+    "--threshold",
+    type=click.FloatRange(min=1),
+    default=1.25,
+    show_default=True,
+    help="Fail when a median is this many times slower than the baseline.",
+)
+@click.option(
+    "--save-baseline",
+    "save_baseline_",
+    is_flag=True,
+    help="Store the results as the new baseline.",
+)
+def main(name_filter, repeat, threshold, save_baseline_):
+    """Run the benchmarks, and fail if any got slower than the baseline"""
+    baseline = load_baseline()
+    results = run_benchmarks(name_filter, repeat)
+    log("\n" + format_results(results, baseline))
+
+    if save_baseline_:
+        save_baseline(results)
+        log("Saved as new baseline")
+        return
+
+    # Would never be found to regress otherwise
+    missing = missing_baselines(results, baseline)
+    for name in missing:
+        log(f"{name} has no baseline, store one with --save-baseline")
+    regressions = find_regressions(results, baseline, threshold)
+    for regression in regressions:
+        log(f"{regression.name} is {regression.ratio:.2f}x slower than the baseline")
+    if regressions or missing:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import math
+import subprocess
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from pathlib import Path
+
+from PIL import Image
+
+from matsemanns_streetview_tools.gpx import GpxPoint, GpxTrack
+from matsemanns_streetview_tools.util import ffmpeg_path
+
+START = datetime(2024, 6, 1, 12, 0, 0, tzinfo=timezone.utc)
+
+
+def synthetic_track(points: int = 10_000, speed_m_s: float = 5.0) -> GpxTrack:
+    """A track with a point every second, winding a bit like a real road.
+    Coordinates have 7 decimals, like from a gps"""
+    degrees_per_meter = 1 / 111_111
+    lat, lon = 60.0, 10.0
+    track_points = []
+    for i in range(points):
+        direction = math.sin(i / 50) * math.pi / 3
+        lat += math.cos(direction) * speed_m_s * degrees_per_meter
+        lon += math.sin(direction) * speed_m_s * degrees_per_meter * 2
+        track_points.append(
+            GpxPoint(
+                lat=Decimal(f"{lat:.7f}"),
+                lon=Decimal(f"{lon:.7f}"),
+                ele=Decimal(f"{100 + 10 * math.sin(i / 200):.1f}"),
+                utc_time=START + timedelta(seconds=i),
+            )
+        )
+    return GpxTrack(name="synthetic", utc_time=START, points=track_points)
+
+
+def synthetic_equirectangular(width: int = 5376, height: int = 2688) -> Image.Image:
+    """Gradients and noise, so enhancing and jpeg encoding has some work to do,
+    unlike on a flat color"""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    return Image.merge(
+        "RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT))
+    )
+
+
+def synthetic_video(
+    file: Path,
+    seconds: int = 10,
+    width: int = 1920,
+    height: int = 960,
+    fps: int = 30,
+) -> Path:
+    """An ffmpeg test pattern video, so no real video files are needed"""
+    subprocess.run(
+        [
+            ffmpeg_path(),
+            "-y",
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc2=size={width}x{height}:rate={fps}:duration={seconds}",
+            "-c:v",
+            "libx264",
+            "-preset",
+            "ultrafast",
+            "-pix_fmt",
+            "yuv420p",
+            "-metadata",
+            f"creation_time={START.isoformat().replace('+00:00', 'Z')}",
+            str(file),
+        ],
+        capture_output=True,
+        check=True,
+    )
+    return file
@@ -0,0 +1,147 @@
+import json
+import statistics
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+BASELINE_FILE = Path(__file__).parent / "baseline.json"
+
+
+@dataclass
+class Benchmark:
+    name: str
+    # Prepares the data in the given folder, and returns the function to time
+    setup: Callable[[Path], Callable[[], object]]
+    repeat: int = 5
+    # Returns why the benchmark can't run here, or None if it can
+    skip_if: Callable[[], str | None] | None = None
+
+
+_benchmarks: dict[str, Benchmark] = {}
+
+
+def benchmark(
+    name: str, repeat: int = 5, skip_if: Callable[[], str | None] | None = None
+):
+    """Registers the decorated setup function as a benchmark"""
+
+    def register(setup: Callable[[Path], Callable[[], object]]):
+        _benchmarks[name] = Benchmark(name, setup, repeat, skip_if)
+        return setup
+
+    return register
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    runs: list[float]
+    skipped: str | None = None
+
+    @property
+    def best(self) -> float:
+        return min(self.runs)
+
+    @property
+    def median(self) -> float:
+        return statistics.median(self.runs)
+
+
+@dataclass
+class Regression:
+    name: str
+    baseline: float
+    median: float
+
+    @property
+    def ratio(self) -> float:
+        return self.median / self.baseline
+
+
+def run_benchmark(bench: Benchmark, repeat: int | None = None) -> BenchmarkResult:
+    reason = bench.skip_if() if bench.skip_if else None
+    if reason:
+        return BenchmarkResult(bench.name, [], skipped=reason)
+
+    with tempfile.TemporaryDirectory() as folder:
+        function = bench.setup(Path(folder))
+        # Not timed, lets lazy imports and caches settle
+        function()
+        runs = []
+        for _ in range(repeat or bench.repeat):
+            start = time.perf_counter()
+            function()
+            runs.append(time.perf_counter() - start)
+    return BenchmarkResult(bench.name, runs)
+
+
+def run_benchmarks(
+    name_filter: str | None = None, repeat: int | None = None
+) -> list[BenchmarkResult]:
+    """Runs all benchmarks with name_filter in their name"""
+    from matsemanns_streetview_tools.benchmarks import cases  # noqa: F401, registers
+
+    return [
+        run_benchmark(bench, repeat)
+        for name, bench in _benchmarks.items()
+        if not name_filter or name_filter in name
+    ]
+
+
+def load_baseline(file: Path = BASELINE_FILE) -> dict[str, float]:
+    """Median seconds for each benchmark"""
+    if not file.exists():
+        return {}
+    return json.loads(file.read_text())
+
+
+def save_baseline(results: list[BenchmarkResult], file: Path = BASELINE_FILE) -> None:
+    """Updates the baseline with the results, keeping the other benchmarks"""
+    baseline = load_baseline(file)
+    for result in results:
+        if not result.skipped:
+            baseline[result.name] = round(result.median, 6)
+    file.write_text(json.dumps(dict(sorted(baseline.items())), indent=2) + "\n")
+
+
+def find_regressions(
+    results: list[BenchmarkResult], baseline: dict[str, float], threshold: float
+) -> list[Regression]:
+    """The benchmarks with a median more than threshold times their baseline"""
+    return [
+        Regression(result.name, baseline[result.name], result.median)
+        for result in results
+        if not result.skipped
+        and result.name in baseline
+        and result.median > baseline[result.name] * threshold
+    ]
+
+
+def missing_baselines(
+    results: list[BenchmarkResult], baseline: dict[str, float]
+) -> list[str]:
+    """The benchmarks that ran, but have nothing to compare with"""
+    return [
+        result.name
+        for result in results
+        if not result.skipped and result.name not in baseline
+    ]
+
+
+def format_results(results: list[BenchmarkResult], baseline: dict[str, float]) -> str:
+    lines = [f"{'benchmark'.ljust(32)} {'best':>9} {'median':>9} {'baseline':>9}"]
+    for result in results:
+        if result.skipped:
+            lines.append(f"{result.name.ljust(32)} skipped, {result.skipped}")
+            continue
+        base = baseline.get(result.name)
+        compared = (
+            f"{base:>8.4f}s ({result.median / base:.2f}x)" if base else "        -"
+        )
+        lines.append(
+            f"{result.name.ljust(32)} {result.best:>8.4f}s {result.median:>8.4f}s"
+            f" {compared}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,166 @@
+import struct
+from functools import cache
+
+from PIL import ExifTags
+
+from matsemanns_streetview_tools.gpx import GpxPoint
+from matsemanns_streetview_tools.util import (
+    datetime_to_exifdatetime,
+    datetime_to_exifdate,
+)
+
+# Tiff field types
+_BYTE = 1
+_ASCII = 2
+_LONG = 4
+_RATIONAL = 5
+
+_EXIF_HEADER = b"Exif\x00\x00"
+# Big endian, like Pillow writes it
+_TIFF_HEADER = b"MM\x00\x2a\x00\x00\x00\x08"
+
+# Denominators used for the rationals, enough precision for each field
+_LATLON_SCALE = 10_000_000
+_ELE_SCALE = 1000
+_HEADING_SCALE = 100
+_SECONDS_SCALE = 1000
+
+_Entry = tuple[int, int, int, bytes]
+
+
+def _rational(value, scale: int) -> bytes:
+    return struct.pack(">II", round(abs(value) * scale), scale)
+
+
+def _ascii(value: str) -> bytes:
+    return value.encode("ascii") + b"\x00"
+
+
+def _build_ifd(entries: list[_Entry], ifd_offset: int) -> tuple[bytes, dict[int, int]]:
+    """Serializes an IFD placed at ifd_offset in the tiff data, with the values
+    too large to fit inline placed right after it.
+    Returns the bytes and where in the tiff data the value of each tag ended up."""
+    entries = sorted(entries)
+    data_offset = ifd_offset + 2 + 12 * len(entries) + 4
+
+    ifd = struct.pack(">H", len(entries))
+    data = b""
+    positions = {}
+    for i, (tag, field_type, count, value) in enumerate(entries):
+        if len(value) <= 4:
+            positions[tag] = ifd_offset + 2 + 12 * i + 8
+            ifd += struct.pack(">HHI", tag, field_type, count) + value.ljust(4, b"\x00")
+        else:
+            positions[tag] = data_offset + len(data)
+            ifd += struct.pack(">HHII", tag, field_type, count, positions[tag])
+            data += value + (b"\x00" if len(value) % 2 else b"")  # word aligned
+    ifd += struct.pack(">I", 0)  # no next ifd
+
+    return ifd + data, positions
+
+
+class ExifTemplate:
+    """Precompiled exif data for the extracted frames. All frames share the same
+    layout, only the time, position and heading changes. So the bytes are built once,
+    and for each frame the values are just written into a copy at known offsets.
+
+    Contains the same tags as create_exif_data, but handles S/W positions and below
+    sea level elevations correctly and keeps milliseconds in the gps timestamp.
+    """
+
+    def __init__(
+        self, with_heading: bool, software: str = "matsemanns_streetview_tools"
+    ):
+        self.with_heading = with_heading
+        placeholder_datetime = _ascii("0000:00:00 00:00:00")
+        ifd0_entries: list[_Entry] = [
+            (ExifTags.Base.Software, _ASCII, len(software) + 1, _ascii(software)),
+            (ExifTags.Base.DateTime, _ASCII, 20, placeholder_datetime),
+            (ExifTags.Base.DateTimeOriginal, _ASCII, 20, placeholder_datetime),
+            (ExifTags.Base.DateTimeDigitized, _ASCII, 20, placeholder_datetime),
+            (ExifTags.IFD.GPSInfo, _LONG, 1, struct.pack(">I", 0)),
+        ]
+        zero = struct.pack(">II", 0, 1)
+        gps_entries: list[_Entry] = [
+            (ExifTags.GPS.GPSLatitudeRef, _ASCII, 2, _ascii("N")),
+            (ExifTags.GPS.GPSLatitude, _RATIONAL, 1, zero),
+            (ExifTags.GPS.GPSLongitudeRef, _ASCII, 2, _ascii("E")),
+            (ExifTags.GPS.GPSLongitude, _RATIONAL, 1, zero),
+            (ExifTags.GPS.GPSAltitudeRef, _BYTE, 1, b"\x00"),
+            (ExifTags.GPS.GPSAltitude, _RATIONAL, 1, zero),
+            (ExifTags.GPS.GPSTimeStamp, _RATIONAL, 3, zero * 3),
+            (ExifTags.GPS.GPSImgDirectionRef, _ASCII, 2, _ascii("T")),
+            (ExifTags.GPS.GPSDestBearingRef, _ASCII, 2, _ascii("T")),
+            (ExifTags.GPS.GPSDateStamp, _ASCII, 11, _ascii("0000:00:00")),
+        ]
+        if with_heading:
+            gps_entries += [
+                (ExifTags.GPS.GPSImgDirection, _RATIONAL, 1, zero),
+                (ExifTags.GPS.GPSDestBearing, _RATIONAL, 1, zero),
+            ]
+
+        ifd0, ifd0_positions = _build_ifd(ifd0_entries, len(_TIFF_HEADER))
+        gps_offset = len(_TIFF_HEADER) + len(ifd0)
+        gps_ifd, gps_positions = _build_ifd(gps_entries, gps_offset)
+
+        tiff = bytearray(_TIFF_HEADER + ifd0 + gps_ifd)
+        struct.pack_into(">I", tiff, ifd0_positions[ExifTags.IFD.GPSInfo], gps_offset)
+
+        self._template = bytes(_EXIF_HEADER + tiff)
+        # Positions relative to the whole template
+        prefix = len(_EXIF_HEADER)
+        self._ifd0 = {tag: pos + prefix for tag, pos in ifd0_positions.items()}
+        self._gps = {tag: pos + prefix for tag, pos in gps_positions.items()}
+
+    def render(self, gpx_point: GpxPoint) -> bytes:
+        buf = bytearray(self._template)
+        utc_time = gpx_point.utc_time
+
+        exif_datetime = datetime_to_exifdatetime(utc_time).encode("ascii")
+        for tag in [
+            ExifTags.Base.DateTime,
+            ExifTags.Base.DateTimeOriginal,
+            ExifTags.Base.DateTimeDigitized,
+        ]:
+            pos = self._ifd0[tag]
+            buf[pos : pos + len(exif_datetime)] = exif_datetime
+
+        gps = self._gps
+        pos = gps[ExifTags.GPS.GPSDateStamp]
+        buf[pos : pos + 10] = datetime_to_exifdate(utc_time).encode("ascii")
+
+        buf[gps[ExifTags.GPS.GPSLatitudeRef]] = ord("N" if gpx_point.lat >= 0 else "S")
+        buf[gps[ExifTags.GPS.GPSLongitudeRef]] = ord("E" if gpx_point.lon >= 0 else "W")
+        buf[gps[ExifTags.GPS.GPSAltitudeRef]] = 0 if gpx_point.ele >= 0 else 1
+
+        def put(tag: int, value: bytes) -> None:
+            buf[gps[tag] : gps[tag] + len(value)] = value
+
+        put(ExifTags.GPS.GPSLatitude, _rational(gpx_point.lat, _LATLON_SCALE))
+        put(ExifTags.GPS.GPSLongitude, _rational(gpx_point.lon, _LATLON_SCALE))
+        put(ExifTags.GPS.GPSAltitude, _rational(gpx_point.ele, _ELE_SCALE))
+        seconds = utc_time.second * _SECONDS_SCALE + utc_time.microsecond // 1000
+        put(
+            ExifTags.GPS.GPSTimeStamp,
+            struct.pack(
+                ">IIIIII", utc_time.hour, 1, utc_time.minute, 1, seconds, _SECONDS_SCALE
+            ),
+        )
+
+        if self.with_heading and gpx_point.heading is not None:
+            heading = _rational(gpx_point.heading, _HEADING_SCALE)
+            put(ExifTags.GPS.GPSImgDirection, heading)
+            put(ExifTags.GPS.GPSDestBearing, heading)
+
+        return bytes(buf)
+
+
+@cache
+def exif_template(with_heading: bool) -> ExifTemplate:
+    return ExifTemplate(with_heading)
+
+
+def create_exif_bytes(gpx_point: GpxPoint) -> bytes:
+    """Faster alternative to image.create_exif_data, returns the exif as
+    bytes ready to be passed to Image.save"""
+    return exif_template(gpx_point.heading is not None).render(gpx_point)
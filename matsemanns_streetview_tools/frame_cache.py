@@ -0,0 +1,141 @@
+import hashlib
+import mmap
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterator
+
+from PIL import Image
+
+from matsemanns_streetview_tools.util import file_fingerprint, log
+from matsemanns_streetview_tools.video import stream_video_frames
+
+
+class FrameCache:
+    """Decoded video frames stored as raw rgb files, one folder per video (by its
+    fingerprint) and one file per frame. Reading a frame maps the file instead of
+    decoding it again, so rerunning the pipeline with another frame distance or
+    cut only has ffmpeg decode the frames it hasn't seen before.
+
+    When the files take more than max_bytes, the least recently used are deleted.
+    The modification time of a file is its last use, so that's kept between runs.
+    Pinned frames are never deleted, to keep the frames a run has found in the
+    cache there until it gets to them.
+    """
+
+    def __init__(self, folder: Path, max_bytes: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.folder.mkdir(parents=True, exist_ok=True)
+        files = sorted(self.folder.glob("*/*.rgb"), key=lambda f: f.stat().st_mtime)
+        self.entries: OrderedDict[Path, int] = OrderedDict(
+            (file, file.stat().st_size) for file in files
+        )
+        self.size = sum(self.entries.values())
+        self.pinned: set[Path] = set()
+        self.hits = 0
+        self.misses = 0
+
+    def video_key(self, video: Path) -> str:
+        return hashlib.sha256(file_fingerprint(video).encode()).hexdigest()[:32]
+
+    def _file(self, key: str, frame: int, size: tuple[int, int]) -> Path:
+        width, height = size
+        return self.folder / key / f"{frame:08}_{width}x{height}.rgb"
+
+    def contains(self, key: str, frame: int, size: tuple[int, int]) -> bool:
+        return self._file(key, frame, size) in self.entries
+
+    def pin(self, key: str, frames: list[int], size: tuple[int, int]) -> None:
+        self.pinned.update(self._file(key, frame, size) for frame in frames)
+
+    def unpin_all(self) -> None:
+        self.pinned.clear()
+
+    def get(self, key: str, frame: int, size: tuple[int, int]) -> Image.Image | None:
+        file = self._file(key, frame, size)
+        if file not in self.entries:
+            self.misses += 1
+            return None
+        try:
+            with open(file, "rb") as f:
+                # The image keeps the map open, the file can be closed
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(file)
+        except (FileNotFoundError, ValueError):
+            # Deleted by another process sharing the cache, or empty
+            self.size -= self.entries.pop(file)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(file)
+        self.hits += 1
+        return Image.frombuffer("RGB", size, data, "raw", "RGB", 0, 1)
+
+    def put(self, key: str, frame: int, image: Image.Image) -> None:
+        file = self._file(key, frame, image.size)
+        data = image.tobytes()
+        if file in self.entries or len(data) > self.max_bytes:
+            return
+        self._evict(self.max_bytes - len(data))
+
+        file.parent.mkdir(exist_ok=True)
+        # Write and rename, so a crash or another process never sees half a frame
+        tmp_file = file.with_suffix(f".{os.getpid()}.tmp")
+        tmp_file.write_bytes(data)
+        os.replace(tmp_file, file)
+        self.entries[file] = len(data)
+        self.size += len(data)
+
+    def _evict(self, max_size: int) -> None:
+        for file in list(self.entries):
+            if self.size <= max_size:
+                break
+            if file in self.pinned:
+                continue
+            file.unlink(missing_ok=True)
+            self.size -= self.entries.pop(file)
+
+
+def cached_video_frames(
+    cache: FrameCache, video_file: Path, frames: list[int], size: tuple[int, int]
+) -> Iterator[Image.Image]:
+    """Like stream_video_frames, but takes the frames from the cache when they're
+    there, and only has ffmpeg decode the rest (adding them to the cache). Ffmpeg
+    isn't started at all when every frame is cached, and is stopped after the
+    last frame that wasn't.
+
+    The frames must be sorted.
+    """
+    key = cache.video_key(video_file)
+    missing = {frame for frame in frames if not cache.contains(key, frame, size)}
+    # Only the cached ones, the decoded frames can't make the cache go past its limit
+    cache.pin(key, [frame for frame in frames if frame not in missing], size)
+    log(f"{len(frames) - len(missing)} of {len(frames)} frames found in the cache")
+
+    to_decode = sorted(missing)
+    stream = stream_video_frames(video_file, to_decode, size) if missing else None
+    decoded = zip(to_decode, stream or [])
+    last: tuple[int, Image.Image] | None = None
+    try:
+        for frame in frames:
+            if last and last[0] == frame:
+                yield last[1]
+                continue
+
+            image = cache.get(key, frame, size)
+            if image is None:
+                for decoded_frame, decoded_image in decoded:
+                    cache.put(key, decoded_frame, decoded_image)
+                    if decoded_frame == frame:
+                        image = decoded_image
+                        break
+            if image is None:
+                raise RuntimeError(f"Frame {frame} is neither cached nor decoded")
+
+            last = (frame, image)
+            yield image
+    finally:
+        cache.unpin_all()
+        if stream is not None:
+            stream.close()
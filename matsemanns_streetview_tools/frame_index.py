@@ -0,0 +1,69 @@
+import os
+from dataclasses import dataclass
+from decimal import Decimal
+from pathlib import Path
+
+import numpy as np
+
+from matsemanns_streetview_tools import metadata
+from matsemanns_streetview_tools.util import file_fingerprint, log
+from matsemanns_streetview_tools.video import FrameRounding, search_frames
+
+
+@dataclass
+class FrameIndex:
+    """The timestamp of every frame in a video, stored next to it as
+    <video>.frames.npz. Finding the frames from the timestamps instead of the
+    average fps keeps them right when the camera has dropped or duplicated frames,
+    which otherwise adds up to a drift over a long video.
+
+    Reading the timestamps means ffprobe has to go through the whole video, so
+    it's only done once, until the video changes.
+    """
+
+    video: Path
+    fingerprint: str
+    # Microseconds from the first frame, sorted
+    times_us: np.ndarray
+
+    @staticmethod
+    def index_file(video: Path) -> Path:
+        return video.parent / f"{video.name}.frames.npz"
+
+    @classmethod
+    def load(cls, video: Path) -> "FrameIndex":
+        """The stored index for the video, or a new one if there is none or the
+        video has changed since it was made"""
+        fingerprint = file_fingerprint(video)
+        file = cls.index_file(video)
+        if file.exists():
+            with np.load(file) as data:
+                if str(data["fingerprint"]) == fingerprint:
+                    return cls(video, fingerprint, data["times_us"])
+            log(f"{video} has changed since the frame index was made, redoing it")
+
+        index = cls(video, fingerprint, metadata.get_frame_times(video))
+        index.save()
+        return index
+
+    def save(self) -> None:
+        # Write and rename, so a crash never leaves a half written index
+        file = self.index_file(self.video)
+        tmp_file = file.with_suffix(".tmp.npz")
+        np.savez(tmp_file, fingerprint=self.fingerprint, times_us=self.times_us)
+        os.replace(tmp_file, file)
+
+    def __len__(self) -> int:
+        return len(self.times_us)
+
+    def frame_at(self, seconds: float, rounding: FrameRounding = "next") -> int:
+        """The frame for a time since the first frame, or -1/len(self) if it's
+        outside the video"""
+        offset = np.array([round(seconds * 1_000_000)], dtype=np.int64)
+        return int(search_frames(self.times_us, offset, rounding)[0])
+
+    def max_drift(self, fps: Decimal) -> float:
+        """The most any frame is off from where the average fps would put it,
+        in seconds"""
+        expected = np.arange(len(self)) * (1_000_000 / float(fps))
+        return float(np.max(np.abs(self.times_us - expected))) / 1_000_000
@@ -1,8 +1,12 @@
 import json
 import os
+import threading
 import time
-from datetime import timedelta, datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
+from typing import Callable
 
 import requests
 from google.auth.credentials import TokenState
@@ -12,14 +16,35 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 
 from base64 import urlsafe_b64decode
 
-from pydantic import BaseModel
 from requests import Session
 from tqdm import tqdm
 
 from matsemanns_streetview_tools import metadata
 from matsemanns_streetview_tools.gpx import GpxTrack
 from matsemanns_streetview_tools.metadata import FfprobeMetadata
-from matsemanns_streetview_tools.util import log
+from matsemanns_streetview_tools.transfer import (
+    RETRYABLE_STATUSES,
+    Backoff,
+    MiB,
+    ThrottledBody,
+    TokenBucket,
+    TransferController,
+)
+from matsemanns_streetview_tools.upload_journal import UploadJournal
+from matsemanns_streetview_tools.upload_preflight import (
+    PreflightResult,
+    preflight_videos,
+    verify_valid_gpx_for_video,
+)
+from matsemanns_streetview_tools.upload_protocol import (
+    QUERY_HEADERS,
+    ChunkedUpload,
+    UploadAttempt,
+    continue_from_status,
+    mapped_video,
+    upload_status,
+)
+from matsemanns_streetview_tools.util import ERROR, log, streetview_api_url
 
 # No way to avoid publishing this for a public desktop client, even the hidden value.
 # Using PKCE, but google requires the value to be used when requesting the token
@@ -30,22 +55,29 @@ config = json.loads(urlsafe_b64decode(config_str))
 
 user_cred_file = Path("./google_credentials.json")
 
+# Parallel uploads share the credentials, only one of them should refresh the token
+_token_lock = threading.Lock()
 
-def _get_user_credentials() -> Credentials:
+# How long to wait between attempts when an upload has network problems
+retry_backoff = Backoff()
+
+
+def get_user_credentials() -> Credentials:
     if not user_cred_file.exists():
         raise RuntimeError("No google auth configured, run 'google auth'")
     return Credentials.from_authorized_user_file(str(user_cred_file.resolve()))
 
 
-def _save_credentials(creds: Credentials) -> None:
+def save_credentials(creds: Credentials) -> None:
     user_cred_file.write_text(creds.to_json())
 
 
 def _get_credentials_token(creds: Credentials) -> str:
-    if creds.token_state in [TokenState.STALE, TokenState.INVALID]:
-        log("refreshing google token")
-        creds.refresh(Request())
-        _save_credentials(creds)
+    with _token_lock:
+        if creds.token_state in [TokenState.STALE, TokenState.INVALID]:
+            log("refreshing google token")
+            creds.refresh(Request())
+            save_credentials(creds)
 
     return creds.token
 
@@ -71,54 +103,173 @@ def authorize():
 
     credentials: Credentials = flow.run_local_server()  # type: ignore
 
-    _save_credentials(credentials)
+    save_credentials(credentials)
 
     log(f"Token stored in {user_cred_file}")
 
 
+def upload_streetview_videos(
+    videos: list[Path],
+    chunk_size_mib: int = 16,
+    concurrency: int = 2,
+    max_mib_per_second: float | None = None,
+    retries: int = 2,
+    max_chunk_size_mib: int | None = None,
+    credentials: Credentials | None = None,
+) -> list[Path]:
+    """Uploads multiple videos, each together with the gpx file matching its name.
+
+    First checks all videos in parallel, so problems with any of them are reported
+    before starting, and only the valid ones are uploaded.
+    Runs up to concurrency uploads in parallel, sharing the credentials and an optional
+    bandwidth limit. Shows the progress of all of them in one bar. A video failing is
+    started over up to retries times, without affecting the others.
+    Returns the videos that failed.
+    """
+    credentials = credentials or get_user_credentials()
+    bandwidth = TokenBucket(max_mib_per_second * MiB) if max_mib_per_second else None
+    progress_lock = threading.Lock()
+
+    preflight = preflight_videos(videos)
+    valid = [result for result in preflight if not result.error]
+
+    with tqdm(
+        total=sum(os.path.getsize(result.video) for result in valid),
+        desc=f"{len(valid)} videos",
+        unit="B",
+        leave=True,
+        unit_scale=True,
+        unit_divisor=1024,
+    ) as pbar:
+
+        def upload(checked: PreflightResult) -> bool:
+            for attempt_number in range(retries + 1):
+                attempt = UploadAttempt(checked.video, pbar, progress_lock)
+                try:
+                    upload_streetview_video(
+                        checked.video,
+                        checked.gpx_track,
+                        chunk_size_mib,
+                        max_chunk_size_mib=max_chunk_size_mib,
+                        credentials=credentials,
+                        bandwidth=bandwidth,
+                        progress=attempt.progress,
+                        video_metadata=checked.video_metadata,
+                    )
+                    return True
+                except Exception as err:
+                    attempt.failed(err, attempt_number, retries)
+
+            return False
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            uploaded = dict(zip((r.video for r in valid), executor.map(upload, valid)))
+
+    return [video for video in videos if not uploaded.get(video)]
+
+
 def upload_streetview_video(
     video: Path,
     gpx_track: GpxTrack,
     chunk_size_mib: int = 16,
+    max_chunk_size_mib: int | None = None,
+    credentials: Credentials | None = None,
+    bandwidth: TokenBucket | None = None,
+    progress: Callable[[int], None] | None = None,
+    video_metadata: FfprobeMetadata | None = None,
 ) -> None:
     """Uses the Google Street View Publish API to upload a video together with gps data.
     Uploads the video in chunks, so even large files are handled. Also supports interruptions and can resume.
 
     https://developers.google.com/streetview/publish/reference/rest
 
+    Progress is stored in a journal next to the video, so running it again after being
+    stopped continues the upload, or skips it if the video is already published.
+    With max_chunk_size_mib, the chunk size starts at chunk_size_mib and is adjusted to
+    the measured upload speed, up to max_chunk_size_mib.
+    Credentials are read from the stored file if not given. If video_metadata is given,
+    the video is expected to already have been checked by the preflight. Uploaded bytes are sent
+    through bandwidth if given, and reported to progress instead of a progress bar.
     """
-    credentials = _get_user_credentials()
+    credentials = credentials or get_user_credentials()
 
     # Sanity check the metadata, the gpx should cover the video
-    video_metadata = metadata.get_ffprobe_metadata(video)
-    _verify_valid_gpx_for_video(video_metadata, gpx_track)
-    gps_points = _create_google_gps_data_from_gpx(gpx_track)
+    if video_metadata is None:
+        video_metadata = metadata.get_ffprobe_metadata(video)
+        verify_valid_gpx_for_video(video_metadata, gpx_track)
+
+    journal = UploadJournal.load(video)
+    if journal.status == "published":
+        log(f"{video} is already published as {journal.sequence_id}, skipping")
+        if progress:
+            progress(os.path.getsize(video))
+        return
 
     # We don't use default headers in the session, instead make sure we have an up-to-date token each request, as this
     # upload process can last for a long time for large files, making it expire between requests
     session = requests.Session()
 
+    if journal.status == "uploading":
+        _continue_from_journal(session, credentials, journal)
+
     # Tell google we want to upload something, get a ref back
-    log("Step 1/3: Preparing for upload")
-    upload_url = _get_upload_url(session, credentials)
+    if journal.upload_url is None:
+        log(f"Step 1/3: Preparing for upload of {video.name}")
+        journal.upload_url = _get_upload_url(session, credentials)
+        journal.status = "uploading"
+        journal.save()
 
     # Upload the file to the reference we got, parts at a time
-    log(f"Step 2/3: Uploading video to {upload_url}")
-    _chunk_upload_video(session, credentials, video, upload_url, chunk_size_mib)
+    if journal.status == "uploading":
+        log(f"Step 2/3: Uploading {video.name} to {journal.upload_url}")
+        _chunk_upload_video(
+            session,
+            credentials,
+            journal,
+            chunk_size_mib,
+            max_chunk_size_mib,
+            bandwidth,
+            progress,
+        )
+    elif progress:
+        progress(os.path.getsize(video))
 
     # Tell google this should be a streetview together with the gps data
-    log("Step 3/3: Attaching gps data to the uploaded video and publishing")
-    _create_street_view_photosequence(
-        session, credentials, gps_points, video_metadata.get_creation_time(), upload_url
+    log(f"Step 3/3: Attaching gps data to {video.name} and publishing")
+    journal.sequence_id = _create_street_view_photosequence(
+        session,
+        credentials,
+        gpx_track,
+        video_metadata.get_creation_time(),
+        journal.upload_url,
     )
+    journal.status = "published"
+    journal.save()
 
     log(f"Successfully uploaded {video}")
 
 
+def _continue_from_journal(
+    session: Session, credentials: Credentials, journal: UploadJournal
+) -> None:
+    """Checks with google how much of an earlier upload it got, so we can continue
+    from there. Starts over if the upload is gone"""
+    status, received = None, 0
+    if journal.resumable_url is not None:
+        try:
+            status, received = _query_upload(
+                session, credentials, journal.resumable_url
+            )
+        except Exception as err:
+            log(f"Couldn't check earlier upload of {journal.video}, {err}")
+    continue_from_status(journal, status, received)
+    journal.save()
+
+
 def _get_upload_url(session: Session, credentials: Credentials) -> str:
     try:
         res = session.post(
-            "https://streetviewpublish.googleapis.com/v1/photoSequence:startUpload",
+            f"{streetview_api_url()}/photoSequence:startUpload",
             headers={"Authorization": _get_header_token(credentials)},
             timeout=60,
         )
@@ -126,7 +277,7 @@ def _get_upload_url(session: Session, credentials: Credentials) -> str:
 
         return res.json()["uploadUrl"]
     except Exception as err:
-        log(f"ERROR: Something went wrong, {err}")
+        log(f"Something went wrong, {err}", ERROR)
         log(
             "If the error is 401 or 403, check if the token is valid or authorize again"
         )
@@ -136,190 +287,187 @@ def _get_upload_url(session: Session, credentials: Credentials) -> str:
 def _chunk_upload_video(
     session: Session,
     credentials: Credentials,
-    video: Path,
-    upload_url: str,
+    journal: UploadJournal,
     chunk_size_mib: int,
+    max_chunk_size_mib: int | None = None,
+    bandwidth: TokenBucket | None = None,
+    progress: Callable[[int], None] | None = None,
 ) -> None:
-    total_bytes = os.path.getsize(video)
-
-    # Tell google we want to do it in chunks / resumable
-    # Based on https://developers.google.com/streetview/publish/resumable-uploads
-    res = session.post(
-        upload_url,
-        headers={
-            "Authorization": _get_header_token(credentials),
-            "X-Goog-Upload-Protocol": "resumable",
-            "X-Goog-Upload-Header-Content-Length": str(total_bytes),
-            "X-Goog-Upload-Header-Content-Type": "video/mp4",
-            "X-Goog-Upload-Command": "start",
-        },
-    )
-    res.raise_for_status()
-    resumable_url = res.headers["X-Goog-Upload-URL"]
-
-    uploaded_bytes = 0
-    chunk_size = 1024 * 1024 * chunk_size_mib
-
-    with open(video, "rb") as file:
-        with tqdm(
-            total=total_bytes, unit="B", leave=True, unit_scale=True, unit_divisor=1024
-        ) as pbar:
-            while uploaded_bytes < total_bytes:
-                chunk = file.read(chunk_size)
-
-                # If it's the last chunk to upload, different header command
-                remaining = total_bytes - uploaded_bytes
-                command = "upload, finalize" if remaining <= chunk_size else "upload"
-
-                try:
-                    session.post(
-                        resumable_url,
-                        data=chunk,
-                        headers={
-                            "Authorization": _get_header_token(credentials),
-                            "X-Goog-Upload-Offset": str(uploaded_bytes),
-                            "X-Goog-Upload-Command": command,
-                            "Content-Length": str(len(chunk)),
-                        },
-                        timeout=60,
-                    )
-
-                    uploaded_bytes += len(chunk)
-                    pbar.update(len(chunk))
-                    # log(f"Uploaded {uploaded_bytes / 1024 / 1024} MiB")
-                except Exception as err:
-                    log(
-                        f"Something went wrong uploading a chunk {err}, will try to resume"
-                    )
-
-                    uploaded_bytes = _resume_upload(credentials, resumable_url, session)
-                    file.seek(uploaded_bytes)  # Seek to where we should resume from
-                    log(f"Success, resuming upload from byte {uploaded_bytes}")
-
+    video = journal.video
+    pbar = None
+    if progress is None:
+        pbar = tqdm(
+            total=os.path.getsize(video),
+            unit="B",
+            leave=True,
+            unit_scale=True,
+            unit_divisor=1024,
+        )
+        progress = pbar.update
+    try:
+        controller = TransferController(
+            chunk_size_mib * MiB,
+            (max_chunk_size_mib or chunk_size_mib) * MiB,
+            backoff=retry_backoff,
+        )
+        upload = ChunkedUpload(journal, controller, progress)
 
-def _resume_upload(credentials, resumable_url, session) -> int:
-    for attempt in range(10):
-        if attempt < 3:
-            time.sleep(5)
-        else:
-            time.sleep(30)
-        try:
+        # Tell google we want to do it in chunks / resumable
+        if journal.resumable_url is None:
             res = session.post(
-                resumable_url,
-                headers={
-                    "Authorization": _get_header_token(credentials),
-                    "X-Goog-Upload-Command": "query",
-                },
-                timeout=30,
+                journal.upload_url,
+                headers={"Authorization": _get_header_token(credentials)}
+                | upload.start_headers(),
             )
             res.raise_for_status()
-        except Exception as err2:
-            log(f"Didn't work, trying again {err2}")
-            continue
+            upload.started(res.headers)
+            journal.save()
 
-        status = res.headers["X-Goog-Upload-Status"]
+        upload.report_progress()
 
-        if status != "active":
-            log("Upload is no longer active, aborting")
-            raise RuntimeError("Upload no longer active")
+        with mapped_video(video) as view:
+            while not upload.done:
+                # Released when it's sent, the map can't be closed with chunks left
+                with upload.next_chunk(view) as chunk:
+                    _upload_chunk(session, credentials, upload, chunk, bandwidth)
+                journal.save()
+                upload.report_progress()
 
-        return int(res.headers["X-Goog-Upload-Size-Received"])
-
-    log("No more attempts, aborting")
-    raise RuntimeError("Out of attempts to resume the upload")
+        log(f"Uploaded {video.name}, {controller.summary()}")
+    finally:
+        if pbar is not None:
+            pbar.close()
 
 
-def _verify_valid_gpx_for_video(
-    video_metadata: FfprobeMetadata, gpx_track: GpxTrack
+def _upload_chunk(
+    session: Session,
+    credentials: Credentials,
+    upload: ChunkedUpload,
+    chunk: memoryview,
+    bandwidth: TokenBucket | None,
 ) -> None:
-    video_start = video_metadata.get_creation_time()
-    video_end = video_start + video_metadata.get_duration()
-
-    gpx_start = gpx_track.points[0].utc_time
-    gpx_end = gpx_track.points[-1].utc_time
-    # A small delta to handle that video time is in whole seconds
-    if gpx_start > video_start + timedelta(seconds=1):
-        raise RuntimeError(
-            f"Gpx file starts at {gpx_start}, which is after video starts ({video_start})"
-        )
-    if video_end > gpx_end + timedelta(seconds=1):
-        raise RuntimeError(
-            f"Gpx file ends at {gpx_end}, which is before video ends ({video_end})"
+    try:
+        start = time.perf_counter()
+        res = session.post(
+            upload.journal.resumable_url,
+            data=ThrottledBody(chunk, bandwidth) if bandwidth else chunk,
+            headers={"Authorization": _get_header_token(credentials)}
+            | upload.chunk_headers(chunk),
+            timeout=60,
         )
+        res.raise_for_status()
+        upload.sent(chunk, time.perf_counter() - start)
+    except Exception as err:
+        if not _is_retryable(err):
+            log(f"Uploading a chunk of {upload.journal.video.name} failed, {err}, giving up")  # fmt: skip
+            raise
+        upload.failed(chunk, err)
+        upload.resumed(*_resume_upload(session, credentials, upload))
 
 
-class UploadReference(BaseModel):
-    uploadUrl: str
+def _query_upload(
+    session: Session, credentials: Credentials, resumable_url: str
+) -> tuple[str, int]:
+    """Asks google for the status of an upload, and how many bytes it has received"""
+    res = session.post(
+        resumable_url,
+        headers={"Authorization": _get_header_token(credentials)} | QUERY_HEADERS,
+        timeout=30,
+    )
+    res.raise_for_status()
+    return upload_status(res.headers)
 
 
-class LatLng(BaseModel):
-    latitude: float
-    longitude: float
+def _is_retryable(err: Exception) -> bool:
+    """Network problems and statuses like 503 are worth retrying, while errors like
+    401/403 or an unknown upload won't get better by trying again"""
+    if isinstance(err, requests.HTTPError):
+        return (
+            err.response is not None and err.response.status_code in RETRYABLE_STATUSES
+        )
+    return isinstance(err, requests.RequestException)
 
 
-class Pose(BaseModel):
-    latLngPair: LatLng
-    altitude: float | None
-    gpsRecordTimestampUnixEpoch: str
-    heading: float | None = None
-    pitch: float | None = None
-    roll: float | None = None
+def _resume_upload(
+    session: Session, credentials: Credentials, upload: ChunkedUpload
+) -> tuple[str, int]:
+    """Asks google where to continue after a failed chunk, until it answers"""
+    controller = upload.controller
+    for attempt in range(controller.backoff.attempts):
+        controller.wait(attempt)
+        try:
+            return _query_upload(session, credentials, upload.journal.resumable_url)
+        except Exception as err2:
+            if not _is_retryable(err2):
+                log(f"Can't resume the upload, {err2}")
+                raise
+            log(f"Didn't work, trying again {err2}")
 
+    log("No more attempts, aborting")
+    raise RuntimeError("Out of attempts to resume the upload")
 
-class PhotoSequenceRequest(BaseModel):
-    uploadReference: UploadReference
-    rawGpsTimeline: list[Pose]
-    gpsSource: str
-    captureTimeOverride: str
 
+@lru_cache(maxsize=64)
+def _format_second(epoch_second: int) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(epoch_second))
 
-def _create_google_gps_data_from_gpx(gpx_track: GpxTrack) -> list[Pose]:
-    gps_data = []
 
+def _format_timestamp(dt: datetime) -> str:
+    """Same as strftime("%Y-%m-%dT%H:%M:%S.%fZ") for a utc datetime, but formatted from
+    the epoch value. Gps points come several per second, so the formatting of the
+    whole seconds is cached and only the microseconds are added"""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)  # We assume utc
+    # Whole microseconds since epoch fit exactly in a float, the rounding fixes the
+    # error from the float timestamp
+    seconds, micros = divmod(round(dt.timestamp() * 1_000_000), 1_000_000)
+    return f"{_format_second(seconds)}.{micros:06d}Z"
+
+
+def create_photo_sequence_json(
+    gpx_track: GpxTrack, video_start_time: datetime, upload_url: str
+) -> str:
+    """The json for creating the photoSequence, with a pose in rawGpsTimeline per gpx
+    point. Written directly as a string, as long videos can have tens of thousands of
+    points. The tests check it against the schema of the request"""
+    poses = []
     for point in gpx_track.points:
-        gps_data.append(
-            Pose(
-                latLngPair=LatLng(
-                    latitude=float(point.lat),
-                    longitude=float(point.lon),
-                ),
-                altitude=float(point.ele),
-                gpsRecordTimestampUnixEpoch=point.utc_time.strftime(
-                    # "%Y-%m-%dT%H:%M:%S.%fZ" # TODO reactivate
-                    "%Y-%m-%dT%H:%M:%SZ"
-                ),
-                # TODO make configurable if we include these or let google decide?
-                heading=float(point.heading) if point.heading is not None else None,
-                # We know it's horizon leveled
-                pitch=0,
-                roll=0,
-            )
+        # Left out when the gpx has none, then google works it out from the track
+        heading = (
+            f',"heading":{float(point.heading)!r}' if point.heading is not None else ""
+        )
+        poses.append(
+            f'{{"latLngPair":{{"latitude":{float(point.lat)!r},'
+            f'"longitude":{float(point.lon)!r}}},'
+            f'"altitude":{float(point.ele)!r},'
+            f'"gpsRecordTimestampUnixEpoch":"{_format_timestamp(point.utc_time)}"'
+            # We know it's horizon leveled
+            f'{heading},"pitch":0.0,"roll":0.0}}'
         )
 
-    return gps_data
+    return (
+        f'{{"uploadReference":{{"uploadUrl":{json.dumps(upload_url)}}},'
+        f'"rawGpsTimeline":[{",".join(poses)}],'
+        f'"gpsSource":"PHOTO_SEQUENCE",'
+        f'"captureTimeOverride":"{_format_timestamp(video_start_time)}"}}'
+    )
 
 
 def _create_street_view_photosequence(
     session: Session,
     credentials: Credentials,
-    gps_data: list[Pose],
+    gpx_track: GpxTrack,
     video_start_time: datetime,
     upload_url: str,
-) -> None:
-    sequence_request = PhotoSequenceRequest(
-        uploadReference=UploadReference(uploadUrl=upload_url),
-        rawGpsTimeline=gps_data,
-        gpsSource="PHOTO_SEQUENCE",
-        captureTimeOverride=video_start_time.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-    )
+) -> str:
     res = session.post(
-        "https://streetviewpublish.googleapis.com/v1/photoSequence",
-        data=sequence_request.model_dump_json(),
+        f"{streetview_api_url()}/photoSequence",
+        data=create_photo_sequence_json(gpx_track, video_start_time, upload_url),
         headers={"Authorization": _get_header_token(credentials)},
         params={"inputType": "VIDEO"},
         timeout=60,
     )
     res.raise_for_status()
     sequence_id = res.json()["name"]
-    # log(sequence_request.model_dump_json())
     log(f"Completed, saved as {sequence_id}")
+    return sequence_id
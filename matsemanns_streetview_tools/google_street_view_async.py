@@ -0,0 +1,374 @@
+import asyncio
+import os
+import time
+from collections.abc import AsyncIterator, Callable
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+from google.auth.credentials import TokenState
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from tqdm import tqdm
+
+from matsemanns_streetview_tools import google_street_view as gsv
+from matsemanns_streetview_tools import metadata
+from matsemanns_streetview_tools.gpx import GpxTrack
+from matsemanns_streetview_tools.metadata import FfprobeMetadata
+from matsemanns_streetview_tools.transfer import (
+    RETRYABLE_STATUSES,
+    MiB,
+    TokenBucket,
+    TransferController,
+)
+from matsemanns_streetview_tools.upload_journal import UploadJournal
+from matsemanns_streetview_tools.upload_preflight import (
+    PreflightResult,
+    preflight_videos,
+    verify_valid_gpx_for_video,
+)
+from matsemanns_streetview_tools.upload_protocol import (
+    QUERY_HEADERS,
+    ChunkedUpload,
+    UploadAttempt,
+    continue_from_status,
+    mapped_video,
+    upload_status,
+)
+from matsemanns_streetview_tools.util import log, streetview_api_url
+
+# The same uploads as google_street_view, but on asyncio with httpx. All uploads share
+# one event loop, one connection pool and one credential manager. The protocol itself
+# is in upload_protocol, shared with google_street_view, only the requests are here.
+# File writes like saving the journal go through a thread, to not block the loop
+
+
+class CredentialManager:
+    """Shares the credentials between all uploads. Refreshes the token in the
+    background refresh_margin before it expires, so the uploads don't stop to refresh
+    it in the middle of sending chunks. header() only refreshes by itself if the
+    background refresh has failed or fallen behind."""
+
+    def __init__(
+        self, credentials: Credentials, refresh_margin: timedelta = timedelta(minutes=5)
+    ):
+        self.credentials = credentials
+        self.refresh_margin = refresh_margin
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def header(self) -> str:
+        if self.credentials.token_state != TokenState.FRESH:
+            await self._refresh()
+        return f"Bearer {self.credentials.token}"
+
+    async def _refresh(self, force: bool = False) -> None:
+        async with self._lock:
+            # Someone else may have refreshed it while waiting for the lock
+            if not force and self.credentials.token_state == TokenState.FRESH:
+                return
+            log("refreshing google token")
+            await asyncio.to_thread(self.credentials.refresh, Request())
+            await asyncio.to_thread(gsv.save_credentials, self.credentials)
+
+    async def _refresh_loop(self) -> None:
+        while self.credentials.expiry is not None:
+            # google-auth keeps expiry as naive utc
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            wait = self.credentials.expiry - self.refresh_margin - now
+            await asyncio.sleep(max(wait.total_seconds(), 0))
+            try:
+                await self._refresh(force=True)
+            except Exception as err:
+                log(f"Refreshing google token failed, {err}, trying again soon")
+                await asyncio.sleep(30)
+
+
+async def upload_streetview_videos(
+    videos: list[Path],
+    chunk_size_mib: int = 16,
+    max_chunk_size_mib: int | None = None,
+    concurrency: int = 2,
+    max_mib_per_second: float | None = None,
+    retries: int = 2,
+    credentials: Credentials | None = None,
+) -> list[Path]:
+    """Same as google_street_view.upload_streetview_videos, but runs the uploads as
+    tasks on the event loop instead of in threads. Returns the videos that failed."""
+    credential_manager = CredentialManager(credentials or gsv.get_user_credentials())
+    bandwidth = TokenBucket(max_mib_per_second * MiB) if max_mib_per_second else None
+    semaphore = asyncio.Semaphore(concurrency)
+
+    preflight = await asyncio.to_thread(preflight_videos, videos)
+    valid = [result for result in preflight if not result.error]
+
+    async with httpx.AsyncClient(
+        timeout=60, limits=httpx.Limits(max_connections=concurrency * 2)
+    ) as client:
+        await credential_manager.start()
+        try:
+            with tqdm(
+                total=sum(os.path.getsize(result.video) for result in valid),
+                desc=f"{len(valid)} videos",
+                unit="B",
+                leave=True,
+                unit_scale=True,
+                unit_divisor=1024,
+            ) as pbar:
+
+                async def upload(checked: PreflightResult) -> bool:
+                    async with semaphore:
+                        return await _upload_with_retries(
+                            client,
+                            credential_manager,
+                            checked,
+                            chunk_size_mib,
+                            max_chunk_size_mib,
+                            bandwidth,
+                            pbar,
+                            retries,
+                        )
+
+                results = await asyncio.gather(*(upload(r) for r in valid))
+        finally:
+            await credential_manager.stop()
+
+    uploaded = dict(zip((result.video for result in valid), results))
+    return [video for video in videos if not uploaded.get(video)]
+
+
+async def _upload_with_retries(
+    client: httpx.AsyncClient,
+    credentials: CredentialManager,
+    checked: PreflightResult,
+    chunk_size_mib: int,
+    max_chunk_size_mib: int | None,
+    bandwidth: TokenBucket | None,
+    pbar: tqdm,
+    retries: int,
+) -> bool:
+    for attempt_number in range(retries + 1):
+        attempt = UploadAttempt(checked.video, pbar)
+        try:
+            await upload_streetview_video(
+                client,
+                credentials,
+                checked.video,
+                checked.gpx_track,
+                chunk_size_mib,
+                max_chunk_size_mib,
+                bandwidth,
+                attempt.progress,
+                checked.video_metadata,
+            )
+            return True
+        except Exception as err:
+            attempt.failed(err, attempt_number, retries)
+
+    return False
+
+
+async def upload_streetview_video(
+    client: httpx.AsyncClient,
+    credentials: CredentialManager,
+    video: Path,
+    gpx_track: GpxTrack,
+    chunk_size_mib: int = 16,
+    max_chunk_size_mib: int | None = None,
+    bandwidth: TokenBucket | None = None,
+    progress: Callable[[int], None] | None = None,
+    video_metadata: FfprobeMetadata | None = None,
+) -> None:
+    """The three steps of google_street_view.upload_streetview_video, using the
+    same upload journal"""
+    if video_metadata is None:
+        video_metadata = await asyncio.to_thread(metadata.get_ffprobe_metadata, video)
+        verify_valid_gpx_for_video(video_metadata, gpx_track)
+
+    journal = await asyncio.to_thread(UploadJournal.load, video)
+    if journal.status == "published":
+        log(f"{video} is already published as {journal.sequence_id}, skipping")
+        if progress:
+            progress(os.path.getsize(video))
+        return
+
+    if journal.status == "uploading":
+        await _continue_from_journal(client, credentials, journal)
+
+    if journal.upload_url is None:
+        log(f"Step 1/3: Preparing for upload of {video.name}")
+        res = await client.post(
+            f"{streetview_api_url()}/photoSequence:startUpload",
+            headers={"Authorization": await credentials.header()},
+        )
+        res.raise_for_status()
+        journal.upload_url = res.json()["uploadUrl"]
+        journal.status = "uploading"
+        await asyncio.to_thread(journal.save)
+
+    if journal.status == "uploading":
+        log(f"Step 2/3: Uploading {video.name} to {journal.upload_url}")
+        await _chunk_upload_video(
+            client,
+            credentials,
+            journal,
+            chunk_size_mib,
+            max_chunk_size_mib,
+            bandwidth,
+            progress,
+        )
+    elif progress:
+        progress(os.path.getsize(video))
+
+    log(f"Step 3/3: Attaching gps data to {video.name} and publishing")
+    res = await client.post(
+        f"{streetview_api_url()}/photoSequence",
+        content=gsv.create_photo_sequence_json(
+            gpx_track, video_metadata.get_creation_time(), journal.upload_url
+        ),
+        headers={"Authorization": await credentials.header()},
+        params={"inputType": "VIDEO"},
+    )
+    res.raise_for_status()
+    journal.sequence_id = res.json()["name"]
+    journal.status = "published"
+    await asyncio.to_thread(journal.save)
+
+    log(f"Successfully uploaded {video}, saved as {journal.sequence_id}")
+
+
+async def _continue_from_journal(
+    client: httpx.AsyncClient, credentials: CredentialManager, journal: UploadJournal
+) -> None:
+    status, received = None, 0
+    if journal.resumable_url is not None:
+        try:
+            status, received = await _query_upload(
+                client, credentials, journal.resumable_url
+            )
+        except Exception as err:
+            log(f"Couldn't check earlier upload of {journal.video}, {err}")
+    continue_from_status(journal, status, received)
+    await asyncio.to_thread(journal.save)
+
+
+async def _chunk_stream(
+    chunk: memoryview, bandwidth: TokenBucket | None, block_size: int = 256 * 1024
+) -> AsyncIterator[memoryview]:
+    """The chunk as a request body, sent in blocks that each wait (without blocking
+    the event loop) for their share of the bandwidth"""
+    for start in range(0, len(chunk), block_size):
+        block = chunk[start : start + block_size]
+        if bandwidth:
+            await asyncio.sleep(bandwidth.reserve(len(block)))
+        yield block
+
+
+async def _chunk_upload_video(
+    client: httpx.AsyncClient,
+    credentials: CredentialManager,
+    journal: UploadJournal,
+    chunk_size_mib: int,
+    max_chunk_size_mib: int | None = None,
+    bandwidth: TokenBucket | None = None,
+    progress: Callable[[int], None] | None = None,
+) -> None:
+    controller = TransferController(
+        chunk_size_mib * MiB,
+        (max_chunk_size_mib or chunk_size_mib) * MiB,
+        backoff=gsv.retry_backoff,
+    )
+    progress = progress or (lambda n: None)
+    upload = ChunkedUpload(journal, controller, progress)
+
+    if journal.resumable_url is None:
+        res = await client.post(
+            journal.upload_url,
+            headers={"Authorization": await credentials.header()}
+            | upload.start_headers(),
+        )
+        res.raise_for_status()
+        upload.started(res.headers)
+        await asyncio.to_thread(journal.save)
+
+    upload.report_progress()
+
+    with mapped_video(journal.video) as view:
+        while not upload.done:
+            with upload.next_chunk(view) as chunk:
+                await _upload_chunk(client, credentials, upload, chunk, bandwidth)
+            await asyncio.to_thread(journal.save)
+            upload.report_progress()
+
+    log(f"Uploaded {journal.video.name}, {controller.summary()}")
+
+
+async def _upload_chunk(
+    client: httpx.AsyncClient,
+    credentials: CredentialManager,
+    upload: ChunkedUpload,
+    chunk: memoryview,
+    bandwidth: TokenBucket | None,
+) -> None:
+    try:
+        start = time.perf_counter()
+        res = await client.post(
+            upload.journal.resumable_url,
+            content=_chunk_stream(chunk, bandwidth),
+            headers={"Authorization": await credentials.header()}
+            | upload.chunk_headers(chunk),
+        )
+        res.raise_for_status()
+        upload.sent(chunk, time.perf_counter() - start)
+    except Exception as err:
+        if not _is_retryable(err):
+            log(f"Uploading a chunk of {upload.journal.video.name} failed, {err}, giving up")  # fmt: skip
+            raise
+        upload.failed(chunk, err)
+        upload.resumed(*await _resume_upload(client, credentials, upload))
+
+
+def _is_retryable(err: Exception) -> bool:
+    if isinstance(err, httpx.HTTPStatusError):
+        return err.response.status_code in RETRYABLE_STATUSES
+    return isinstance(err, httpx.TransportError)
+
+
+async def _query_upload(
+    client: httpx.AsyncClient, credentials: CredentialManager, resumable_url: str
+) -> tuple[str, int]:
+    res = await client.post(
+        resumable_url,
+        headers={"Authorization": await credentials.header()} | QUERY_HEADERS,
+        timeout=30,
+    )
+    res.raise_for_status()
+    return upload_status(res.headers)
+
+
+async def _resume_upload(
+    client: httpx.AsyncClient, credentials: CredentialManager, upload: ChunkedUpload
+) -> tuple[str, int]:
+    controller = upload.controller
+    for attempt in range(controller.backoff.attempts):
+        await asyncio.sleep(controller.delay(attempt))
+        try:
+            return await _query_upload(
+                client, credentials, upload.journal.resumable_url
+            )
+        except Exception as err:
+            if not _is_retryable(err):
+                log(f"Can't resume the upload, {err}")
+                raise
+            log(f"Didn't work, trying again {err}")
+
+    log("No more attempts, aborting")
+    raise RuntimeError("Out of attempts to resume the upload")
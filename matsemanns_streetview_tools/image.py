@@ -1,5 +1,10 @@
-import subprocess
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import cache, lru_cache
 from pathlib import Path
+from typing import Any
+
+import numpy as np
 from PIL import Image, ImageEnhance, ExifTags
 
 
@@ -8,33 +13,147 @@ from matsemanns_streetview_tools.util import (
     log,
     datetime_to_exifdatetime,
     datetime_to_exifdate,
-    magick_path,
 )
 
 
 def create_nadir(
     input_file: Path, output_file: Path, width: int = 5376, height: int = 588
 ) -> None:
-    cmd = [
-        magick_path(),
-        str(input_file.resolve()),
-        "-rotate",
-        "180",
-        "-distort",
-        "DePolar",
-        "0",
-        "-rotate",
-        "180",
-        "-resize",
-        f"{width}x{height}!",
-        str(output_file.resolve()),
-    ]
-    log(f"Running magick: {' '.join(cmd)}")
-
-    proc = subprocess.run(cmd, capture_output=True, text=True)
-
-    if proc.returncode != 0:
-        raise RuntimeError("Error from magick", proc.stderr)
+    """Converts a square image (like a round logo) to an equirectangular nadir,
+    to be placed at the bottom of the 360 images."""
+    log(f"Creating {width}x{height} nadir from {input_file}")
+    nadir = render_nadir(Image.open(input_file), width, height)
+    nadir.save(output_file)
+
+
+def render_nadir(img: Image.Image, width: int, height: int) -> Image.Image:
+    """Unwraps the circle inscribed in the image to a width x height strip, so that
+    the center of the image ends up at the bottom (the nadir) and the edge of the
+    circle at the top. The top of the image faces the middle of the 360 image.
+
+    Like ImageMagick's DePolar distortion, but done in-process with numpy.
+    """
+    img = img.convert("RGBA")
+
+    # Only the inscribed square is used. Scale down large inputs first, as bilinear
+    # sampling would alias when sampling sparsely. At this size the circle's
+    # circumference is still more than enough pixels for the width.
+    w, h = img.size
+    side = min(w, h)
+    box = ((w - side) // 2, (h - side) // 2, (w + side) // 2, (h + side) // 2)
+    target_side = min(side, 2 * height)
+    if box != (0, 0, w, h):
+        img = img.crop(box)
+    if target_side != side:
+        factor = side // target_side
+        if factor > 1:
+            img = img.reduce(factor)  # much faster than resampling everything
+        img = img.resize((target_side, target_side), Image.Resampling.LANCZOS)
+
+    x0, y0, wx, wy = _depolar_map(img.size, (width, height))
+    src = np.asarray(img)
+    src_w = src.shape[1]
+    idx00 = y0 * src_w + x0
+    idx10 = idx00 + 1
+    idx01 = idx00 + src_w
+    idx11 = idx01 + 1
+
+    out = np.empty((height, width, 4), dtype=np.uint8)
+    for channel in range(4):
+        flat = src[:, :, channel].ravel().astype(np.float32)
+        top = flat[idx00] * (1 - wx) + flat[idx10] * wx
+        bottom = flat[idx01] * (1 - wx) + flat[idx11] * wx
+        value = top * (1 - wy) + bottom * wy
+        out[:, :, channel] = np.clip(value + 0.5, 0, 255)
+
+    return Image.fromarray(out, "RGBA")
+
+
+@lru_cache(maxsize=4)
+def _depolar_map(
+    input_size: tuple[int, int], output_size: tuple[int, int]
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """For each output pixel, the top left input pixel to sample (x0, y0) and the
+    bilinear weights (wx, wy) towards the pixel to the right and below.
+    Cached as it only depends on the sizes."""
+    in_w, in_h = input_size
+    out_w, out_h = output_size
+    radius = min(in_w, in_h) / 2
+
+    # Angle 0 (the middle column) is the top of the input, increasing clockwise
+    angles = (np.arange(out_w) + 0.5) / out_w * 2 * np.pi - np.pi
+    # Top row is the edge of the circle, bottom row the center
+    radii = (out_h - np.arange(out_h) - 0.5) / out_h * radius
+
+    # Coordinates in pixel centers
+    x = in_w / 2 + radii[:, None] * np.sin(angles)[None, :] - 0.5
+    y = in_h / 2 - radii[:, None] * np.cos(angles)[None, :] - 0.5
+    x = np.clip(x, 0, in_w - 1.001)
+    y = np.clip(y, 0, in_h - 1.001)
+
+    x0 = np.floor(x).astype(np.intp)
+    y0 = np.floor(y).astype(np.intp)
+    wx = (x - x0).astype(np.float32)
+    wy = (y - y0).astype(np.float32)
+    return x0, y0, wx, wy
+
+
+# The order the enhancements are applied in
+ENHANCERS: list[tuple[str, type[ImageEnhance._Enhance]]] = [
+    ("contrast", ImageEnhance.Contrast),
+    ("brightness", ImageEnhance.Brightness),
+    ("color", ImageEnhance.Color),
+    ("sharpness", ImageEnhance.Sharpness),
+]
+
+Box = tuple[int, int, int, int]
+
+
+def visible_region(
+    image_size: tuple[int, int], nadir_size: tuple[int, int] | None = None
+) -> Box:
+    """The box (left, top, right, bottom) of an image that will still be visible
+    after the nadir has been pasted in the bottom. No need to spend time enhancing
+    the rows that will be overwritten anyway.
+
+    A nadir not covering the whole width doesn't hide any full rows, so then
+    the whole image is returned.
+    """
+    w, h = image_size
+    if nadir_size is None:
+        return 0, 0, w, h
+
+    n_w, n_h = nadir_size
+    if n_w < w:
+        return 0, 0, w, h
+
+    return 0, 0, w, max(h - n_h, 0)
+
+
+def _intersect(a: Box, b: Box) -> Box:
+    left, top = max(a[0], b[0]), max(a[1], b[1])
+    right, bottom = min(a[2], b[2]), min(a[3], b[3])
+    return left, top, max(left, right), max(top, bottom)
+
+
+def enhance_image(
+    img: Image.Image,
+    color: float | None = None,
+    contrast: float | None = None,
+    brightness: float | None = None,
+    sharpness: float | None = None,
+) -> Image.Image:
+    values = {
+        "color": color,
+        "contrast": contrast,
+        "brightness": brightness,
+        "sharpness": sharpness,
+    }
+    for name, enhancer in ENHANCERS:
+        value = values[name]
+        if value:
+            img = enhancer(img).enhance(value)
+    return img
 
 
 def apply_image_pipeline(
@@ -44,15 +163,40 @@ def apply_image_pipeline(
     contrast: float | None = None,
     brightness: float | None = None,
     sharpness: float | None = None,
+    region: Box | None = None,
+    mask: Image.Image | None = None,
 ) -> Image.Image:
-    if contrast:
-        img = ImageEnhance.Contrast(img).enhance(contrast)
-    if brightness:
-        img = ImageEnhance.Brightness(img).enhance(brightness)
-    if color:
-        img = ImageEnhance.Color(img).enhance(color)
-    if sharpness:
-        img = ImageEnhance.Sharpness(img).enhance(sharpness)
+    """Applies the enhancements and pastes the nadir on the image.
+
+    The enhancements are only applied to the part of the image not covered
+    by the nadir. They can be limited further by a region (a box) and/or a mask
+    (mode "L" or "1", same size as the image) where only the masked pixels are changed.
+    Note that contrast is then based on the average of the enhanced part only.
+
+    The input image is never modified. With no enhancements and no nadir there's
+    nothing to do, and the input image itself is returned.
+    """
+    has_enhancements = any([color, contrast, brightness, sharpness])
+
+    if has_enhancements:
+        full_image = (0, 0, *img.size)
+        box = visible_region(img.size, nadir.size if nadir else None)
+        if region:
+            box = _intersect(box, region)
+
+        if box == full_image and mask is None:
+            img = enhance_image(img, color, contrast, brightness, sharpness)
+        elif box[0] == box[2] or box[1] == box[3]:
+            # Nothing visible left to enhance
+            img = img.copy()
+        else:
+            enhanced = enhance_image(
+                img.crop(box), color, contrast, brightness, sharpness
+            )
+            img = img.copy()
+            img.paste(enhanced, box[:2], mask.crop(box) if mask else None)
+    elif nadir:
+        img = img.copy()
 
     if nadir:
         w, h = img.size
@@ -108,7 +252,12 @@ def create_exif_data(img: Image.Image, gpx_point: GpxPoint):
 
 
 def create_xmp_pano_data(img: Image.Image) -> bytes:
-    w, h = img.size
+    return _xmp_pano_data(*img.size)
+
+
+@cache
+def _xmp_pano_data(w: int, h: int) -> bytes:
+    # Same for all images of the same size, so only created once
     return str.encode(f"""<?xpacket begin='﻿' id='W5M0MpCehiHzreSzNTczkc9d'?>
 <x:xmpmeta xmlns:x='adobe:ns:meta/' x:xmptk='Image::ExifTool 12.40'>
 <rdf:RDF xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#'>
@@ -129,6 +278,82 @@ def create_xmp_pano_data(img: Image.Image) -> bytes:
 <?xpacket end='w'?>""")
 
 
+def jpeg_save_options(
+    quality: int = 95,
+    subsampling: str | None = None,
+    optimize: bool | None = None,
+    progressive: bool | None = None,
+) -> dict[str, Any]:
+    """Options for Image.save when saving as jpeg, to trade size for throughput.
+    Subsampling is like "4:4:4" (best), "4:2:2" or "4:2:0" (default, smallest).
+    Optimize makes files a bit smaller, but costs an extra pass when encoding,
+    progressive is even slower and mainly useful for web, so both are off by default.
+    """
+    options: dict[str, Any] = {
+        "quality": quality,
+        "optimize": bool(optimize),
+        "progressive": bool(progressive),
+    }
+    if subsampling is not None:
+        options["subsampling"] = subsampling
+    return options
+
+
+class ImageWriter:
+    """Saves images on background threads, so encoding and writing the jpgs
+    overlaps with processing the next frame (Pillow releases the GIL while
+    encoding). At most max_pending images wait to be saved, after that save()
+    blocks, so a slow disk can't fill up the memory.
+
+    with ImageWriter(workers=2) as writer:
+        writer.save(image, file, quality=95)
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int | None = None):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="image-writer")
+        self.pending = threading.BoundedSemaphore(max_pending or workers * 2)
+        self.futures: list[Future] = []
+        self.bytes_written = 0
+        self.error: Exception | None = None
+        self._lock = threading.Lock()
+
+    def save(self, image: Image.Image, file: Path, **options) -> None:
+        # Fail fast instead of processing the rest of the frames for nothing
+        if self.error:
+            raise self.error
+
+        self.pending.acquire()
+        future = self.executor.submit(self._save, image, file, options)
+        future.add_done_callback(lambda _: self.pending.release())
+        self.futures.append(future)
+
+    def _save(self, image: Image.Image, file: Path, options: dict) -> None:
+        try:
+            image.save(file, **options)
+            size = file.stat().st_size
+        except Exception as err:
+            self.error = err
+            raise
+        with self._lock:
+            self.bytes_written += size
+
+    def close(self) -> None:
+        """Waits for all images to be saved, raises if any failed"""
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+        self.futures.clear()
+
+    def __enter__(self) -> "ImageWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            self.close()
+
+
 if __name__ == "__main__":
     create_nadir(
         Path("./test_files/nadir_3k.png"),
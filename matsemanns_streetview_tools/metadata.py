@@ -3,7 +3,7 @@ import subprocess
 from decimal import Decimal
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional, Any
+from typing import TYPE_CHECKING, Optional, Any
 
 from matsemanns_streetview_tools.util import (
     log,
@@ -12,6 +12,9 @@ from matsemanns_streetview_tools.util import (
     exiftool_path,
 )
 
+if TYPE_CHECKING:
+    import numpy as np
+
 
 class ExiftoolMetadata:
     def __init__(self, data):
@@ -113,3 +116,37 @@ def get_ffprobe_metadata(file: Path) -> FfprobeMetadata:
 
     result = proc.stdout
     return FfprobeMetadata(json.loads(result))
+
+
+def get_frame_times(file: Path) -> "np.ndarray":
+    """Microseconds from the first frame for each frame of the video, from the
+    timestamps of the packets. For videos with a variable framerate, or dropped
+    frames, where the frame number can't be calculated from the fps."""
+    # Not on import, the cli commands using this module don't all need numpy
+    import numpy as np
+
+    cmd = [
+        ffprobe_path(),
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time",
+        "-of",
+        "csv=p=0",
+        str(file.resolve()),
+    ]
+    log(f"Running ffprobe: {' '.join(cmd)}")
+
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+
+    if proc.returncode != 0:
+        raise RuntimeError("Error from ffprobe", proc.stderr)
+
+    times = np.array(
+        [float(line.strip(",")) for line in proc.stdout.split() if line != "N/A"]
+    )
+    if len(times) == 0:
+        raise RuntimeError(f"No frames found in {file}")
+    # Packets are in decoding order, B-frames makes that differ from the display order
+    times_us = np.sort(np.round(times * 1_000_000).astype(np.int64))
+    return times_us - times_us[0]
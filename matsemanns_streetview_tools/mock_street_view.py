@@ -0,0 +1,219 @@
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from matsemanns_streetview_tools.transfer import TokenBucket
+
+
+@dataclass
+class MockUpload:
+    total_bytes: int | None = None
+    data: bytearray = field(default_factory=bytearray)
+    status: str = "created"  # -> active -> final
+
+
+class MockStreetViewServer:
+    """A local stand-in for the parts of the Street View Publish API used when
+    uploading: startUpload, the resumable upload protocol and creating the
+    photoSequence. Keeps everything in memory, so tests (or benchmarks) can run the
+    real upload code against it by pointing STREETVIEW_API_URL to api_url.
+
+    with MockStreetViewServer() as server:
+        monkeypatch.setenv("STREETVIEW_API_URL", server.api_url)
+        ...
+        server.uploads, server.sequences
+
+    Can also act like a worse network than localhost: latency is added to every
+    request, bandwidth (bytes/s) caps how fast all request bodies together are read,
+    and failure_rate is the chance of a chunk upload failing with a 503 after its
+    data has been sent. recovery_times has how long each failed upload took until
+    its next chunk was accepted.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        bandwidth: float | None = None,
+        failure_rate: float = 0.0,
+        seed: int | None = None,
+    ):
+        self.uploads: dict[str, MockUpload] = {}
+        self.sequences: list[dict] = []
+        # Statuses to answer the next chunk uploads with, instead of accepting them
+        self.chunk_failures: list[int] = []
+        self.latency = latency
+        self.bandwidth = TokenBucket(bandwidth) if bandwidth else None
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.injected_failures = 0
+        self.recovery_times: list[float] = []
+        self._failed_at: dict[str, float] = {}
+        self.lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.mock = self  # type: ignore
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.url}/v1"
+
+    def start(self) -> "MockStreetViewServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "MockStreetViewServer":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real api
+
+    @property
+    def mock(self) -> MockStreetViewServer:
+        return self.server.mock  # type: ignore
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        if self.mock.bandwidth is None:
+            return self.rfile.read(length)
+
+        body = bytearray()
+        while len(body) < length:
+            block = self.rfile.read(min(64 * 1024, length - len(body)))
+            if not block:
+                break
+            self.mock.bandwidth.consume(len(block))
+            body += block
+        return bytes(body)
+
+    def do_POST(self) -> None:
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+        body = self._read_body()
+
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            return self._respond(401, {"error": "missing token"})
+
+        path = urlparse(self.path).path
+        parts = path.strip("/").split("/")
+        if path == "/v1/photoSequence:startUpload":
+            self._start_upload()
+        elif path == "/v1/photoSequence":
+            self._create_sequence(body)
+        elif len(parts) == 2 and parts[0] == "media":
+            self._start_resumable(parts[1])
+        elif len(parts) == 2 and parts[0] == "resumable":
+            self._resumable(parts[1], body)
+        else:
+            self._respond(404, {"error": f"unknown path {path}"})
+
+    def _respond(
+        self, status: int, content: dict | None = None, headers: dict | None = None
+    ) -> None:
+        data = json.dumps(content).encode() if content is not None else b""
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_upload(self) -> None:
+        with self.mock.lock:
+            upload_id = str(len(self.mock.uploads) + 1)
+            self.mock.uploads[upload_id] = MockUpload()
+        self._respond(200, {"uploadUrl": f"{self.mock.url}/media/{upload_id}"})
+
+    def _start_resumable(self, upload_id: str) -> None:
+        upload = self.mock.uploads.get(upload_id)
+        if upload is None or self.headers.get("X-Goog-Upload-Command") != "start":
+            return self._respond(400, {"error": "unknown upload"})
+
+        upload.total_bytes = int(self.headers["X-Goog-Upload-Header-Content-Length"])
+        upload.status = "active"
+        self._respond(
+            200,
+            headers={
+                "X-Goog-Upload-Status": "active",
+                "X-Goog-Upload-URL": f"{self.mock.url}/resumable/{upload_id}",
+                "X-Goog-Upload-Chunk-Granularity": str(256 * 1024),
+            },
+        )
+
+    def _resumable(self, upload_id: str, body: bytes) -> None:
+        upload = self.mock.uploads.get(upload_id)
+        if upload is None:
+            return self._respond(404, {"error": "unknown upload"})
+
+        command = self.headers.get("X-Goog-Upload-Command", "")
+        if "query" not in command:
+            if upload.status != "active":
+                return self._respond(400, {"error": "upload not active"})
+            if int(self.headers.get("X-Goog-Upload-Offset", -1)) != len(upload.data):
+                return self._respond(400, {"error": "wrong offset"})
+            with self.mock.lock:
+                if self.mock.chunk_failures:
+                    failure = self.mock.chunk_failures.pop(0)
+                elif self.mock.random.random() < self.mock.failure_rate:
+                    failure = 503
+                else:
+                    failure = None
+
+                if failure:
+                    self.mock.injected_failures += 1
+                    self.mock._failed_at.setdefault(upload_id, time.monotonic())
+                elif upload_id in self.mock._failed_at:
+                    failed_at = self.mock._failed_at.pop(upload_id)
+                    self.mock.recovery_times.append(time.monotonic() - failed_at)
+            if failure:
+                return self._respond(failure, {"error": "injected failure"})
+
+            upload.data += body
+            if "finalize" in command:
+                if len(upload.data) != upload.total_bytes:
+                    return self._respond(400, {"error": "finalized incomplete upload"})
+                upload.status = "final"
+
+        self._respond(
+            200,
+            headers={
+                "X-Goog-Upload-Status": upload.status,
+                "X-Goog-Upload-Size-Received": str(len(upload.data)),
+            },
+        )
+
+    def _create_sequence(self, body: bytes) -> None:
+        request = json.loads(body)
+        upload_id = request["uploadReference"]["uploadUrl"].rsplit("/", 1)[-1]
+        upload = self.mock.uploads.get(upload_id)
+        if upload is None or upload.status != "final":
+            return self._respond(400, {"error": "upload not finalized"})
+
+        with self.mock.lock:
+            self.mock.sequences.append(request)
+            name = f"photoSequences/{len(self.mock.sequences)}"
+        self._respond(200, {"name": name})
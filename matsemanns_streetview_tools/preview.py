@@ -0,0 +1,163 @@
+import itertools
+import math
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from matsemanns_streetview_tools.image import ENHANCERS, apply_image_pipeline
+
+
+def open_preview_image(file: Path, max_width: int | None = None) -> Image.Image:
+    """Opens the image downscaled to at most max_width (keeping aspect ratio).
+    For jpegs the downscaling is mostly done by the decoder (draft mode), so the full
+    resolution image is never decoded, which is much faster for large panoramas."""
+    img = Image.open(file)
+    w, h = img.size
+
+    if max_width and w > max_width:
+        size = (max_width, max(1, round(h * max_width / w)))
+        img.draft("RGB", size)  # picks a decoder scale still >= size
+        factor = img.size[0] // max_width
+        if factor > 1:
+            img = img.reduce(factor)
+        if img.size[0] > max_width:
+            img = img.resize(size, Image.Resampling.LANCZOS)
+
+    img.load()
+    return img
+
+
+class PreviewPipeline:
+    """Applies the same enhancements as apply_image_pipeline, but keeps the result
+    of each step. When a single value is changed, only the steps from that
+    enhancement and onwards are recomputed."""
+
+    def __init__(self, img: Image.Image):
+        self.img = img
+        self._steps: list[tuple[float | None, Image.Image]] = []
+
+    def apply(
+        self,
+        color: float | None = None,
+        contrast: float | None = None,
+        brightness: float | None = None,
+        sharpness: float | None = None,
+    ) -> Image.Image:
+        values = {
+            "color": color,
+            "contrast": contrast,
+            "brightness": brightness,
+            "sharpness": sharpness,
+        }
+
+        img = self.img
+        for i, (name, enhancer) in enumerate(ENHANCERS):
+            value = values[name]
+            if i < len(self._steps) and self._steps[i][0] == value:
+                img = self._steps[i][1]
+                continue
+
+            del self._steps[i:]
+            # 1.0 gives back the same image, so no need to spend time on it
+            if value and value != 1.0:
+                img = enhancer(img).enhance(value)
+            self._steps.append((value, img))
+
+        return img
+
+
+def texture_data(img: Image.Image) -> np.ndarray:
+    """The image as a flat float32 RGBA array in 0-1, the format used by dearpygui
+    textures. Avoids going through a python list of floats."""
+    data = np.asarray(img.convert("RGBA"), dtype=np.float32)
+    data *= 1 / 255
+    return data.ravel()
+
+
+EffectValues = tuple[float | None, float | None, float | None, float | None]
+
+
+def _render_variant(
+    img: Image.Image,
+    values: EffectValues,
+    output_folder: Path,
+    thumbnail_width: int | None,
+) -> tuple[Path, Image.Image | None]:
+    con, bri, col, sharp = values
+    img2 = apply_image_pipeline(
+        img, contrast=con, color=col, brightness=bri, sharpness=sharp
+    )
+    if img2 is img:
+        # Nothing to enhance, don't draw the label on the image all variants share
+        img2 = img.copy()
+    label = f"con={con},bri={bri},col={col},sharp={sharp}"
+    ImageDraw.Draw(img2).text((0, 0), label, font_size=max(12, img2.width // 100))
+
+    file = output_folder / f"con{con}_bri{bri}_col{col}_sharp{sharp}.jpg"
+    img2.save(file, quality=95)
+
+    thumbnail = None
+    if thumbnail_width:
+        w, h = img2.size
+        thumbnail = img2.resize(
+            (thumbnail_width, max(1, round(h * thumbnail_width / w))),
+            Image.Resampling.BILINEAR,
+            reducing_gap=2.0,
+        )
+    return file, thumbnail
+
+
+def render_effect_grid(
+    img: Image.Image,
+    output_folder: Path,
+    contrasts: list[float | None],
+    brightness: list[float | None],
+    colors: list[float | None],
+    sharpness: list[float | None],
+    max_workers: int | None = None,
+    contact_sheet_width: int | None = None,
+) -> list[Path]:
+    """Saves a variant of the image for every combination of the values.
+
+    The variants are rendered in a thread pool, all working from the same decoded image
+    (Pillow releases the GIL for the heavy parts like the jpeg encoding).
+    If contact_sheet_width is given, also saves contact_sheet.jpg with all variants
+    in a grid of that total width.
+    """
+    img.load()
+    combinations = list(itertools.product(contrasts, brightness, colors, sharpness))
+
+    columns = math.ceil(math.sqrt(len(combinations)))
+    thumbnail_width = contact_sheet_width // columns if contact_sheet_width else None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(
+            executor.map(
+                lambda values: _render_variant(
+                    img, values, output_folder, thumbnail_width
+                ),
+                combinations,
+            )
+        )
+
+    files = [file for file, _ in results]
+    thumbnails = [thumbnail for _, thumbnail in results if thumbnail]
+    if thumbnails:
+        sheet = create_contact_sheet(thumbnails, columns)
+        sheet_file = output_folder / "contact_sheet.jpg"
+        sheet.save(sheet_file, quality=90)
+        files.append(sheet_file)
+
+    return files
+
+
+def create_contact_sheet(images: list[Image.Image], columns: int) -> Image.Image:
+    """Places the images (expected to be the same size) in a grid"""
+    w, h = images[0].size
+    rows = math.ceil(len(images) / columns)
+    sheet = Image.new("RGB", (w * columns, h * rows))
+    for i, img in enumerate(images):
+        sheet.paste(img, ((i % columns) * w, (i // columns) * h))
+    return sheet
@@ -0,0 +1,308 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from matsemanns_streetview_tools import tracer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore
+
+
+@dataclass
+class _Usage:
+    wall: float
+    cpu: float
+    child_cpu: float
+    peak_rss: int
+    peak_child_rss: int
+
+
+def _usage() -> _Usage:
+    if resource is None:
+        return _Usage(time.perf_counter(), time.process_time(), 0.0, 0, 0)
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    # Only includes subprocesses (ffmpeg, exiftool) that have finished
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # maxrss is in KiB on linux, but bytes on mac
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+    return _Usage(
+        wall=time.perf_counter(),
+        cpu=own.ru_utime + own.ru_stime,
+        child_cpu=children.ru_utime + children.ru_stime,
+        peak_rss=own.ru_maxrss * rss_unit,
+        peak_child_rss=children.ru_maxrss * rss_unit,
+    )
+
+
+@dataclass
+class StageMetrics:
+    """What a stage (or all of a file) used. The cpu times are for the whole
+    process, so they can't be split between stages running at the same time. A
+    stage that overlapped another one has no cpu times, utilization or bound.
+    Peak rss is the highest seen by the end of the stage, for this process and
+    for the largest subprocess."""
+
+    invocations: int = 0
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    child_cpu_seconds: float = 0.0
+    peak_rss_bytes: int = 0
+    peak_child_rss_bytes: int = 0
+    frames: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    # Ran at the same time as another stage, at least once
+    overlapped: bool = False
+
+    def count(self, frames: int = 0, bytes_read: int = 0, bytes_written: int = 0):
+        self.frames += frames
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+        for counter, amount in [
+            ("frames", frames),
+            ("bytes_read", bytes_read),
+            ("bytes_written", bytes_written),
+        ]:
+            if amount:
+                tracer.count(counter, amount)
+
+    def add(self, other: "StageMetrics") -> None:
+        self.invocations += other.invocations
+        self.wall_seconds += other.wall_seconds
+        self.cpu_seconds += other.cpu_seconds
+        self.child_cpu_seconds += other.child_cpu_seconds
+        self.peak_rss_bytes = max(self.peak_rss_bytes, other.peak_rss_bytes)
+        self.peak_child_rss_bytes = max(
+            self.peak_child_rss_bytes, other.peak_child_rss_bytes
+        )
+        self.frames += other.frames
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        self.overlapped = self.overlapped or other.overlapped
+
+    def _per_second(self, amount: float) -> float:
+        return amount / self.wall_seconds if self.wall_seconds else 0.0
+
+    @property
+    def frames_per_second(self) -> float:
+        return self._per_second(self.frames)
+
+    @property
+    def read_mb_per_second(self) -> float:
+        return self._per_second(self.bytes_read / 1e6)
+
+    @property
+    def write_mb_per_second(self) -> float:
+        return self._per_second(self.bytes_written / 1e6)
+
+    @property
+    def cpu_utilization(self) -> float | None:
+        """Cores used by python, 1.0 is one core fully busy"""
+        if self.overlapped:
+            return None
+        return self._per_second(self.cpu_seconds)
+
+    @property
+    def child_cpu_utilization(self) -> float | None:
+        """Cores used by ffmpeg/exiftool"""
+        if self.overlapped:
+            return None
+        return self._per_second(self.child_cpu_seconds)
+
+    @property
+    def bound(self) -> str | None:
+        """A rough guess of what limits the stage: "subprocess" (ffmpeg decoding or
+        encoding), "python", or "io" when neither keeps a core busy"""
+        if self.cpu_utilization is None or self.child_cpu_utilization is None:
+            return None
+        if max(self.cpu_utilization, self.child_cpu_utilization) < 0.5:
+            return "io"
+        if self.child_cpu_utilization > self.cpu_utilization:
+            return "subprocess"
+        return "python"
+
+    def to_dict(self) -> dict:
+        values = asdict(self) | {
+            "frames_per_second": self.frames_per_second,
+            "read_mb_per_second": self.read_mb_per_second,
+            "write_mb_per_second": self.write_mb_per_second,
+            "cpu_utilization": self.cpu_utilization,
+            "child_cpu_utilization": self.child_cpu_utilization,
+            "bound": self.bound,
+        }
+        if self.overlapped:
+            values["cpu_seconds"] = values["child_cpu_seconds"] = None
+        return values
+
+
+class RunReport:
+    """Metrics for each file and each stage of a pipeline run, to see if it's
+    limited by ffmpeg, disk or python. Stages are also traced by the tracer.
+    Stages of the current file can run at the same time, on several threads.
+
+    with report.file(video.name):
+        with report.stage("extract frames") as stage:
+            ...
+            stage.count(frames=len(frames), bytes_read=size)
+    """
+
+    def __init__(self):
+        self.files: dict[str, dict[str, StageMetrics]] = {}
+        self._file: str | None = None
+        self._file_metrics: StageMetrics | None = None
+        self._started = _usage()
+        self._lock = threading.Lock()
+        # By id, as the metrics of two stages can be equal
+        self._running: dict[int, StageMetrics] = {}
+
+    def clear(self) -> None:
+        with self._lock:
+            self.files.clear()
+            self._file, self._file_metrics = None, None
+            self._running.clear()
+        self._started = _usage()
+
+    def _start_stage(self, metrics: StageMetrics) -> None:
+        with self._lock:
+            if self._running:
+                metrics.overlapped = True
+                for running in self._running.values():
+                    running.overlapped = True
+            self._running[id(metrics)] = metrics
+
+    @contextmanager
+    def _measure(
+        self, stages: dict[str, StageMetrics], name: str, is_stage: bool = True
+    ):
+        metrics = StageMetrics(invocations=1)
+        if is_stage:
+            self._start_stage(metrics)
+        start = _usage()
+        try:
+            with tracer.trace(name):
+                yield metrics
+        finally:
+            end = _usage()
+            metrics.wall_seconds = end.wall - start.wall
+            metrics.cpu_seconds = end.cpu - start.cpu
+            metrics.child_cpu_seconds = end.child_cpu - start.child_cpu
+            metrics.peak_rss_bytes = end.peak_rss
+            metrics.peak_child_rss_bytes = end.peak_child_rss
+            with self._lock:
+                self._running.pop(id(metrics), None)
+                stages.setdefault(name, StageMetrics()).add(metrics)
+
+    @contextmanager
+    def file(self, name: str):
+        with self._lock:
+            stages = self.files.setdefault(name, {})
+        # All of the file is measured, whatever its stages run alongside
+        with self._measure(stages, "file", is_stage=False) as metrics:
+            self._file, self._file_metrics = name, metrics
+            try:
+                yield metrics
+            finally:
+                self._file, self._file_metrics = None, None
+
+    @contextmanager
+    def stage(self, name: str):
+        with self._lock:
+            stages = self.files.setdefault(self._file or "", {})
+        with self._measure(stages, name) as metrics:
+            yield metrics
+        # All the bytes are counted for the file as well, but the stages work on the
+        # same frames, so that's the most any stage handled
+        file_metrics = self._file_metrics
+        if file_metrics is None:
+            return
+        with self._lock:
+            file_metrics.frames = max(file_metrics.frames, metrics.frames)
+            file_metrics.bytes_read += metrics.bytes_read
+            file_metrics.bytes_written += metrics.bytes_written
+
+    def stage_totals(self) -> dict[str, StageMetrics]:
+        totals: dict[str, StageMetrics] = {}
+        with self._lock:
+            for stages in self.files.values():
+                for name, metrics in stages.items():
+                    totals.setdefault(name, StageMetrics()).add(metrics)
+        return totals
+
+    def to_dict(self) -> dict:
+        end = _usage()
+        return {
+            "wall_seconds": end.wall - self._started.wall,
+            "cpu_seconds": end.cpu - self._started.cpu,
+            "child_cpu_seconds": end.child_cpu - self._started.child_cpu,
+            "peak_rss_bytes": end.peak_rss,
+            "peak_child_rss_bytes": end.peak_child_rss,
+            "stages": {
+                name: metrics.to_dict() for name, metrics in self.stage_totals().items()
+            },
+            "files": self._files_dict(),
+        }
+
+    def _files_dict(self) -> dict:
+        with self._lock:
+            return {
+                file: {name: metrics.to_dict() for name, metrics in stages.items()}
+                for file, stages in self.files.items()
+            }
+
+    def write(self, file: Path) -> None:
+        file.write_text(json.dumps(self.to_dict(), indent=2))
+
+    def out(self) -> str:
+        lines = [
+            f"{'stage'.ljust(20)} {'seconds':>8} {'frames/s':>9} {'read MB/s':>10}"
+            f" {'write MB/s':>11} {'cpu':>5} {'ffmpeg':>7}  bound"
+        ]
+        totals = self.stage_totals()
+        for name, m in totals.items():
+            lines.append(
+                f"{name.ljust(20)} {m.wall_seconds:>8.2f} {m.frames_per_second:>9.2f}"
+                f" {m.read_mb_per_second:>10.1f} {m.write_mb_per_second:>11.1f}"
+                f" {_utilization(m.cpu_utilization):>5} "
+                f"{_utilization(m.child_cpu_utilization):>7}  {m.bound or '-'}"
+            )
+        if any(m.overlapped for m in totals.values()):
+            lines.append("(- is a stage that ran alongside others, its cpu is unknown)")
+        return "Stages:\n" + "\n".join(lines)
+
+
+def _utilization(value: float | None) -> str:
+    return "-" if value is None else f"{value:.2f}"
+
+
+_report = RunReport()
+
+
+def clear():
+    _report.clear()
+
+
+def file(name: str):
+    return _report.file(name)
+
+
+def stage(name: str):
+    return _report.stage(name)
+
+
+def to_dict() -> dict:
+    return _report.to_dict()
+
+
+def write(file: Path):
+    _report.write(file)
+
+
+def out() -> str:
+    return _report.out()
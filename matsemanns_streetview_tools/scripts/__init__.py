@@ -1,17 +1,39 @@
+import importlib
+
 import click
 
-from .google import google
-from .image import image
-from .pipeline import pipeline
-from .video_from_folder import video_from_folder
 
+class LazyGroup(click.Group):
+    """A group where each command is only imported when it's used, so starting
+    the cli for one command doesn't pay for importing the dependencies of all the
+    others (google auth, requests, PIL, numpy, ...).
 
-@click.group()
-def cli():
-    pass
+    lazy_commands maps the command name to "module:attribute" of the command."""
+
+    def __init__(self, *args, lazy_commands: dict[str, str] | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
 
+    def list_commands(self, ctx: click.Context) -> list[str]:
+        return sorted([*super().list_commands(ctx), *self.lazy_commands])
 
-cli.add_command(image)
-cli.add_command(pipeline)
-cli.add_command(video_from_folder)
-cli.add_command(google)
+    def get_command(self, ctx: click.Context, cmd_name: str) -> click.Command | None:
+        if cmd_name in self.lazy_commands:
+            module_name, attribute = self.lazy_commands[cmd_name].split(":")
+            module = importlib.import_module(module_name)
+            return getattr(module, attribute)
+        return super().get_command(ctx, cmd_name)
+
+
+@click.group(
+    cls=LazyGroup,
+    lazy_commands={
+        "google": f"{__name__}.google:google",
+        "image": f"{__name__}.image:image",
+        "pipeline": f"{__name__}.pipeline:pipeline",
+        "pipeline-worker": f"{__name__}.pipeline:pipeline_worker",
+        "video-from-folder": f"{__name__}.video_from_folder:video_from_folder",
+    },
+)
+def cli():
+    pass
@@ -1,12 +1,20 @@
+import sys
 from pathlib import Path
 
 import click
-from tqdm import tqdm
 
-import matsemanns_streetview_tools.google_street_view as gsv
-from matsemanns_streetview_tools import gpx
 from matsemanns_streetview_tools.util import log
 
+# google auth, requests and httpx are slow to import, so they're only
+# imported by the commands using them
+
+
+def _ints(ctx, param, value: str) -> tuple[int, ...]:
+    try:
+        return tuple(int(v) for v in value.split(","))
+    except ValueError:
+        raise click.BadParameter("should be comma separated numbers, like 2,8,16")
+
 
 @click.group()
 def google():
@@ -17,6 +25,8 @@ def google():
 @google.command()
 def auth():
     """Authorize this app to contact google street view services on your behalf"""
+    import matsemanns_streetview_tools.google_street_view as gsv
+
     gsv.authorize()
 
 
@@ -32,34 +42,166 @@ def auth():
     default=16,
     help="How much to upload in one request, in MiB, as a multiple of 2.",
 )
-def upload(input_files, chunk_size):
+@click.option(
+    "--max-chunk-size",
+    type=int,
+    default=64,
+    show_default=True,
+    help="Let the chunk size grow up to this on fast connections, in MiB, "
+    "as a multiple of 2. Set it to the same as --chunk-size to always use that.",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=2,
+    show_default=True,
+    help="How many videos to upload in parallel.",
+)
+@click.option(
+    "--max-speed",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="Limit the total upload speed of all videos, in MiB/s.",
+)
+@click.option(
+    "--retries",
+    type=click.IntRange(min=0),
+    default=2,
+    show_default=True,
+    help="How many times to start a failed video over.",
+)
+@click.option(
+    "--use-async",
+    is_flag=True,
+    help="Run the uploads on asyncio, sharing one connection pool and refreshing "
+    "the token in the background.",
+)
+@click.option(
+    "--check-only",
+    is_flag=True,
+    help="Only check that the videos and gpx files are valid for uploading, exits "
+    "with 1 if any is not. Doesn't create any upload journals.",
+)
+def upload(
+    input_files,
+    chunk_size,
+    max_chunk_size,
+    concurrency,
+    max_speed,
+    retries,
+    use_async,
+    check_only,
+):
     """Upload video files, using a gpx track matching the video names.
     Can handle multiple videos or glob expansions from command line"""
 
     if chunk_size < 2 or chunk_size % 2 != 0:
         log("Chunk size must be a multiple of 2")
         return
+    if max_chunk_size < chunk_size or max_chunk_size % 2 != 0:
+        log("Max chunk size must be a multiple of 2, and at least the chunk size")
+        return
+
+    from matsemanns_streetview_tools.upload_preflight import preflight_videos
+
+    videos = [Path(file) for file in input_files]
+    if check_only:
+        if any(result.error for result in preflight_videos(videos, save=False)):
+            sys.exit(1)
+        return
 
-    failed_videos = []
-
-    for file in tqdm(input_files, desc="Files", leave=True):
-        log(f"Uploading {file}")
-        video = Path(file)
-        gpx_path = video.parent / f"{video.stem}.gpx"
-        try:
-            if not gpx_path.exists():
-                raise RuntimeError(f"Didn't find a gpx file named {gpx_path}")
-
-            gpx_track = gpx.read_gpx_file(gpx_path)
-            gsv.upload_streetview_video(
-                video,
-                gpx_track,
-                chunk_size_mib=chunk_size,
-            )
-        except Exception as err:
-            log(f"Something went wrong {err}")
-            failed_videos.append(file)
+    options = dict(
+        chunk_size_mib=chunk_size,
+        max_chunk_size_mib=max_chunk_size,
+        concurrency=concurrency,
+        max_mib_per_second=max_speed,
+        retries=retries,
+    )
+    if use_async:
+        import asyncio
+
+        import matsemanns_streetview_tools.google_street_view_async as gsva
+
+        failed_videos = asyncio.run(gsva.upload_streetview_videos(videos, **options))
+    else:
+        import matsemanns_streetview_tools.google_street_view as gsv
+
+        failed_videos = gsv.upload_streetview_videos(videos, **options)
 
     log("Done!")
     if len(failed_videos) > 0:
-        log(f"Some videos failed, {failed_videos}")
+        log(f"Some videos failed, {[str(video) for video in failed_videos]}")
+
+
+@google.command()
+@click.option("--videos", type=click.IntRange(min=1), default=4, show_default=True)
+@click.option(
+    "--video-size",
+    type=click.IntRange(min=1),
+    default=64,
+    show_default=True,
+    help="Size of each video, in MiB.",
+)
+@click.option("--chunk-sizes", default="2,8,16", callback=_ints, show_default=True)
+@click.option("--concurrencies", default="1,2,4", callback=_ints, show_default=True)
+@click.option(
+    "--max-chunk-size",
+    type=int,
+    default=None,
+    help="Let the chunk size grow up to this, in MiB. Fixed chunk sizes if not set.",
+)
+@click.option(
+    "--latency",
+    type=click.FloatRange(min=0),
+    default=0.05,
+    show_default=True,
+    help="Seconds added to every request.",
+)
+@click.option(
+    "--bandwidth",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="Total bandwidth of the server, in MiB/s.",
+)
+@click.option(
+    "--failure-rate",
+    type=click.FloatRange(min=0, max=1),
+    default=0.0,
+    show_default=True,
+    help="Chance of a chunk upload failing.",
+)
+@click.option("--seed", type=int, default=0, show_default=True)
+def benchmark(
+    videos,
+    video_size,
+    chunk_sizes,
+    concurrencies,
+    max_chunk_size,
+    latency,
+    bandwidth,
+    failure_rate,
+    seed,
+):
+    """Measure upload throughput against a local mock of the Street View api,
+    for each combination of chunk size and concurrency"""
+    if any(size < 2 or size % 2 != 0 for size in chunk_sizes):
+        log("Chunk sizes must be multiples of 2")
+        return
+
+    from matsemanns_streetview_tools.upload_benchmark import (
+        format_results,
+        run_upload_benchmark,
+    )
+
+    results = run_upload_benchmark(
+        videos=videos,
+        video_size_mib=video_size,
+        chunk_sizes_mib=chunk_sizes,
+        concurrencies=concurrencies,
+        max_chunk_size_mib=max_chunk_size,
+        latency=latency,
+        bandwidth_mib_per_second=bandwidth,
+        failure_rate=failure_rate,
+        seed=seed,
+    )
+    log("\n" + format_results(results))
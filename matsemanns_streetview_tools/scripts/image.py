@@ -1,10 +1,11 @@
-import itertools
 from pathlib import Path
 
 import click
-from PIL import Image, ImageDraw
 
-from matsemanns_streetview_tools.image import create_nadir, apply_image_pipeline
+from matsemanns_streetview_tools.util import log
+
+# The image libraries (PIL, numpy) are imported in the commands, to keep the
+# cli fast to start
 
 
 @click.group()
@@ -20,56 +21,108 @@ def image():
 @click.option("-h", "--height", type=int, default=588)
 def nadir(input_file, output_file, width, height):
     """Convert a square image to an equirectangular nadir"""
+    from matsemanns_streetview_tools.image import create_nadir
+
     create_nadir(Path(input_file), Path(output_file), width, height)
 
 
+def _values(ctx, param, value: str) -> list[float | None]:
+    try:
+        return [
+            None if v.strip().lower() in ["", "none"] else float(v)
+            for v in value.split(",")
+        ]
+    except ValueError:
+        raise click.BadParameter("should be comma separated numbers, like 1.0,1.05")
+
+
 @image.command()
 @click.argument("input_file", type=click.Path())
-def test_effects(input_file):
+@click.option(
+    "-w",
+    "--max-width",
+    type=int,
+    default=None,
+    help="Downscale the image to this width first, faster but less detailed.",
+)
+@click.option(
+    "--contrast", default="0.95,1.0,1.05", callback=_values, show_default=True
+)
+@click.option("--brightness", default="1.0,1.05", callback=_values, show_default=True)
+@click.option("--color", default="1.0,1.2", callback=_values, show_default=True)
+@click.option("--sharpness", default="none", callback=_values, show_default=True)
+@click.option(
+    "--contact-sheet",
+    type=int,
+    default=None,
+    help="Also create a contact_sheet.jpg of all the variants, this many pixels wide.",
+)
+@click.option("--workers", type=int, default=None, help="Defaults to number of cpus")
+def test_effects(
+    input_file,
+    max_width,
+    contrast,
+    brightness,
+    color,
+    sharpness,
+    contact_sheet,
+    workers,
+):
     """Apply an array of image effects on the image to see how they would look.
-    Can then later use the same parameters in the pipeline json config."""
+    Can then later use the same parameters in the pipeline json config.
+
+    The values to try are given as comma separated lists, "none" skips the effect."""
+    from matsemanns_streetview_tools.preview import (
+        open_preview_image,
+        render_effect_grid,
+    )
 
     path = Path(input_file)
     folder = path.parent / path.stem
     if not folder.exists():
         folder.mkdir()
 
-    img = Image.open(input_file)
-
-    contrasts = [0.95, 1.0, 1.05]
-    brightness = [1.0, 1.05]
-    colors = [1.0, 1.2]
-    sharpness = [None]
-
-    for con, bri, col, sharp in itertools.product(
-        contrasts, brightness, colors, sharpness
-    ):
-        img2 = apply_image_pipeline(
-            img, contrast=con, color=col, brightness=bri, sharpness=sharp
-        )
-        ImageDraw.Draw(img2).text(
-            (0, 0), f"con={con},bri={bri},col={col},sharp={sharp}", font_size=50
-        )
-        img2.save(folder / f"con{con}_bri{bri}_col{col}_sharp{sharp}.jpg", quality=95)
+    img = open_preview_image(path, max_width)
+
+    files = render_effect_grid(
+        img,
+        folder,
+        contrasts=contrast,
+        brightness=brightness,
+        colors=color,
+        sharpness=sharpness,
+        max_workers=workers,
+        contact_sheet_width=contact_sheet,
+    )
+    log(f"Saved {len(files)} images to {folder}")
 
 
 @image.command()
 @click.argument("input_file", type=click.Path(exists=True, dir_okay=False))
-def show(input_file):
+@click.option(
+    "-w",
+    "--max-width",
+    type=int,
+    default=2688,
+    help="Width of the preview, the image is downscaled to this.",
+)
+def show(input_file, max_width):
     """Launches a GUI to show the image and apply effects on it.
     Can then later use the same parameters in the pipeline json config.
 
     Uses dearpygui, if it doesn't work, use the test-effects command instead to generate examples."""
     import dearpygui.dearpygui as dpg
 
-    pil_image = Image.open(input_file)
-    pil_image.putalpha(255)
-    org_width, org_height = pil_image.size
-    pil_image = pil_image.resize(
-        (org_width // 2, org_height // 2), Image.Resampling.LANCZOS
+    from matsemanns_streetview_tools.preview import (
+        open_preview_image,
+        PreviewPipeline,
+        texture_data,
     )
+
+    pil_image = open_preview_image(Path(input_file), max_width)
+    preview = PreviewPipeline(pil_image)
     width, height = pil_image.size
-    image_data = [value / 255.0 for value in pil_image.tobytes()]
+    image_data = texture_data(pil_image)
     edited_image_data = image_data
 
     dpg.create_context()
@@ -88,13 +141,12 @@ def show(input_file):
     def cb(sender):
         nonlocal edited_image_data
         config[sender] = dpg.get_value(sender)
-        new_img = apply_image_pipeline(
-            pil_image,
+        new_img = preview.apply(
             brightness=config["brightness"],
             contrast=config["contrast"],
             color=config["color"],
         )
-        edited_image_data = [value / 255.0 for value in new_img.tobytes()]
+        edited_image_data = texture_data(new_img)
         dpg.set_value("original", False)
         dpg.set_value("image", edited_image_data)
 
@@ -1,29 +1,45 @@
 import click
 import json
+import os
 import shutil
+import socket
+import time
 import traceback
-from dataclasses import dataclass
-from datetime import timedelta
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
 from decimal import Decimal
 from pathlib import Path
+from typing import Callable
 
+import numpy as np
 from PIL import Image
 from tqdm import tqdm
 
-from matsemanns_streetview_tools import gpx, metadata, tracer
-from matsemanns_streetview_tools.gpx import GpxTrack
+from matsemanns_streetview_tools import gpx, metadata, report, tracer
+from matsemanns_streetview_tools.exif import create_exif_bytes
+from matsemanns_streetview_tools.frame_cache import FrameCache, cached_video_frames
+from matsemanns_streetview_tools.frame_index import FrameIndex
+from matsemanns_streetview_tools.gpx import GpxPoint, GpxTrack
 from matsemanns_streetview_tools.image import (
+    ImageWriter,
     apply_image_pipeline,
-    create_exif_data,
     create_xmp_pano_data,
+    jpeg_save_options,
+    render_nadir,
 )
-from matsemanns_streetview_tools.util import log, add_file_logger
+from matsemanns_streetview_tools.util import ERROR, log, add_file_logger
 from matsemanns_streetview_tools.video import (
+    FrameRounding,
+    VideoEncoder,
     calculate_frames_to_keep,
     save_video_frames,
+    stream_video_frames,
     join_images_to_video,
     inject_spatial_data,
 )
+from matsemanns_streetview_tools.stage_graph import Stage, StageGraph
+from matsemanns_streetview_tools.work_queue import Task, WorkQueue, work
 
 
 @dataclass
@@ -43,6 +59,20 @@ class PipelineConfig:
     brightness: float | None = None
     sharpness: float | None = None
     nadir: str | None = None
+    nadir_logo: str | None = None
+    nadir_height: int | None = None
+    jpeg_quality: int | None = None
+    jpeg_subsampling: str | None = None
+    jpeg_optimize: bool | None = None
+    jpeg_progressive: bool | None = None
+    streaming: bool | None = None
+    frame_rounding: FrameRounding | None = None
+    variable_framerate: bool | None = None
+    frame_cache_gb: float | None = None
+    frame_cache_folder: str | None = None
+    work_queue: str | None = None
+    outputs: list[str] | None = None
+    image_writers: int | None = None
 
 
 @click.command()
@@ -62,48 +92,207 @@ def pipeline(json_file):
     run_pipeline(project_path, config)
 
 
-def run_pipeline(project_folder: Path, config: PipelineConfig):
-    gpx_track = gpx.read_gpx_file(project_folder / config.gpx_file)
-    output_folder = project_folder / config.output_folder
-    nadir = Image.open(project_folder / config.nadir) if config.nadir else None
+@click.command("pipeline-worker")
+@click.argument("queue_folder", type=click.Path(file_okay=False))
+@click.option(
+    "--poll-seconds",
+    default=5.0,
+    show_default=True,
+    help="How often to look for new files to work on",
+)
+def pipeline_worker(queue_folder, poll_seconds):
+    """
+    Work on the files of a pipeline started with work_queue, on another machine.
+    QUEUE_FOLDER: Path to the work_queue folder, on a disk shared with the others
+    """
+    run_pipeline_worker(Path(queue_folder), poll_seconds)
+
+
+@dataclass
+class _PipelineRun:
+    """What all the files of a run share"""
+
+    project_folder: Path
+    config: PipelineConfig
+    gpx_track: GpxTrack
+    output_folder: Path
+    nadir: Image.Image | None
+    nadir_logo: Image.Image | None
+    frame_cache: FrameCache | None
+    # Shared by the files, to reuse the memoized stages
+    stages: StageGraph
+
+    @classmethod
+    def prepare(
+        cls, project_folder: Path, config: PipelineConfig, log_file: str
+    ) -> "_PipelineRun":
+        # Fail before processing anything
+        _outputs(config)
+        if config.nadir and config.nadir_logo:
+            raise RuntimeError("Set either nadir or nadir_logo, not both")
+        gpx_track = gpx.read_gpx_file(project_folder / config.gpx_file)
+        output_folder = project_folder / config.output_folder
+        nadir = Image.open(project_folder / config.nadir) if config.nadir else None
+        nadir_logo = (
+            Image.open(project_folder / config.nadir_logo)
+            if config.nadir_logo
+            else None
+        )
+
+        if not output_folder.exists():
+            output_folder.mkdir(parents=True)
+
+        add_file_logger(output_folder / log_file)
+
+        frame_cache = None
+        if config.frame_cache_gb:
+            frame_cache = FrameCache(
+                project_folder / (config.frame_cache_folder or "frame_cache"),
+                max_bytes=int(config.frame_cache_gb * 1024**3),
+            )
+
+        return cls(
+            project_folder,
+            config,
+            gpx_track,
+            output_folder,
+            nadir,
+            nadir_logo,
+            frame_cache,
+            pipeline_stages(),
+        )
+
+    def video_files(self) -> list[Path]:
+        video_files = []
+        for file_or_glob in self.config.video_files:
+            video_files.extend(list(self.project_folder.glob(file_or_glob)))
+
+        # Sort gopro videos by how they're created
+        video_files.sort(key=lambda file: (file.stem[4:], file.stem))
+        return video_files
 
-    if not output_folder.exists():
-        output_folder.mkdir(parents=True)
+    def run_file(
+        self, video_file: Path, cancelled: Callable[[], bool] | None = None
+    ) -> str | None:
+        """Returns the error if it failed"""
+        config = self.config
+        try:
+            original_file = self.project_folder / config.original_files_folder / (video_file.stem + ".360")  # fmt: skip
+            with report.file(video_file.name):
+                run_pipeline_on_file(
+                    video_file,
+                    original_file,
+                    self.gpx_track,
+                    self.output_folder,
+                    config,
+                    self.nadir,
+                    self.nadir_logo,
+                    self.frame_cache,
+                    self.stages,
+                    cancelled,
+                )
+        except Exception as e:
+            log(f"File {video_file} FAILED due to {e}\n{traceback.format_exc()}", ERROR)
+            return str(e) or type(e).__name__
+        return None
+
+    def handle_task(self, task: Task) -> dict:
+        # Stops between stages if another worker got the file
+        error = self.run_file(
+            self.project_folder / task.data["video_file"], task.lease_lost.is_set
+        )
+        return {"error": error} if error else {}
+
+    def finish(self, name: str = "") -> None:
+        frame_cache = self.frame_cache
+        if frame_cache:
+            log(f"Frame cache: {frame_cache.hits} hits, {frame_cache.misses} misses, {frame_cache.size / 1024**3:.1f} GB used")  # fmt: skip
+        log(tracer.out())
+        log(report.out())
+        tracer.write_chrome_trace(self.output_folder / f"trace{name}.json")
+        report.write(self.output_folder / f"report{name}.json")
 
-    add_file_logger(output_folder / "log.txt")
 
-    video_files = []
-    for file_or_glob in config.video_files:
-        video_files.extend(list(project_folder.glob(file_or_glob)))
+def _worker_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
 
-    # Sort gopro videos by how they're created
-    video_files.sort(key=lambda file: (file.stem[4:], file.stem))
+
+def run_pipeline(project_folder: Path, config: PipelineConfig):
+    run = _PipelineRun.prepare(project_folder, config, "log.txt")
+    video_files = run.video_files()
 
     log("========================================================")
     log("========================================================")
     log("Starting pipeline")
     log(f"{len(video_files)} files found")
     log(str(video_files))
-    log(f"Will save to {output_folder.resolve()}")
+    log(f"Will save to {run.output_folder.resolve()}")
     log(f"Config: {config}")
 
-    failed_videos = []
-
-    for video_file in tqdm(video_files, desc="Files"):
-        try:
-            original_file = project_folder / config.original_files_folder / (video_file.stem + ".360")  # fmt: skip
-            run_pipeline_on_file(
-                video_file, original_file, gpx_track, output_folder, config, nadir
-            )
-        except Exception as e:
-            failed_videos.append(video_file)
-            log(f"ERROR: File {video_file} FAILED due to {e}\n{traceback.format_exc()}")
+    if config.work_queue:
+        failed_videos = _run_on_work_queue(run, video_files)
+    else:
+        failed_videos = [
+            video_file
+            for video_file in tqdm(video_files, desc="Files")
+            if run.run_file(video_file)
+        ]
 
-    log(tracer.out())
+    run.finish()
     log(f"Failed videos ({len(failed_videos)}): {failed_videos}")
     log("ALL DONE!")
 
 
+def _run_on_work_queue(run: _PipelineRun, video_files: list[Path]) -> list[Path]:
+    """Publishes the files as tasks that workers on other machines can take, works
+    on them here as well, and waits for all to be done. The paths are relative,
+    so the shared disk can be mounted at different places on the machines."""
+    assert run.config.work_queue
+    queue_folder = run.project_folder / run.config.work_queue
+    queue = WorkQueue.create(
+        queue_folder,
+        settings={
+            "project_folder": os.path.relpath(run.project_folder, queue_folder),
+            "config": asdict(run.config),
+        },
+    )
+    for i, video_file in enumerate(video_files):
+        relative_file = video_file.relative_to(run.project_folder).as_posix()
+        queue.publish(f"{i:05}_{video_file.stem}", {"video_file": relative_file})
+    log(f"Published {len(video_files)} files, start more workers with: pipeline-worker {queue_folder.resolve()}")  # fmt: skip
+
+    work(queue, run.handle_task, _worker_name(), until=queue.all_done)
+    queue.finish()
+
+    failed_videos = []
+    for result in queue.results():
+        video_file = run.project_folder / result["data"]["video_file"]
+        log(f"{video_file.name} was done by {result.get('worker')}{' and FAILED' if result.get('error') else ''}")  # fmt: skip
+        if result.get("error"):
+            failed_videos.append(video_file)
+    return failed_videos
+
+
+def run_pipeline_worker(queue_folder: Path, poll_seconds: float = 5.0):
+    worker = _worker_name()
+    while not WorkQueue.exists(queue_folder):
+        log(f"No pipeline in {queue_folder} yet, waiting")
+        time.sleep(poll_seconds)
+
+    queue = WorkQueue(queue_folder)
+    project_folder = (queue_folder / queue.settings["project_folder"]).resolve()
+    config = PipelineConfig(**queue.settings["config"])
+    # Each worker logs to its own files, appending to the same over a network
+    # share would mix up the lines
+    run = _PipelineRun.prepare(project_folder, config, f"log_{worker}.txt")
+    log(f"Worker {worker} starting on {project_folder}")
+
+    handled = work(queue, run.handle_task, worker, poll_seconds)
+
+    run.finish(f"_{worker}")
+    log(f"Worker {worker} done, did {handled} files")
+
+
 def run_pipeline_on_file(
     video_file: Path,
     original_file: Path,
@@ -111,17 +300,111 @@ def run_pipeline_on_file(
     output_folder: Path,
     config: PipelineConfig,
     nadir: Image.Image | None,
+    nadir_logo: Image.Image | None = None,
+    frame_cache: FrameCache | None = None,
+    stages: StageGraph | None = None,
+    cancelled: Callable[[], bool] | None = None,
 ):
     log("====================================")
     log(f"Working on file {video_file.name}")
 
-    with tracer.trace("exiftoolmeta"):
+    (stages or pipeline_stages()).run(
+        cancelled,
+        video_file=video_file,
+        original_file=original_file,
+        gpx_track=gpx_track,
+        output_folder=output_folder,
+        config=config,
+        nadir=nadir,
+        nadir_logo=nadir_logo,
+        frame_cache=frame_cache,
+    )
+
+
+def pipeline_stages() -> StageGraph:
+    """The stages of the pipeline for a file, and what they depend on. Stages
+    not depending on each other run at the same time, like reading the metadata
+    with both exiftool and ffprobe, or writing the gpx while extracting frames."""
+    # fmt: off
+    return StageGraph([
+        Stage("exiftoolmeta", _read_exiftool_metadata, ["original_file"], "original_metadata"),
+        Stage("ffprobe", _read_ffprobe_metadata, ["video_file"], "equi_metadata"),
+        Stage("create nadir", _create_nadir, ["config", "nadir", "nadir_logo", "equi_metadata"], "frame_nadir", memoize=_nadir_key),
+        Stage("video times", _video_times, ["config", "original_metadata", "equi_metadata"], "times"),
+        Stage("gpx", _space_gpx, ["config", "gpx_track", "times"], "spaced_gpx"),
+        Stage("video gpx", _write_video_gpx, ["config", "video_file", "output_folder", "spaced_gpx", "times"], "gpx_out_file"),
+        Stage("frame index", _load_frame_index, ["config", "video_file", "equi_metadata"], "frame_times_us"),
+        Stage("frames", _frames_to_keep, ["config", "spaced_gpx", "times", "equi_metadata", "frame_times_us"], "frames"),
+        Stage("process frames", _process_frames, ["config", "video_file", "output_folder", "frames", "spaced_gpx", "equi_metadata", "times", "frame_nadir", "frame_cache"], "processed"),
+        Stage("inject spatial", _inject_spatial, ["config", "video_file", "output_folder", "processed"], "final_video"),
+        Stage("done", _log_done, ["processed", "gpx_out_file", "final_video"], "done"),
+    ])
+    # fmt: on
+
+
+@dataclass
+class _VideoTimes:
+    video_start: datetime
+    video_end: datetime
+    first_frame: datetime
+    duration: timedelta
+    # Of the new video, where the frames are a second apart
+    final_creation_time: datetime
+
+
+@dataclass
+class _ProcessedFrames:
+    tmp_video: Path | None
+    save_image_folder: Path | None
+
+
+def _project_final_name(video_file: Path, config: PipelineConfig) -> str:
+    return f"{video_file.stem}{"_" if config.project_name else ""}{config.project_name}"
+
+
+def _read_exiftool_metadata(original_file: Path) -> metadata.ExiftoolMetadata:
+    with report.stage("exiftoolmeta"):
         log(f"Finding metadata of 360 file {original_file}")
-        original_metadata = metadata.get_exiftool_metadata(original_file)
-    with tracer.trace("ffprobe"):
+        return metadata.get_exiftool_metadata(original_file)
+
+
+def _read_ffprobe_metadata(video_file: Path) -> metadata.FfprobeMetadata:
+    with report.stage("ffprobe"):
         log(f"Finding metadata of equirectangular file {video_file}")
-        equi_metadata = metadata.get_ffprobe_metadata(video_file)
+        return metadata.get_ffprobe_metadata(video_file)
+
 
+def _nadir_key(config, nadir, nadir_logo, equi_metadata) -> tuple:
+    # The same for all videos of the same size
+    return (
+        id(nadir),
+        id(nadir_logo),
+        config.nadir_height,
+        equi_metadata.get_video_size(),
+    )
+
+
+def _create_nadir(
+    config: PipelineConfig,
+    nadir: Image.Image | None,
+    nadir_logo: Image.Image | None,
+    equi_metadata: metadata.FfprobeMetadata,
+) -> Image.Image | None:
+    if not nadir_logo:
+        return nadir
+    w, h = equi_metadata.get_video_size()
+    # Same ratio as the default 588 pixels for 5376x2688
+    nadir_height = config.nadir_height or round(h * 588 / 2688)
+    log(f"Creating {w}x{nadir_height} nadir from logo")
+    with report.stage("create nadir"):
+        return render_nadir(nadir_logo, w, nadir_height)
+
+
+def _video_times(
+    config: PipelineConfig,
+    original_metadata: metadata.ExiftoolMetadata,
+    equi_metadata: metadata.FfprobeMetadata,
+) -> _VideoTimes:
     log("Calculating times to use in the video")
 
     # Find the start time of the video, but shift it if needed to
@@ -144,75 +427,267 @@ def run_pipeline_on_file(
     log(f"Video gpx starts at {video_original_start}, shifted to {video_start} and ends at {video_end}, duration {equi_metadata.get_duration()}")  # fmt: skip
     log(f"First frame will be at {first_frame}, last at {last_frame} for a duration of {duration}")  # fmt: skip
 
+    return _VideoTimes(
+        video_start,
+        video_end,
+        first_frame,
+        duration,
+        final_creation_time=first_frame.replace(microsecond=0),
+    )
+
+
+def _space_gpx(
+    config: PipelineConfig, gpx_track: GpxTrack, times: _VideoTimes
+) -> GpxTrack:
     log("Creating the gpx tracks")
-    cropped_gpx = gpx.crop_with_interpolation(gpx_track, first_frame, duration)
+    cropped_gpx = gpx.crop_with_interpolation(
+        gpx_track, times.first_frame, times.duration
+    )
     spaced_gpx = gpx.space_out_points(
         cropped_gpx, spacing_distance_m=Decimal(config.frame_distance_meters)
     )
 
     log(f"Gpx for video had {len(cropped_gpx.points)} points, after spacing out every {config.frame_distance_meters}m it's {len(spaced_gpx.points)} points")  # fmt: skip
+    return spaced_gpx
+
 
+def _write_video_gpx(
+    config: PipelineConfig,
+    video_file: Path,
+    output_folder: Path,
+    spaced_gpx: GpxTrack,
+    times: _VideoTimes,
+) -> Path | None:
+    if "video" not in _outputs(config):
+        return None
     # Space each point out 1 second to match the finished video
-    project_final_name = (
-        f"{video_file.stem}{"_" if config.project_name else ""}{config.project_name}"
-    )
-    video_final_creation_time = first_frame.replace(microsecond=0)
     video_gpx = gpx.adjust_time(
-        spaced_gpx, start_time=video_final_creation_time, delta=timedelta(seconds=1)
+        spaced_gpx, start_time=times.final_creation_time, delta=timedelta(seconds=1)
     )
-    gpx_out_file = output_folder / f"{project_final_name}.gpx"
+    gpx_out_file = output_folder / f"{_project_final_name(video_file, config)}.gpx"
     log(f"Writing gpx file to be used with video to {gpx_out_file}")
     gpx_out_file.write_text(gpx.gpx_track_to_xml(video_gpx))
+    return gpx_out_file
 
+
+def _load_frame_index(
+    config: PipelineConfig, video_file: Path, equi_metadata: metadata.FfprobeMetadata
+) -> np.ndarray | None:
+    if not config.variable_framerate:
+        return None
+    with report.stage("frame index"):
+        frame_index = FrameIndex.load(video_file)
+    drift = frame_index.max_drift(equi_metadata.get_framerate())
+    log(f"Frame index has {len(frame_index)} frames, drifting up to {drift:.3f}s from the average fps")  # fmt: skip
+    return frame_index.times_us
+
+
+def _frames_to_keep(
+    config: PipelineConfig,
+    spaced_gpx: GpxTrack,
+    times: _VideoTimes,
+    equi_metadata: metadata.FfprobeMetadata,
+    frame_times_us: np.ndarray | None,
+) -> list[int]:
     log("Calculating frames to keep")
-    frames = calculate_frames_to_keep(
-        spaced_gpx, video_start, video_end, equi_metadata.get_framerate()
+    return calculate_frames_to_keep(
+        spaced_gpx,
+        times.video_start,
+        times.video_end,
+        equi_metadata.get_framerate(),
+        frame_times_us,
+        config.frame_rounding or "next",
+    )
+
+
+def _process_frames(
+    config: PipelineConfig,
+    video_file: Path,
+    output_folder: Path,
+    frames: list[int],
+    spaced_gpx: GpxTrack,
+    equi_metadata: metadata.FfprobeMetadata,
+    times: _VideoTimes,
+    frame_nadir: Image.Image | None,
+    frame_cache: FrameCache | None,
+) -> _ProcessedFrames:
+    outputs = _outputs(config)
+    save_image_folder = None
+    if "images" in outputs:
+        save_image_folder = output_folder / f"{video_file.stem}"
+        if not save_image_folder.exists():
+            save_image_folder.mkdir()
+    tmp_video = None
+    if "video" in outputs:
+        tmp_video = output_folder / f"{video_file.stem}_tmp.mp4"
+
+    # Extracting the frames to jpgs and joining the processed ones is only needed
+    # when both are wanted, and then only if not streaming (which the cache needs)
+    if tmp_video and save_image_folder and not (config.streaming or frame_cache):
+        _process_frames_on_disk(
+            video_file,
+            frames,
+            spaced_gpx,
+            output_folder,
+            tmp_video,
+            save_image_folder,
+            times.final_creation_time,
+            config,
+            frame_nadir,
+        )
+    else:
+        log(f"Found {len(frames)} frames, streaming them from the video")
+        _stream_frames(
+            video_file,
+            frames,
+            spaced_gpx,
+            equi_metadata.get_video_size(),
+            tmp_video,
+            save_image_folder,
+            times.final_creation_time,
+            config,
+            frame_nadir,
+            frame_cache,
+        )
+    return _ProcessedFrames(tmp_video, save_image_folder)
+
+
+def _inject_spatial(
+    config: PipelineConfig,
+    video_file: Path,
+    output_folder: Path,
+    processed: _ProcessedFrames,
+) -> Path | None:
+    tmp_video = processed.tmp_video
+    if not tmp_video:
+        return None
+    log("Injecting 360 metadata into final video")
+    final_video = output_folder / f"{_project_final_name(video_file, config)}.mp4"
+    with report.stage("inject spatial") as stage:
+        inject_spatial_data(tmp_video, final_video)
+        stage.count(
+            bytes_read=tmp_video.stat().st_size,
+            bytes_written=final_video.stat().st_size,
+        )
+
+    if not config.keep_debug_files:
+        log("Cleaning up")
+        tmp_video.unlink(missing_ok=True)
+    return final_video
+
+
+def _log_done(
+    processed: _ProcessedFrames, gpx_out_file: Path | None, final_video: Path | None
+) -> None:
+    done = []
+    if final_video:
+        done.append(f"Video at {final_video}, gpx file at {gpx_out_file}")
+    if processed.save_image_folder:
+        done.append(f"Images at {processed.save_image_folder}")
+
+    log(f"Done! {'. '.join(done)}")
+
+
+def _outputs(config: PipelineConfig) -> set[str]:
+    """What to create, the video for Street View and/or the images for Mapillary"""
+    outputs = set(config.outputs or ["video", "images"])
+    unknown = outputs - {"video", "images"}
+    if unknown:
+        raise RuntimeError(f"Unknown outputs {unknown}, can be 'video' and 'images'")
+    return outputs
+
+
+def _process_image(
+    image: Image.Image, config: PipelineConfig, nadir: Image.Image | None
+) -> Image.Image:
+    return apply_image_pipeline(
+        image,
+        nadir,
+        color=config.color,
+        contrast=config.contrast,
+        brightness=config.brightness,
+        sharpness=config.sharpness,
+    )
+
+
+def _save_image(
+    writer: ImageWriter,
+    image: Image.Image,
+    gpx_point: GpxPoint,
+    image_out: Path,
+    config: PipelineConfig,
+) -> None:
+    save_options = jpeg_save_options(
+        quality=config.jpeg_quality or 95,
+        subsampling=config.jpeg_subsampling,
+        optimize=config.jpeg_optimize,
+        progressive=config.jpeg_progressive,
     )
+    exif = create_exif_bytes(gpx_point)
+    xmp_data = create_xmp_pano_data(image)
+    writer.save(image, image_out, exif=exif, xmp=xmp_data, **save_options)
+
 
+def _process_frames_on_disk(
+    video_file: Path,
+    frames: list[int],
+    spaced_gpx: GpxTrack,
+    output_folder: Path,
+    tmp_video: Path,
+    save_image_folder: Path,
+    video_final_creation_time: datetime,
+    config: PipelineConfig,
+    nadir: Image.Image | None,
+):
+    """Extracts all the frames to jpgs, applies the image pipeline on them and
+    joins them to a video. Needs room for all the frames twice, and the video.
+    The extracted frames are deleted as soon as they're processed."""
     extract_folder = output_folder / f"{video_file.stem}_extracted"
     log(f"Found {len(frames)} frames to extract, extracting into {extract_folder}")
-    with tracer.trace("extract frames"):
-        save_video_frames(
+    with report.stage("extract frames") as stage:
+        saved_frames = save_video_frames(
             video_file, extract_folder, frames, cleanup=not config.keep_debug_files
         )
+        stage.count(
+            frames=len(frames),
+            bytes_read=video_file.stat().st_size,
+            bytes_written=sum(f.stat().st_size for f in extract_folder.glob("*.jpg")),
+        )
 
     log("Adding effects and nadir to extracted images")
-    saved_frames = [
-        extract_folder / f"{video_file.stem}-{i:06}.jpg"
-        for i, f in enumerate(frames, start=1)
-    ]
-    save_image_folder = output_folder / f"{video_file.stem}"
-    if not save_image_folder.exists():
-        save_image_folder.mkdir()
-
     new_images = []
-
-    for image_path, gpx_point in tqdm(
-        zip(saved_frames, spaced_gpx.points),
-        desc="Applying image pipeline",
-        total=len(saved_frames),
-        leave=True,
+    with (
+        report.stage("image pipeline") as stage,
+        ImageWriter(config.image_writers or 2) as writer,
     ):
-        with tracer.trace("image pipeline"):
-            image = Image.open(image_path)
-            updated_image = apply_image_pipeline(
-                image,
-                nadir,
-                color=config.color,
-                contrast=config.contrast,
-                brightness=config.brightness,
-                sharpness=config.sharpness,
+        for i, (image_path, gpx_point) in enumerate(
+            tqdm(
+                zip(saved_frames, spaced_gpx.points),
+                desc="Applying image pipeline",
+                total=len(saved_frames),
+                leave=True,
             )
-            exif = create_exif_data(updated_image, gpx_point)
-            xmp_data = create_xmp_pano_data(updated_image)
-            image_out = save_image_folder / image_path.name
+        ):
+            with tracer.trace("image"):
+                # Read fully and closed, as the file is deleted while the image can
+                # still be waiting for the writer (and Windows can't delete open files)
+                with Image.open(image_path) as image:
+                    image.load()
+                updated_image = _process_image(image, config, nadir)
+            # Named by the point, points sharing a frame get an image each
+            image_out = save_image_folder / f"{video_file.stem}-{i + 1:06}.jpg"
             new_images.append(image_out)
-            updated_image.save(image_out, quality=95, exif=exif, xmp=xmp_data)
+            # Saved on the writer pool while the next image is processed
+            _save_image(writer, updated_image, gpx_point, image_out, config)
+            stage.count(frames=1, bytes_read=image_path.stat().st_size)
+            last_use = i + 1 == len(saved_frames) or saved_frames[i + 1] != image_path
+            if last_use and not config.keep_debug_files:
+                image_path.unlink()
+        writer.close()
+        stage.count(bytes_written=writer.bytes_written)
 
-    tmp_video = output_folder / f"{video_file.stem}_tmp.mp4"
     log(f"Joining images back to video, into {tmp_video}")
-
-    with tracer.trace("joining images"):
+    with report.stage("joining images") as stage:
         join_images_to_video(
             new_images,
             tmp_video,
@@ -220,17 +695,64 @@ def run_pipeline_on_file(
             framerate=1,
             cleanup=not config.keep_debug_files,
         )
-
-    log("Injecting 360 metadata into final video")
-    final_video = output_folder / f"{project_final_name}.mp4"
-    with tracer.trace("inject spatial"):
-        inject_spatial_data(tmp_video, final_video)
+        stage.count(
+            frames=len(new_images),
+            bytes_read=sum(image.stat().st_size for image in new_images),
+            bytes_written=tmp_video.stat().st_size,
+        )
 
     if not config.keep_debug_files:
-        log("Cleaning up")
-        tmp_video.unlink(missing_ok=True)
         shutil.rmtree(extract_folder)
 
-    log(
-        f"Done! Video at {final_video}, gpx file at {gpx_out_file}, images at {save_image_folder}"
-    )
+
+def _stream_frames(
+    video_file: Path,
+    frames: list[int],
+    spaced_gpx: GpxTrack,
+    video_size: tuple[int, int],
+    tmp_video: Path | None,
+    save_image_folder: Path | None,
+    video_final_creation_time: datetime,
+    config: PipelineConfig,
+    nadir: Image.Image | None,
+    frame_cache: FrameCache | None,
+):
+    """Pipes each frame from the video, through the image pipeline and into the
+    encoder of the new video and/or the image writers, one at a time. Nothing but
+    the new video and the images is written to disk."""
+    with (
+        report.stage("stream frames") as stage,
+        ImageWriter(config.image_writers or 2) as writer,
+    ):
+        if frame_cache:
+            stream = cached_video_frames(frame_cache, video_file, frames, video_size)
+        else:
+            stream = stream_video_frames(video_file, frames, video_size)
+        with (
+            VideoEncoder(tmp_video, video_size, video_final_creation_time)
+            if tmp_video
+            else nullcontext()
+        ) as encoder:
+            for i, (image, gpx_point) in enumerate(
+                tqdm(
+                    zip(stream, spaced_gpx.points),
+                    desc="Streaming frames",
+                    total=len(frames),
+                    leave=True,
+                ),
+                start=1,
+            ):
+                with tracer.trace("image pipeline"):
+                    updated_image = _process_image(image, config, nadir)
+                if save_image_folder:
+                    image_out = save_image_folder / f"{video_file.stem}-{i:06}.jpg"
+                    _save_image(writer, updated_image, gpx_point, image_out, config)
+                if encoder:
+                    encoder.write(updated_image)
+                stage.count(frames=1)
+        writer.close()
+        stage.count(
+            bytes_read=video_file.stat().st_size,
+            bytes_written=writer.bytes_written
+            + (tmp_video.stat().st_size if tmp_video else 0),
+        )
@@ -0,0 +1,118 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Hashable
+
+from matsemanns_streetview_tools import tracer
+
+
+@dataclass
+class Stage:
+    """A step of a pipeline. run is called with the inputs as keyword arguments,
+    once all of them are available, and what it returns is available to the other
+    stages as output.
+
+    With memoize, the output is reused by later runs of the graph when memoize
+    returns the same key for the inputs. For things like rendering the nadir, that
+    only has to be done once for all the videos of the same size."""
+
+    name: str
+    run: Callable[..., Any]
+    inputs: list[str]
+    output: str
+    memoize: Callable[..., Hashable] | None = None
+
+
+@dataclass
+class StageGraph:
+    """Runs stages as soon as the stages they depend on are done, so stages that
+    don't depend on each other run at the same time. The stages should spend their
+    time in subprocesses (ffmpeg, exiftool) or I/O, as they run on threads.
+
+    Stages can be added or replaced to customize the pipeline:
+
+    graph = pipeline_stages()
+    graph.replace("inject spatial", my_inject)
+    graph.add(Stage("upload", upload, inputs=["final_video"], output="upload"))
+    """
+
+    stages: list[Stage] = field(default_factory=list)
+    workers: int = 4
+    _memo: dict[tuple[str, Hashable], Any] = field(default_factory=dict)
+
+    def add(self, stage: Stage) -> None:
+        if any(s.output == stage.output for s in self.stages):
+            raise RuntimeError(f"There's already a stage with output {stage.output}")
+        self.stages.append(stage)
+
+    def replace(self, name: str, run: Callable[..., Any]) -> None:
+        """Keeps the inputs and output of the stage, but does something else"""
+        stage = self.stage(name)
+        stage.run, stage.memoize = run, None
+
+    def stage(self, name: str) -> Stage:
+        stage = next((s for s in self.stages if s.name == name), None)
+        if stage is None:
+            raise RuntimeError(f"No stage named {name}")
+        return stage
+
+    def check(self, inputs: set[str]) -> None:
+        """Fails if a stage needs something no one makes, or the stages depend on
+        each other in a cycle"""
+        available = set(inputs)
+        remaining = list(self.stages)
+        while remaining:
+            ready = [s for s in remaining if available.issuperset(s.inputs)]
+            if not ready:
+                made = available | {s.output for s in remaining}
+                missing = sorted({i for s in remaining for i in s.inputs} - made)
+                if missing:
+                    raise RuntimeError(f"No stage makes {missing}")
+                names = [s.name for s in remaining]
+                raise RuntimeError(f"Stages {names} depend on each other in a cycle")
+            available.update(s.output for s in ready)
+            remaining = [s for s in remaining if s not in ready]
+
+    def run(
+        self, cancelled: Callable[[], bool] | None = None, **inputs: Any
+    ) -> dict[str, Any]:
+        """Runs all the stages, returns the inputs and all outputs. Each stage runs
+        once. If a stage fails, the ones not yet started are skipped and the error
+        is raised when the running ones are done. The same happens if cancelled()
+        is true before starting a stage."""
+        self.check(set(inputs))
+        values = dict(inputs)
+        # Nest the stages under the span that started the run
+        parent = tracer.current()
+        waiting = list(self.stages)
+        running: dict[Future, Stage] = {}
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="stage") as executor:
+            while waiting or running:
+                ready = [s for s in waiting if all(i in values for i in s.inputs)]
+                if ready and cancelled and cancelled():
+                    raise RuntimeError(f"Cancelled before stage {ready[0].name}")
+                for stage in ready:
+                    waiting.remove(stage)
+                    args = {name: values[name] for name in stage.inputs}
+                    future = executor.submit(self._run_stage, stage, args, parent)
+                    running[future] = stage
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    error = future.exception()
+                    if error:
+                        for other in running:
+                            other.cancel()
+                        raise error
+                    values[stage.output] = future.result()
+        return values
+
+    def _run_stage(self, stage: Stage, args: dict[str, Any], parent: str | None):
+        with tracer.within(parent):
+            if stage.memoize is None:
+                return stage.run(**args)
+            key = (stage.name, stage.memoize(**args))
+            if key not in self._memo:
+                self._memo[key] = stage.run(**args)
+            return self._memo[key]
@@ -0,0 +1,62 @@
+from matsemanns_streetview_tools.benchmarks.generators import (
+    synthetic_equirectangular,
+    synthetic_track,
+)
+from matsemanns_streetview_tools.benchmarks.runner import (
+    Benchmark,
+    BenchmarkResult,
+    find_regressions,
+    format_results,
+    load_baseline,
+    missing_baselines,
+    run_benchmark,
+    save_baseline,
+)
+from matsemanns_streetview_tools.gpx import gpx_track_to_xml, parse_gpx
+
+
+def test_synthetic_data():
+    track = synthetic_track(100)
+    assert len(track.points) == 100
+    assert parse_gpx(gpx_track_to_xml(track)) == track
+
+    image = synthetic_equirectangular(200, 100)
+    assert image.size == (200, 100)
+    assert image.mode == "RGB"
+
+
+def test_run_benchmark(tmp_path):
+    calls = []
+
+    def setup(folder):
+        calls.append("setup")
+        return lambda: calls.append("run")
+
+    result = run_benchmark(Benchmark("test", setup, repeat=3))
+    assert calls == ["setup"] + ["run"] * 4  # one untimed warmup
+    assert len(result.runs) == 3
+    assert result.best <= result.median
+
+    skipped = run_benchmark(Benchmark("test", setup, skip_if=lambda: "no ffmpeg"))
+    assert skipped.skipped == "no ffmpeg"
+    assert "skipped, no ffmpeg" in format_results([skipped], {})
+
+
+def test_baseline_and_regressions(tmp_path):
+    file = tmp_path / "baseline.json"
+    save_baseline([BenchmarkResult("a", [1.0]), BenchmarkResult("b", [2.0])], file)
+    save_baseline([BenchmarkResult("b", [3.0]), BenchmarkResult("c", [], "x")], file)
+    baseline = load_baseline(file)
+    assert baseline == {"a": 1.0, "b": 3.0}
+
+    results = [
+        BenchmarkResult("a", [1.2, 1.2, 1.2]),
+        BenchmarkResult("b", [4.0, 4.0, 4.0]),
+        BenchmarkResult("new", [1.0]),
+    ]
+    (regression,) = find_regressions(results, baseline, threshold=1.25)
+    assert regression.name == "b"
+    assert regression.ratio == 4.0 / 3.0
+    # Skipped ones aren't missing a baseline, they didn't run
+    skipped = BenchmarkResult("c", [], "no ffmpeg")
+    assert missing_baselines(results + [skipped], baseline) == ["new"]
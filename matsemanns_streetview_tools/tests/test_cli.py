@@ -0,0 +1,68 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+_HEAVY_MODULES = [
+    "PIL",
+    "numpy",
+    "tqdm",
+    "requests",
+    "httpx",
+    "pydantic",
+    "google.auth",
+    "google_auth_oauthlib",
+    "dotenv",
+]
+
+_RUN_CLI = """
+import json, sys
+from matsemanns_streetview_tools.scripts import cli
+try:
+    cli(sys.argv[1:])
+except SystemExit:
+    pass
+print(json.dumps({"modules": [m for m in sys.modules]}))
+"""
+
+
+def _run_cli(*args: str) -> dict:
+    proc = subprocess.run(
+        [sys.executable, "-c", _RUN_CLI, *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(proc.stdout.splitlines()[-1])
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["image", "nadir", "--help"],
+        ["google", "upload", "--help"],
+        ["google", "benchmark", "--help"],
+    ],
+)
+def test_cli_starts_without_heavy_imports(args):
+    result = _run_cli(*args)
+
+    loaded = [
+        module
+        for module in _HEAVY_MODULES
+        if any(m == module or m.startswith(f"{module}.") for m in result["modules"])
+    ]
+    assert loaded == []
+
+
+def test_cli_lists_all_commands():
+    from matsemanns_streetview_tools.scripts import cli
+
+    assert cli.list_commands(None) == [  # type: ignore
+        "google",
+        "image",
+        "pipeline",
+        "pipeline-worker",
+        "video-from-folder",
+    ]
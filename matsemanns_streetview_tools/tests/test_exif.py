@@ -0,0 +1,80 @@
+import io
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from PIL import ExifTags, Image
+from pytest import approx
+
+from matsemanns_streetview_tools.exif import create_exif_bytes
+from matsemanns_streetview_tools.gpx import GpxPoint
+from matsemanns_streetview_tools.image import create_exif_data
+
+
+def _saved_exif(exif) -> Image.Exif:
+    out = io.BytesIO()
+    Image.new("RGB", (16, 8)).save(out, format="jpeg", exif=exif)
+    return Image.open(out).getexif()
+
+
+def test_create_exif_bytes_matches_pillow_exif():
+    point = GpxPoint(
+        lat=Decimal("60.051034"),
+        lon=Decimal("10.688985"),
+        ele=Decimal("367.2"),
+        utc_time=datetime(2022, 8, 17, 13, 37, 55, 666000, tzinfo=timezone.utc),
+        heading=Decimal("214.2"),
+    )
+
+    expected = _saved_exif(create_exif_data(Image.new("RGB", (16, 8)), point))
+    actual = _saved_exif(create_exif_bytes(point))
+
+    for tag in [
+        ExifTags.Base.Software,
+        ExifTags.Base.DateTime,
+        ExifTags.Base.DateTimeOriginal,
+        ExifTags.Base.DateTimeDigitized,
+    ]:
+        assert actual[tag] == expected[tag]
+
+    expected_gps = expected.get_ifd(ExifTags.IFD.GPSInfo)
+    actual_gps = actual.get_ifd(ExifTags.IFD.GPSInfo)
+    assert set(actual_gps) == set(expected_gps)
+    for tag in [
+        ExifTags.GPS.GPSLatitudeRef,
+        ExifTags.GPS.GPSLongitudeRef,
+        ExifTags.GPS.GPSAltitudeRef,
+        ExifTags.GPS.GPSDateStamp,
+        ExifTags.GPS.GPSImgDirectionRef,
+    ]:
+        assert actual_gps[tag] == expected_gps[tag]
+    for tag in [
+        ExifTags.GPS.GPSLatitude,
+        ExifTags.GPS.GPSLongitude,
+        ExifTags.GPS.GPSAltitude,
+        ExifTags.GPS.GPSImgDirection,
+        ExifTags.GPS.GPSDestBearing,
+    ]:
+        assert float(actual_gps[tag]) == approx(float(expected_gps[tag]), abs=1e-6)
+    assert [float(v) for v in actual_gps[ExifTags.GPS.GPSTimeStamp]] == [
+        13,
+        37,
+        55.666,
+    ]
+
+
+def test_create_exif_bytes_south_west_without_heading():
+    point = GpxPoint(
+        lat=Decimal("-33.8688"),
+        lon=Decimal("-70.6693"),
+        ele=Decimal("-2.5"),
+        utc_time=datetime(2023, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+    )
+
+    gps = _saved_exif(create_exif_bytes(point)).get_ifd(ExifTags.IFD.GPSInfo)
+
+    assert gps[ExifTags.GPS.GPSLatitudeRef] == "S"
+    assert float(gps[ExifTags.GPS.GPSLatitude]) == approx(33.8688)
+    assert gps[ExifTags.GPS.GPSLongitudeRef] == "W"
+    assert gps[ExifTags.GPS.GPSAltitudeRef] == b"\x01"
+    assert float(gps[ExifTags.GPS.GPSAltitude]) == approx(2.5)
+    assert ExifTags.GPS.GPSImgDirection not in gps
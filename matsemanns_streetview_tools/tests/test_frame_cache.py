@@ -0,0 +1,74 @@
+import shutil
+
+import pytest
+from PIL import Image
+
+from matsemanns_streetview_tools import frame_cache
+from matsemanns_streetview_tools.benchmarks.generators import synthetic_video
+from matsemanns_streetview_tools.frame_cache import FrameCache, cached_video_frames
+from matsemanns_streetview_tools.util import ffmpeg_path
+
+SIZE = (16, 8)
+FRAME_BYTES = 16 * 8 * 3
+
+
+def _frame(value: int) -> Image.Image:
+    return Image.new("RGB", SIZE, (value, 0, 0))
+
+
+def test_frame_cache_evicts_least_recently_used(tmp_path):
+    cache = FrameCache(tmp_path, max_bytes=FRAME_BYTES * 3)
+    for frame in range(3):
+        cache.put("video", frame, _frame(frame))
+    assert cache.get("video", 0, SIZE).getpixel((0, 0)) == (0, 0, 0)
+
+    cache.put("video", 3, _frame(3))
+
+    assert cache.get("video", 1, SIZE) is None
+    assert cache.get("video", 0, SIZE) is not None
+    assert cache.get("video", 3, SIZE).getpixel((0, 0)) == (3, 0, 0)
+    assert cache.size == FRAME_BYTES * 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    # Picked up again by the next run, with the same order
+    reopened = FrameCache(tmp_path, max_bytes=FRAME_BYTES * 3)
+    assert reopened.size == FRAME_BYTES * 3
+    reopened.put("video", 4, _frame(4))
+    assert not reopened.contains("video", 2, SIZE)
+
+
+def test_frame_cache_keeps_pinned_frames(tmp_path):
+    cache = FrameCache(tmp_path, max_bytes=FRAME_BYTES * 2)
+    cache.put("video", 0, _frame(0))
+    cache.put("video", 1, _frame(1))
+    cache.pin("video", [0], SIZE)
+
+    cache.put("video", 2, _frame(2))
+
+    assert cache.contains("video", 0, SIZE)
+    assert not cache.contains("video", 1, SIZE)
+
+
+@pytest.mark.skipif(shutil.which(ffmpeg_path()) is None, reason="ffmpeg not found")
+def test_cached_video_frames_only_decodes_new_frames(tmp_path, monkeypatch):
+    video = synthetic_video(tmp_path / "video.mp4", seconds=2, width=64, height=32)
+    cache = FrameCache(tmp_path / "cache", max_bytes=100 * 64 * 32 * 3)
+    first = list(cached_video_frames(cache, video, [0, 10, 20], (64, 32)))
+
+    decoded = []
+    stream_video_frames = frame_cache.stream_video_frames
+
+    def counting_stream(video_file, frames, size):
+        decoded.extend(frames)
+        return stream_video_frames(video_file, frames, size)
+
+    monkeypatch.setattr(frame_cache, "stream_video_frames", counting_stream)
+    second = list(cached_video_frames(cache, video, [10, 15, 15, 20], (64, 32)))
+
+    assert decoded == [15]
+    assert len(second) == 4
+    assert second[0].tobytes() == first[1].tobytes()
+    assert second[3].tobytes() == first[2].tobytes()
+
+    list(cached_video_frames(cache, video, [0, 15], (64, 32)))
+    assert decoded == [15]
@@ -0,0 +1,40 @@
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from matsemanns_streetview_tools import metadata
+from matsemanns_streetview_tools.frame_index import FrameIndex
+
+
+def test_frame_index_is_stored_until_video_changes(tmp_path, monkeypatch):
+    video = tmp_path / "GS010001.mp4"
+    video.write_bytes(b"video")
+    probed = []
+
+    def get_frame_times(file):
+        probed.append(file)
+        return np.array([0, 33_367, 66_733, 133_467], dtype=np.int64)
+
+    monkeypatch.setattr(metadata, "get_frame_times", get_frame_times)
+
+    index = FrameIndex.load(video)
+    assert FrameIndex.index_file(video).exists()
+    assert FrameIndex.load(video).times_us.tolist() == index.times_us.tolist()
+    assert len(probed) == 1
+
+    video.write_bytes(b"another video")
+    FrameIndex.load(video)
+    assert len(probed) == 2
+
+
+def test_frame_index_lookup_and_drift(tmp_path):
+    # 30 fps, but frame 3 was dropped, so the rest come 1/30s later
+    times_us = np.round(np.array([0, 1, 2, 4, 5]) / 30 * 1_000_000).astype(np.int64)
+    index = FrameIndex(tmp_path / "video.mp4", "fingerprint", times_us)
+
+    assert index.frame_at(0.1) == 3
+    assert index.frame_at(0.1, rounding="previous") == 2
+    assert index.frame_at(0.13, rounding="nearest") == 3
+    assert index.frame_at(0.2) == len(index)
+    assert index.max_drift(Decimal(30)) == pytest.approx(1 / 30, abs=1e-6)
@@ -0,0 +1,369 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from pathlib import Path
+
+import pytest
+import requests
+from google.oauth2.credentials import Credentials
+from pydantic import BaseModel
+
+import matsemanns_streetview_tools.google_street_view as gsv
+import matsemanns_streetview_tools.google_street_view_async as gsva
+from matsemanns_streetview_tools import metadata
+from matsemanns_streetview_tools.benchmarks.generators import START, synthetic_track
+from matsemanns_streetview_tools.gpx import GpxTrack, gpx_track_to_xml
+from matsemanns_streetview_tools.metadata import FfprobeMetadata
+from matsemanns_streetview_tools.mock_street_view import MockStreetViewServer
+from matsemanns_streetview_tools.transfer import (
+    Backoff,
+    MiB,
+    TokenBucket,
+    TransferController,
+)
+from matsemanns_streetview_tools.upload_journal import UploadJournal
+
+
+def _gpx_track() -> GpxTrack:
+    # A point a second, covering the 10 second videos
+    return synthetic_track(points=11)
+
+
+def _create_video(folder: Path, name: str, size: int) -> Path:
+    video = folder / f"{name}.mp4"
+    video.write_bytes(os.urandom(size))
+    (folder / f"{name}.gpx").write_text(gpx_track_to_xml(_gpx_track()))
+    return video
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # Only the duration and start is used when uploading, no need for real videos
+    probe = FfprobeMetadata(
+        {"format": {"duration": "10", "tags": {"creation_time": START.isoformat()}}}
+    )
+    monkeypatch.setattr(metadata, "get_ffprobe_metadata", lambda video: probe)
+    monkeypatch.setattr(gsv, "get_user_credentials", lambda: Credentials("test"))
+    monkeypatch.setattr(gsv, "retry_backoff", Backoff(base=0.01))
+
+    with MockStreetViewServer() as server:
+        monkeypatch.setenv("STREETVIEW_API_URL", server.api_url)
+        yield server
+
+
+def test_upload_streetview_video(server, tmp_path):
+    video = _create_video(tmp_path, "video", 5 * 1024 * 1024)
+    uploaded = []
+
+    gsv.upload_streetview_video(
+        video, _gpx_track(), chunk_size_mib=2, progress=uploaded.append
+    )
+
+    assert uploaded == [2 * 1024 * 1024, 2 * 1024 * 1024, 1024 * 1024]
+    (upload,) = server.uploads.values()
+    assert upload.status == "final"
+    assert upload.data == video.read_bytes()
+    (sequence,) = server.sequences
+    assert len(sequence["rawGpsTimeline"]) == 11
+
+
+def test_upload_with_adaptive_chunk_size(server, tmp_path):
+    video = _create_video(tmp_path, "video", 15 * MiB)
+    uploaded = []
+
+    gsv.upload_streetview_video(
+        video,
+        _gpx_track(),
+        chunk_size_mib=2,
+        max_chunk_size_mib=8,
+        progress=uploaded.append,
+    )
+
+    # A local server is fast, so the chunks grow until the max
+    assert uploaded == [2 * MiB, 4 * MiB, 8 * MiB, 1 * MiB]
+    (upload,) = server.uploads.values()
+    assert upload.data == video.read_bytes()
+
+
+def test_upload_retries_failed_chunks_with_smaller_chunks(server, tmp_path):
+    video = _create_video(tmp_path, "video", 12 * MiB)
+    server.chunk_failures = [503, 503]
+    uploaded = []
+
+    gsv.upload_streetview_video(
+        video,
+        _gpx_track(),
+        chunk_size_mib=8,
+        max_chunk_size_mib=8,
+        progress=uploaded.append,
+    )
+
+    # Halved after each failure, then waits for it to be stable before growing
+    assert uploaded == [2 * MiB, 2 * MiB, 4 * MiB, 4 * MiB]
+    (upload,) = server.uploads.values()
+    assert upload.data == video.read_bytes()
+
+
+def test_upload_gives_up_on_fatal_status(server, tmp_path):
+    video = _create_video(tmp_path, "video", 4 * MiB)
+    server.chunk_failures = [403]
+
+    with pytest.raises(requests.HTTPError):
+        gsv.upload_streetview_video(video, _gpx_track(), chunk_size_mib=2)
+
+    assert UploadJournal.load(video).bytes_uploaded == 0
+    assert server.sequences == []
+
+
+def test_upload_fails_on_empty_video(server, tmp_path):
+    video = _create_video(tmp_path, "video", 0)
+
+    with pytest.raises(RuntimeError, match="is empty"):
+        gsv.upload_streetview_video(video, _gpx_track(), chunk_size_mib=2)
+
+    assert server.sequences == []
+
+
+def test_upload_continues_from_journal_after_interruption(server, tmp_path):
+    video = _create_video(tmp_path, "video", 5 * 1024 * 1024)
+
+    def stop_after_two_chunks(n: int) -> None:
+        if UploadJournal.load(video).bytes_uploaded > 2 * 1024 * 1024:
+            raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        gsv.upload_streetview_video(
+            video, _gpx_track(), chunk_size_mib=2, progress=stop_after_two_chunks
+        )
+    journal = UploadJournal.load(video)
+    assert journal.status == "uploading"
+    assert journal.bytes_uploaded == 4 * 1024 * 1024
+
+    uploaded = []
+    gsv.upload_streetview_video(
+        video, _gpx_track(), chunk_size_mib=2, progress=uploaded.append
+    )
+
+    # Reported what was already uploaded, then only sent the rest
+    assert uploaded == [4 * 1024 * 1024, 1024 * 1024]
+    (upload,) = server.uploads.values()
+    assert upload.data == video.read_bytes()
+    assert UploadJournal.load(video).status == "published"
+
+    # Published videos are skipped
+    gsv.upload_streetview_video(video, _gpx_track(), chunk_size_mib=2)
+    assert len(server.sequences) == 1
+
+
+def test_upload_starts_over_when_video_changed(server, tmp_path):
+    video = _create_video(tmp_path, "video", 1024 * 1024)
+    gsv.upload_streetview_video(video, _gpx_track(), chunk_size_mib=2)
+
+    video.write_bytes(os.urandom(1024 * 1024))
+    gsv.upload_streetview_video(video, _gpx_track(), chunk_size_mib=2)
+
+    assert len(server.uploads) == 2
+    assert len(server.sequences) == 2
+
+
+def test_upload_streetview_videos_in_parallel(server, tmp_path):
+    videos = [_create_video(tmp_path, f"video_{i}", 3 * 1024 * 1024) for i in range(3)]
+    missing_gpx = tmp_path / "no_gpx.mp4"
+    missing_gpx.write_bytes(b"data")
+
+    failed = gsv.upload_streetview_videos(
+        videos + [missing_gpx], chunk_size_mib=2, concurrency=3
+    )
+
+    assert failed == [missing_gpx]
+    assert len(server.sequences) == 3
+    assert sorted(bytes(upload.data) for upload in server.uploads.values()) == sorted(
+        video.read_bytes() for video in videos
+    )
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=1000, capacity=100)
+
+    start = time.monotonic()
+    bucket.consume(100)  # the burst capacity is available right away
+    bucket.consume(200)
+    elapsed = time.monotonic() - start
+
+    assert 0.15 < elapsed < 0.5
+
+
+# The schema of the photoSequence request, written by create_photo_sequence_json
+
+
+class UploadReference(BaseModel):
+    uploadUrl: str
+
+
+class LatLng(BaseModel):
+    latitude: float
+    longitude: float
+
+
+class Pose(BaseModel):
+    latLngPair: LatLng
+    altitude: float | None
+    gpsRecordTimestampUnixEpoch: str
+    heading: float | None = None
+    pitch: float | None = None
+    roll: float | None = None
+
+
+class PhotoSequenceRequest(BaseModel):
+    uploadReference: UploadReference
+    rawGpsTimeline: list[Pose]
+    gpsSource: str
+    captureTimeOverride: str
+
+
+def test_create_photo_sequence_json_matches_schema():
+    track = _gpx_track()
+    track.points[3].utc_time += timedelta(microseconds=123456)
+    track.points[3].heading = Decimal("214.2")
+    video_start = START + timedelta(microseconds=500)
+
+    body = gsv.create_photo_sequence_json(track, video_start, "https://upload/1")
+
+    expected = PhotoSequenceRequest(
+        uploadReference=UploadReference(uploadUrl="https://upload/1"),
+        rawGpsTimeline=[
+            Pose(
+                latLngPair=LatLng(
+                    latitude=float(point.lat), longitude=float(point.lon)
+                ),
+                altitude=float(point.ele),
+                gpsRecordTimestampUnixEpoch=point.utc_time.strftime(
+                    "%Y-%m-%dT%H:%M:%S.%fZ"
+                ),
+                heading=float(point.heading) if point.heading is not None else None,
+                pitch=0,
+                roll=0,
+            )
+            for point in track.points
+        ],
+        gpsSource="PHOTO_SEQUENCE",
+        captureTimeOverride=video_start.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+    )
+    assert PhotoSequenceRequest.model_validate_json(body) == expected
+    pose = expected.rawGpsTimeline[3]
+    assert pose.gpsRecordTimestampUnixEpoch == "2024-06-01T12:00:03.123456Z"
+    assert pose.heading == 214.2
+
+
+def test_format_timestamp():
+    for dt in [
+        datetime(1999, 12, 31, 23, 59, 59, 999999, tzinfo=timezone.utc),
+        datetime(2024, 2, 29, 0, 0, 0, tzinfo=timezone.utc),
+        datetime(2024, 6, 1, 14, 5, 6, 7, tzinfo=timezone(timedelta(hours=2))),
+    ]:
+        expected = dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        assert gsv._format_timestamp(dt) == expected
+
+
+def test_transfer_controller_chunk_size():
+    controller = TransferController(16 * MiB, maximum=64 * MiB, target_seconds=10)
+
+    # 1 MiB/s, aims for 10 MiB per request, rounded down to a multiple of 2
+    controller.record(16 * MiB, 16)
+    assert controller.size == 10 * MiB
+
+    # Grows at most to the double
+    for _ in range(10):
+        controller.record(controller.size, 0.1)
+    assert controller.size == 64 * MiB
+
+    # Slows down right away
+    controller.record(MiB, 2)
+    assert controller.size == 4 * MiB
+
+    # Halves on failures, and only grows again after a couple of chunks
+    controller.failed(4 * MiB)
+    assert controller.size == 2 * MiB
+    controller.record(2 * MiB, 0.1)
+    assert controller.size == 2 * MiB
+    controller.record(2 * MiB, 0.1)
+    assert controller.size == 4 * MiB
+
+    assert controller.failures == 1
+    assert controller.bytes_failed == 4 * MiB
+
+
+def test_backoff_delay():
+    backoff = Backoff(base=1, cap=10)
+
+    for attempt, limit in [(0, 1), (1, 2), (2, 4), (3, 8), (4, 10), (10, 10)]:
+        delays = [backoff.delay(attempt) for _ in range(20)]
+        assert all(limit / 2 <= delay <= limit for delay in delays)
+
+
+def test_upload_streetview_videos_async(server, tmp_path):
+    videos = [_create_video(tmp_path, f"video_{i}", 5 * MiB) for i in range(3)]
+    missing_gpx = tmp_path / "no_gpx.mp4"
+    missing_gpx.write_bytes(b"data")
+    server.chunk_failures = [503]
+
+    failed = asyncio.run(
+        gsva.upload_streetview_videos(
+            videos + [missing_gpx],
+            chunk_size_mib=2,
+            max_chunk_size_mib=4,
+            concurrency=2,
+            max_mib_per_second=100,
+            credentials=Credentials("test"),
+        )
+    )
+
+    assert failed == [missing_gpx]
+    assert len(server.sequences) == 3
+    assert sorted(bytes(upload.data) for upload in server.uploads.values()) == sorted(
+        video.read_bytes() for video in videos
+    )
+
+
+def test_credential_manager_refreshes_in_background(monkeypatch):
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    credentials = Credentials("old", expiry=now + timedelta(hours=1))
+    refreshed = []
+
+    def refresh(request):
+        refreshed.append(request)
+        credentials.token = "new"
+        credentials.expiry = now + timedelta(hours=2)
+
+    monkeypatch.setattr(credentials, "refresh", refresh)
+    monkeypatch.setattr(gsv, "save_credentials", lambda creds: None)
+
+    async def run():
+        # The margin makes it due for a refresh right away
+        manager = gsva.CredentialManager(credentials, refresh_margin=timedelta(hours=1))
+        assert await manager.header() == "Bearer old"
+        await manager.start()
+        await asyncio.sleep(0.2)
+        assert await manager.header() == "Bearer new"
+        await manager.stop()
+
+    asyncio.run(run())
+    assert len(refreshed) == 1
+
+
+def test_mock_server_injects_latency_and_failures(server, tmp_path):
+    video = _create_video(tmp_path, "video", 6 * MiB)
+    server.latency = 0.05
+    server.chunk_failures = [503]
+
+    start = time.perf_counter()
+    gsv.upload_streetview_video(video, _gpx_track(), chunk_size_mib=2)
+
+    # startUpload, start, 1 failed + query + 3 chunks, photoSequence
+    assert time.perf_counter() - start >= 7 * 0.05
+    assert server.injected_failures == 1
+    assert len(server.recovery_times) == 1
+    (upload,) = server.uploads.values()
+    assert upload.data == video.read_bytes()
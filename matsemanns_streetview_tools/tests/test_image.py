@@ -0,0 +1,98 @@
+import pytest
+from PIL import Image
+
+from matsemanns_streetview_tools.image import (
+    ImageWriter,
+    apply_image_pipeline,
+    create_nadir,
+    render_nadir,
+    visible_region,
+)
+
+
+def test_visible_region():
+    assert visible_region((100, 50)) == (0, 0, 100, 50)
+    assert visible_region((100, 50), (100, 10)) == (0, 0, 100, 40)
+    # Nadir not covering whole width doesn't hide any rows
+    assert visible_region((100, 50), (80, 10)) == (0, 0, 100, 50)
+
+
+def test_apply_image_pipeline_skips_nadir_area():
+    img = Image.new("RGB", (100, 50), (100, 100, 100))
+    nadir = Image.new("RGB", (100, 10), (0, 0, 255))
+
+    result = apply_image_pipeline(img, nadir, brightness=1.5)
+
+    assert result.size == (100, 50)
+    assert result.getpixel((50, 0)) == (150, 150, 150)
+    assert result.getpixel((50, 39)) == (150, 150, 150)
+    assert result.getpixel((50, 40)) == (0, 0, 255)
+    # Original is untouched
+    assert img.getpixel((50, 45)) == (100, 100, 100)
+
+
+def test_apply_image_pipeline_with_region_and_mask():
+    img = Image.new("RGB", (100, 50), (100, 100, 100))
+
+    result = apply_image_pipeline(img, brightness=1.5, region=(0, 0, 50, 50))
+    assert result.getpixel((10, 10)) == (150, 150, 150)
+    assert result.getpixel((60, 10)) == (100, 100, 100)
+
+    mask = Image.new("L", (100, 50), 0)
+    mask.paste(255, (0, 0, 100, 25))
+    result = apply_image_pipeline(img, brightness=1.5, mask=mask)
+    assert result.getpixel((60, 10)) == (150, 150, 150)
+    assert result.getpixel((60, 30)) == (100, 100, 100)
+
+
+def _quadrant_logo(size: int) -> Image.Image:
+    half = size // 2
+    logo = Image.new("RGB", (size, size))
+    logo.paste((255, 0, 0), (0, 0, half, half))  # top left
+    logo.paste((0, 255, 0), (half, 0, size, half))  # top right
+    logo.paste((0, 0, 255), (0, half, half, size))  # bottom left
+    logo.paste((255, 255, 255), (half, half, size, size))  # bottom right
+    return logo
+
+
+def test_render_nadir():
+    nadir = render_nadir(_quadrant_logo(200), 800, 100)
+
+    assert nadir.size == (800, 100)
+    assert nadir.mode == "RGBA"
+    # Middle of the 360 image faces the top of the logo, left of it is the left side
+    assert nadir.getpixel((300, 10)) == (255, 0, 0, 255)
+    assert nadir.getpixel((500, 10)) == (0, 255, 0, 255)
+    assert nadir.getpixel((100, 10)) == (0, 0, 255, 255)
+    assert nadir.getpixel((700, 10)) == (255, 255, 255, 255)
+
+
+def test_render_nadir_large_non_square_input(tmp_path):
+    logo = Image.new("RGB", (3000, 2000), (0, 0, 0))
+    logo.paste(_quadrant_logo(2000), (500, 0))
+    logo.save(tmp_path / "logo.png")
+
+    create_nadir(tmp_path / "logo.png", tmp_path / "nadir.png", 800, 100)
+
+    nadir = Image.open(tmp_path / "nadir.png")
+    assert nadir.size == (800, 100)
+    assert nadir.getpixel((300, 10)) == (255, 0, 0, 255)
+    assert nadir.getpixel((700, 10)) == (255, 255, 255, 255)
+
+
+def test_image_writer(tmp_path):
+    images = [Image.new("RGB", (64, 32), (i * 20, 0, 0)) for i in range(10)]
+    with ImageWriter(workers=3, max_pending=2) as writer:
+        for i, image in enumerate(images):
+            writer.save(image, tmp_path / f"{i}.jpg", quality=90)
+        writer.close()
+
+    files = [tmp_path / f"{i}.jpg" for i in range(10)]
+    assert writer.bytes_written == sum(f.stat().st_size for f in files)
+    assert Image.open(files[5]).getpixel((10, 10))[0] == pytest.approx(100, abs=3)
+
+
+def test_image_writer_raises_failed_save(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        with ImageWriter() as writer:
+            writer.save(Image.new("RGB", (8, 8)), tmp_path / "missing" / "1.jpg")
@@ -0,0 +1,84 @@
+from PIL import Image
+from pytest import approx
+
+from matsemanns_streetview_tools.image import apply_image_pipeline
+from matsemanns_streetview_tools.preview import (
+    open_preview_image,
+    PreviewPipeline,
+    render_effect_grid,
+    texture_data,
+)
+
+
+def test_open_preview_image_downscales(tmp_path):
+    file = tmp_path / "frame.jpg"
+    Image.new("RGB", (800, 400), (10, 20, 30)).save(file)
+
+    img = open_preview_image(file, max_width=200)
+
+    assert img.size == (200, 100)
+    assert open_preview_image(file).size == (800, 400)
+
+
+def test_preview_pipeline_reuses_unchanged_steps():
+    img = Image.linear_gradient("L").convert("RGB").resize((64, 32))
+    preview = PreviewPipeline(img)
+
+    first = preview.apply(contrast=1.2, color=1.1)
+    expected = apply_image_pipeline(img, contrast=1.2, color=1.1)
+    assert first.tobytes() == expected.tobytes()
+
+    # Same values gives back the cached result
+    assert preview.apply(contrast=1.2, color=1.1) is first
+
+    # Changing only the last enhancement keeps the earlier steps
+    contrast_step = preview._steps[0][1]
+    preview.apply(contrast=1.2, color=1.3)
+    assert preview._steps[0][1] is contrast_step
+
+
+def test_texture_data():
+    img = Image.new("RGB", (4, 2), (255, 0, 51))
+
+    data = texture_data(img)
+
+    assert data.shape == (4 * 2 * 4,)
+    assert list(data[:4]) == approx([1.0, 0.0, 0.2, 1.0])
+
+
+def test_render_effect_grid(tmp_path):
+    img = Image.linear_gradient("L").convert("RGB").resize((64, 32))
+
+    files = render_effect_grid(
+        img,
+        tmp_path,
+        contrasts=[1.0, 1.1],
+        brightness=[1.0],
+        colors=[1.0, 1.2, None],
+        sharpness=[None],
+        max_workers=2,
+        contact_sheet_width=60,
+    )
+
+    assert len(files) == 7
+    assert (tmp_path / "con1.1_bri1.0_col1.2_sharpNone.jpg").exists()
+    # 6 variants in a 3x2 grid of 20 px wide thumbnails
+    assert Image.open(tmp_path / "contact_sheet.jpg").size == (60, 20)
+
+
+def test_render_effect_grid_leaves_image_unchanged(tmp_path):
+    img = Image.linear_gradient("L").convert("RGB").resize((200, 100))
+    original = img.tobytes()
+
+    render_effect_grid(
+        img,
+        tmp_path,
+        contrasts=[None, 1.1],
+        brightness=[None],
+        colors=[None],
+        sharpness=[None],
+        max_workers=2,
+        contact_sheet_width=100,
+    )
+
+    assert img.tobytes() == original
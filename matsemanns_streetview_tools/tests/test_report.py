@@ -0,0 +1,96 @@
+import json
+import subprocess
+import sys
+import threading
+import time
+
+from matsemanns_streetview_tools.report import RunReport, StageMetrics
+
+
+def _busy(seconds: float) -> None:
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+
+def test_run_report_stages_and_files(tmp_path):
+    report = RunReport()
+    for name in ["a.mp4", "b.mp4"]:
+        with report.file(name):
+            with report.stage("extract frames") as stage:
+                subprocess.run(
+                    [
+                        sys.executable,
+                        "-c",
+                        "import time\nt=time.process_time()\n"
+                        "while time.process_time() - t < 0.3: pass",
+                    ],
+                    check=True,
+                )
+                stage.count(frames=10, bytes_read=4_000_000, bytes_written=1_000_000)
+            for _ in range(2):
+                with report.stage("image pipeline") as stage:
+                    _busy(0.1)
+                    stage.count(frames=1, bytes_read=100, bytes_written=200)
+
+    totals = report.stage_totals()
+    assert totals["extract frames"].frames == 20
+    assert totals["extract frames"].bytes_read == 8_000_000
+    assert totals["extract frames"].child_cpu_seconds >= 0.5
+    assert totals["extract frames"].bound == "subprocess"
+    assert totals["image pipeline"].invocations == 4
+    assert totals["image pipeline"].bound == "python"
+    assert totals["file"].invocations == 2
+
+    file_metrics = report.files["a.mp4"]["file"]
+    assert file_metrics.frames == 10
+    assert file_metrics.bytes_read == 4_000_200
+    assert file_metrics.bytes_written == 1_000_400
+    assert file_metrics.peak_rss_bytes > 0
+
+    report.write(tmp_path / "report.json")
+    data = json.loads((tmp_path / "report.json").read_text())
+    assert data["files"].keys() == {"a.mp4", "b.mp4"}
+    assert data["stages"]["extract frames"]["frames_per_second"] > 0
+    assert "image pipeline" in report.out()
+
+
+def test_overlapping_stages_have_no_cpu(tmp_path):
+    report = RunReport()
+    both_running = threading.Barrier(2)
+
+    def work(name: str):
+        with report.stage(name) as stage:
+            both_running.wait()
+            for _ in range(1000):
+                stage.count(bytes_read=1)
+
+    with report.file("a.mp4"):
+        threads = [threading.Thread(target=work, args=(n,)) for n in ["a", "b"]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with report.stage("alone"):
+            _busy(0.1)
+
+    stages = report.files["a.mp4"]
+    assert stages["a"].overlapped and stages["b"].overlapped
+    assert stages["a"].bound is None
+    assert stages["alone"].bound == "python"
+    assert not stages["file"].overlapped
+    assert stages["file"].bytes_read == 2000
+
+    report.write(tmp_path / "report.json")
+    data = json.loads((tmp_path / "report.json").read_text())
+    assert data["stages"]["a"]["child_cpu_seconds"] is None
+    assert data["stages"]["a"]["bound"] is None
+    assert data["stages"]["alone"]["cpu_seconds"] > 0
+    assert "(- is a stage that ran alongside others" in report.out()
+
+
+def test_stage_metrics_bound():
+    assert StageMetrics(wall_seconds=10, cpu_seconds=1).bound == "io"
+    assert StageMetrics(wall_seconds=10, cpu_seconds=9).bound == "python"
+    assert StageMetrics(wall_seconds=10, child_cpu_seconds=30).bound == "subprocess"
+    assert StageMetrics().frames_per_second == 0.0
@@ -0,0 +1,134 @@
+import threading
+
+import pytest
+
+from matsemanns_streetview_tools.scripts.pipeline import (
+    PipelineConfig,
+    _PipelineRun,
+    pipeline_stages,
+)
+from matsemanns_streetview_tools.stage_graph import Stage, StageGraph
+
+
+def test_independent_stages_run_at_the_same_time():
+    # Both have to be running for either to get past the barrier
+    barrier = threading.Barrier(2, timeout=5)
+
+    def wait_for_other(x):
+        barrier.wait()
+        return x
+
+    graph = StageGraph(
+        [
+            Stage("a", wait_for_other, ["x"], "a"),
+            Stage("b", wait_for_other, ["x"], "b"),
+            Stage("sum", lambda a, b: a + b, ["a", "b"], "sum"),
+        ]
+    )
+    assert graph.run(x=2)["sum"] == 4
+
+
+def test_memoized_stage_runs_once_per_key():
+    calls = []
+
+    def render(size):
+        calls.append(size)
+        return f"nadir {size}"
+
+    graph = StageGraph(
+        [Stage("nadir", render, ["size"], "nadir", memoize=lambda size: size)]
+    )
+    assert graph.run(size=1)["nadir"] == "nadir 1"
+    assert graph.run(size=1)["nadir"] == "nadir 1"
+    assert graph.run(size=2)["nadir"] == "nadir 2"
+    assert calls == [1, 2]
+
+
+def test_add_and_replace_stages():
+    graph = StageGraph([Stage("double", lambda x: x * 2, ["x"], "doubled")])
+    graph.add(Stage("add one", lambda doubled: doubled + 1, ["doubled"], "result"))
+    assert graph.run(x=3)["result"] == 7
+
+    graph.replace("double", lambda x: x * 10)
+    assert graph.run(x=3)["result"] == 31
+
+    with pytest.raises(RuntimeError, match="already a stage"):
+        graph.add(Stage("again", lambda x: x, ["x"], "doubled"))
+
+
+def test_missing_inputs_and_cycles():
+    graph = StageGraph([Stage("a", lambda y: y, ["y"], "a")])
+    with pytest.raises(RuntimeError, match="No stage makes \\['y'\\]"):
+        graph.run(x=1)
+
+    graph = StageGraph(
+        [Stage("a", lambda b: b, ["b"], "a"), Stage("b", lambda a: a, ["a"], "b")]
+    )
+    with pytest.raises(RuntimeError, match="cycle"):
+        graph.run()
+
+
+def test_failing_stage_skips_the_rest():
+    ran = []
+
+    def fail():
+        raise ValueError("broken")
+
+    graph = StageGraph(
+        [
+            Stage("fail", fail, [], "failed"),
+            Stage("after", lambda failed: ran.append(failed), ["failed"], "after"),
+        ]
+    )
+    with pytest.raises(ValueError, match="broken"):
+        graph.run()
+    assert ran == []
+
+
+def test_cancelled_skips_the_stages_not_started():
+    ran = []
+    cancel = threading.Event()
+
+    def first():
+        cancel.set()
+        return 1
+
+    graph = StageGraph(
+        [
+            Stage("first", first, [], "first"),
+            Stage("after", lambda first: ran.append(first), ["first"], "after"),
+        ]
+    )
+    with pytest.raises(RuntimeError, match="Cancelled before stage after"):
+        graph.run(cancel.is_set)
+    assert ran == []
+
+
+def test_pipeline_stages_have_all_their_inputs():
+    pipeline_stages().check(
+        {
+            "video_file",
+            "original_file",
+            "gpx_track",
+            "output_folder",
+            "config",
+            "nadir",
+            "nadir_logo",
+            "frame_cache",
+        }
+    )
+
+
+def test_pipeline_fails_with_both_nadir_and_logo(tmp_path):
+    config = PipelineConfig(
+        project_name="test",
+        video_files=["*.mp4"],
+        original_files_folder=".",
+        gpx_file="track.gpx",
+        output_folder="out",
+        frame_distance_meters=3,
+        nadir="nadir.png",
+        nadir_logo="logo.png",
+    )
+    with pytest.raises(RuntimeError, match="either nadir or nadir_logo"):
+        _PipelineRun.prepare(tmp_path, config, "log.txt")
@@ -0,0 +1,116 @@
+import json
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from matsemanns_streetview_tools.tracer import SpanStats, Tracer
+
+
+def test_nested_spans_and_counters():
+    tracer = Tracer()
+    with tracer.trace("file"):
+        with tracer.trace("extract"):
+            tracer.count("frames", 10)
+        with tracer.trace("extract"):
+            tracer.count("frames", 5)
+    tracer.add("upload", 3.0, invocations=3)
+
+    summary = tracer.summary()
+    assert summary.keys() == {"file", "file/extract", "upload"}
+    assert summary["file"]["invocations"] == 1
+    assert summary["file/extract"]["invocations"] == 2
+    assert summary["file/extract"]["counters"] == {"frames": 15}
+    assert summary["upload"]["invocations"] == 3
+    assert summary["upload"]["p95"] == 1.0
+
+    lines = tracer.out().splitlines()
+    assert lines[1].startswith("file ")
+    assert lines[2].startswith("  extract ")
+    assert "frames: 15" in lines[2]
+
+
+def test_percentiles():
+    stats = SpanStats(durations=[float(i) for i in range(1, 101)])
+    assert stats.percentile(50) == 50.0
+    assert stats.percentile(95) == 95.0
+    assert stats.percentile(100) == 100.0
+    assert SpanStats().percentile(50) == 0.0
+
+
+def test_zero_invocations_only_add_time():
+    tracer = Tracer()
+    tracer.add("setup", 2.0, invocations=0)
+    with tracer.trace("setup", invocations=0):
+        pass
+
+    summary = tracer.summary()["setup"]
+    assert summary["invocations"] == 0
+    assert summary["total_time"] >= 2.0
+    assert summary["avg"] == 0.0
+    assert "setup" in tracer.out()
+
+
+def test_threads_have_their_own_nesting():
+    tracer = Tracer()
+
+    def work():
+        for _ in range(100):
+            with tracer.trace("outer"):
+                with tracer.trace("inner"):
+                    tracer.count("items")
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    summary = tracer.summary()
+    assert summary.keys() == {"outer", "outer/inner"}
+    assert summary["outer"]["invocations"] == 400
+    assert summary["outer/inner"]["counters"] == {"items": 400}
+
+
+def test_within_continues_nesting_in_another_thread():
+    tracer = Tracer()
+
+    def work(parent):
+        with tracer.within(parent):
+            with tracer.trace("stage"):
+                pass
+
+    with tracer.trace("file"):
+        thread = threading.Thread(target=work, args=(tracer.current(),))
+        thread.start()
+        thread.join()
+
+    assert tracer.current() is None
+    assert tracer.summary().keys() == {"file", "file/stage"}
+
+
+def _worker(i: int) -> dict:
+    tracer = Tracer()
+    with tracer.trace("work"):
+        tracer.count("bytes", i)
+    return tracer.snapshot()
+
+
+def test_merge_snapshots_from_worker_processes(tmp_path):
+    tracer = Tracer()
+    # spawn, as forking the multi-threaded test runner may deadlock
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=2, mp_context=context) as executor:
+        for snapshot in executor.map(_worker, range(1, 5)):
+            tracer.merge(snapshot)
+
+    summary = tracer.summary()
+    assert summary["work"]["invocations"] == 4
+    assert summary["work"]["counters"] == {"bytes": 10}
+
+    tracer.write_chrome_trace(tmp_path / "trace.json")
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert len(events) == 4
+    assert all(event["ph"] == "X" and event["name"] == "work" for event in events)
+
+    tracer.write_json(tmp_path / "summary.json")
+    assert json.loads((tmp_path / "summary.json").read_text()) == summary
@@ -0,0 +1,34 @@
+from matsemanns_streetview_tools import google_street_view as gsv
+from matsemanns_streetview_tools.transfer import Backoff
+from matsemanns_streetview_tools.upload_benchmark import (
+    format_results,
+    run_upload_benchmark,
+)
+
+
+def test_run_upload_benchmark(monkeypatch):
+    monkeypatch.setattr(gsv, "retry_backoff", Backoff(base=0.01))
+
+    results = run_upload_benchmark(
+        videos=2,
+        video_size_mib=4,
+        chunk_sizes_mib=(2, 4),
+        concurrencies=(1, 2),
+        latency=0.0,
+        failure_rate=0.2,
+        seed=1,
+    )
+
+    assert [(r.chunk_size_mib, r.concurrency) for r in results] == [
+        (2, 1),
+        (2, 2),
+        (4, 1),
+        (4, 2),
+    ]
+    for result in results:
+        assert result.failed_videos == 0
+        assert result.total_bytes == 2 * 4 * 1024 * 1024
+        assert result.throughput > 0
+        assert len(result.recovery_times) <= result.injected_failures
+    assert sum(r.injected_failures for r in results) > 0
+    assert len(format_results(results).splitlines()) == 5
@@ -0,0 +1,70 @@
+from datetime import timedelta
+
+from click.testing import CliRunner
+
+from matsemanns_streetview_tools import metadata
+from matsemanns_streetview_tools.benchmarks.generators import START, synthetic_track
+from matsemanns_streetview_tools.gpx import gpx_track_to_xml
+from matsemanns_streetview_tools.metadata import FfprobeMetadata
+from matsemanns_streetview_tools.scripts.google import google
+from matsemanns_streetview_tools.upload_preflight import preflight_videos
+
+
+def _write_gpx(file, seconds: int) -> None:
+    file.write_text(gpx_track_to_xml(synthetic_track(seconds + 1)))
+
+
+def _fake_ffprobe(monkeypatch) -> list:
+    probed = []
+
+    def get_ffprobe_metadata(video):
+        probed.append(video)
+        return FfprobeMetadata(
+            {"format": {"duration": "10", "tags": {"creation_time": START.isoformat()}}}
+        )
+
+    monkeypatch.setattr(metadata, "get_ffprobe_metadata", get_ffprobe_metadata)
+    return probed
+
+
+def test_preflight_videos(monkeypatch, tmp_path):
+    probed = _fake_ffprobe(monkeypatch)
+
+    videos = [tmp_path / f"{name}.mp4" for name in ["ok", "no_gpx", "short_gpx"]]
+    for video in videos:
+        video.write_bytes(b"video " + video.name.encode())
+    _write_gpx(tmp_path / "ok.gpx", 10)
+    _write_gpx(tmp_path / "short_gpx.gpx", 5)
+
+    ok, no_gpx, short_gpx = preflight_videos(videos)
+
+    assert ok.error is None
+    assert len(ok.gpx_track.points) == 11
+    assert ok.video_metadata.get_duration() == timedelta(seconds=10)
+    assert "Didn't find a gpx file" in no_gpx.error
+    assert "before video ends" in short_gpx.error
+    assert sorted(probed) == sorted([videos[0], videos[2]])
+
+    # The probe results are cached until the video changes
+    preflight_videos(videos)
+    assert len(probed) == 2
+    videos[0].write_bytes(b"changed")
+    preflight_videos(videos)
+    assert probed[2:] == [videos[0]]
+
+
+def test_upload_check_only(monkeypatch, tmp_path):
+    _fake_ffprobe(monkeypatch)
+    ok, short_gpx = tmp_path / "ok.mp4", tmp_path / "short_gpx.mp4"
+    for video in [ok, short_gpx]:
+        video.write_bytes(b"video")
+    _write_gpx(tmp_path / "ok.gpx", 10)
+    _write_gpx(tmp_path / "short_gpx.gpx", 5)
+
+    runner = CliRunner()
+    result = runner.invoke(google, ["upload", "--check-only", str(ok)])
+    assert result.exit_code == 0
+    result = runner.invoke(google, ["upload", "--check-only", str(ok), str(short_gpx)])
+    assert result.exit_code == 1
+    # Checking doesn't start any uploads
+    assert list(tmp_path.glob("*.upload.json")) == []
@@ -0,0 +1,91 @@
+import multiprocessing
+import os
+
+import pytest
+
+from matsemanns_streetview_tools import util
+from matsemanns_streetview_tools.util import (
+    DEBUG,
+    ERROR,
+    INFO,
+    add_file_logger,
+    close_logs,
+    flush_logs,
+    log,
+    log_enabled,
+    set_log_level,
+)
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    # Lines logged by earlier tests shouldn't end up in the file
+    flush_logs()
+    loggers = list(util.logger_impls)
+    file = tmp_path / "log.txt"
+    add_file_logger(file)
+    yield file
+    close_logs()
+    set_log_level(INFO)
+    util.logger_impls[:] = loggers
+
+
+def test_log_to_file_in_background(log_file):
+    for i in range(100):
+        log(f"line {i}")
+    flush_logs()
+
+    lines = log_file.read_text().splitlines()
+    assert len(lines) == 100
+    assert lines[0].startswith("[") and lines[0].endswith("] line 0")
+    assert lines[-1].endswith("] line 99")
+
+
+def test_log_levels(log_file):
+    log("hidden", DEBUG)
+    log("failed", ERROR)
+    set_log_level("DEBUG")
+    assert log_enabled(DEBUG)
+    log("shown", DEBUG)
+    close_logs()
+
+    lines = log_file.read_text().splitlines()
+    assert len(lines) == 2
+    assert lines[0].endswith("] ERROR: failed")
+    assert lines[1].endswith("] DEBUG: shown")
+
+
+def test_unknown_log_level(log_file, monkeypatch):
+    with pytest.raises(RuntimeError, match="Unknown log level LOUD"):
+        set_log_level("LOUD")
+
+    monkeypatch.setattr(util, "_log_level", None)
+    monkeypatch.setenv("LOG_LEVEL", "LOUD")
+    log("still logged")
+    close_logs()
+
+    lines = log_file.read_text().splitlines()
+    assert lines[0].endswith("] WARNING: Unknown log level LOUD, should be one of DEBUG, INFO, WARNING, ERROR, using INFO")  # fmt: skip
+    assert lines[1].endswith("] still logged")
+
+
+def _log_from_worker(i: int) -> int:
+    log(f"from worker {i}")
+    flush_logs()
+    return os.getpid()
+
+
+def test_log_from_worker_process(log_file):
+    log("before starting workers")
+    # spawn, as forking the multi-threaded test runner may deadlock. The workers
+    # get the log file from the environment instead of a copy of the loggers
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(2) as pool:
+        pids = pool.map(_log_from_worker, range(4))
+    flush_logs()
+
+    lines = log_file.read_text().splitlines()
+    assert lines[0].endswith("] before starting workers")
+    assert len(lines) == 5
+    for i, pid in enumerate(pids):
+        assert any(line.endswith(f"] ({pid}) from worker {i}") for line in lines)
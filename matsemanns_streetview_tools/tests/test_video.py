@@ -1,4 +1,27 @@
-from matsemanns_streetview_tools.video import _create_ffmpeg_frame_file_content
+import shutil
+from datetime import timedelta
+from decimal import Decimal
+
+import numpy as np
+import pytest
+from PIL import Image, ImageChops, ImageStat
+
+from matsemanns_streetview_tools.benchmarks.generators import START, synthetic_video
+from matsemanns_streetview_tools.gpx import GpxPoint, GpxTrack
+from matsemanns_streetview_tools.util import ffmpeg_path
+from matsemanns_streetview_tools.video import (
+    VideoEncoder,
+    _create_ffmpeg_frame_file_content,
+    calculate_frames_to_keep,
+    epoch_microseconds,
+    map_times_to_frames,
+    save_video_frames,
+    stream_video_frames,
+)
+
+needs_ffmpeg = pytest.mark.skipif(
+    shutil.which(ffmpeg_path()) is None, reason="ffmpeg not found"
+)
 
 
 def test_create_ffmpeg_frame_file_content():
@@ -9,3 +32,129 @@ def test_create_ffmpeg_frame_file_content():
 +eq(n,1000)'"""
 
     assert result == expected
+
+
+def _times(*seconds: float) -> np.ndarray:
+    return epoch_microseconds(START + timedelta(seconds=s) for s in seconds)
+
+
+def test_map_times_to_frames_rounding():
+    end = START + timedelta(seconds=10)
+    times = _times(0, 0.1, 0.11, 0.15, 1.0)
+
+    def frames(rounding):
+        return map_times_to_frames(
+            times, START, end, Decimal(30), rounding=rounding
+        ).frames.tolist()
+
+    # 0.1s is exactly frame 3, even if 0.1 * 30 isn't exactly 3 as floats
+    assert frames("next") == [0, 3, 4, 5, 30]
+    assert frames("previous") == [0, 3, 3, 4, 30]
+    assert frames("nearest") == [0, 3, 3, 5, 30]
+
+
+def test_map_times_to_frames_ntsc_framerate():
+    fps = Decimal(30000 / 1001)
+    end = START + timedelta(minutes=1)
+    # Frame 1000 of a 29.97 fps video is at 33.3666666.. seconds
+    times = _times(33.366666, 33.366667)
+    mapping = map_times_to_frames(times, START, end, fps)
+    assert mapping.frames.tolist() == [1000, 1001]
+    mapping = map_times_to_frames(times, START, end, fps, rounding="previous")
+    assert mapping.frames.tolist() == [999, 1000]
+
+
+def test_map_times_to_frames_duplicates_and_outside():
+    end = START + timedelta(seconds=10)
+    mapping = map_times_to_frames(
+        _times(-1, 1.0, 1.01, 1.02, 2.0, 11), START, end, Decimal(30)
+    )
+    assert mapping.duplicates.tolist() == [3]
+    assert mapping.outside.tolist() == [0, 5]
+
+
+def test_map_times_to_frames_variable_framerate():
+    frame_times_us = np.array([0, 0.5, 0.6, 0.7, 2.0, 2.1]) * 1_000_000
+    end = START + timedelta(seconds=3)
+    times = _times(0.58, 1.0, 1.5, 2.5)
+
+    def mapping(rounding):
+        return map_times_to_frames(
+            times, START, end, frame_times_us=frame_times_us, rounding=rounding
+        )
+
+    assert mapping("next").frames.tolist()[:3] == [2, 4, 4]
+    assert mapping("next").outside.tolist() == [3]
+    assert mapping("previous").frames.tolist() == [1, 3, 3, 5]
+    assert mapping("nearest").frames.tolist() == [2, 3, 4, 5]
+
+
+def test_calculate_frames_to_keep_outside_video():
+    points = [
+        GpxPoint(Decimal(0), Decimal(0), Decimal(0), START + timedelta(seconds=s))
+        for s in (1, 2, 20)
+    ]
+    track = GpxTrack("track", START, points)
+    with pytest.raises(RuntimeError, match="1 points outside video"):
+        calculate_frames_to_keep(
+            track, START, START + timedelta(seconds=10), Decimal(30)
+        )
+
+
+def _mean_difference(a, b) -> float:
+    return sum(ImageStat.Stat(ImageChops.difference(a, b)).mean)
+
+
+@needs_ffmpeg
+def test_stream_video_frames_and_encode(tmp_path):
+    video = synthetic_video(tmp_path / "video.mp4", seconds=2, width=320, height=160)
+
+    frames = [0, 15, 15, 59]
+    images = [image.copy() for image in stream_video_frames(video, frames, (320, 160))]
+    assert len(images) == 4
+    assert images[1].tobytes() == images[2].tobytes()
+    # The test pattern moves, so different frames differ a lot
+    assert _mean_difference(images[0], images[3]) > 20
+
+    with VideoEncoder(tmp_path / "out.mp4", (320, 160), START) as encoder:
+        for image in images:
+            encoder.write(image)
+    assert encoder.frames == 4
+
+    encoded = list(stream_video_frames(tmp_path / "out.mp4", [0, 3], (320, 160)))
+    assert _mean_difference(encoded[0], images[0]) < 10
+    assert _mean_difference(encoded[1], images[3]) < 10
+
+
+@needs_ffmpeg
+def test_save_video_frames_with_duplicates(tmp_path):
+    video = synthetic_video(tmp_path / "video.mp4", seconds=2, width=320, height=160)
+
+    frames = [0, 15, 15, 15, 59]
+    files = save_video_frames(video, tmp_path / "frames", frames, progressbar=False)
+
+    # Ffmpeg saves each frame once, the points sharing a frame share its file
+    assert sorted((tmp_path / "frames").glob("*.jpg")) == sorted(set(files))
+    assert [file.name for file in files] == [
+        "video-000001.jpg",
+        "video-000002.jpg",
+        "video-000002.jpg",
+        "video-000002.jpg",
+        "video-000003.jpg",
+    ]
+    # Each file is the frame it's for, closest to that frame from the stream
+    streamed = [
+        image.copy() for image in stream_video_frames(video, frames, (320, 160))
+    ]
+    for i, file in enumerate(files):
+        with Image.open(file) as saved:
+            differences = [_mean_difference(saved, image) for image in streamed]
+        assert frames[differences.index(min(differences))] == frames[i]
+
+
+@needs_ffmpeg
+def test_stream_video_frames_outside_video(tmp_path):
+    video = synthetic_video(tmp_path / "video.mp4", seconds=1, width=320, height=160)
+
+    with pytest.raises(RuntimeError, match="stopped before frame 100"):
+        list(stream_video_frames(video, [0, 100], (320, 160)))
@@ -0,0 +1,121 @@
+import multiprocessing
+import os
+import time
+
+from matsemanns_streetview_tools.work_queue import Task, WorkQueue, work
+
+
+def test_claim_gives_each_task_to_one_worker(tmp_path):
+    queue = WorkQueue.create(tmp_path, settings={"project": ".."})
+    queue.publish("a", {"file": "a.mp4"})
+    queue.publish("b", {"file": "b.mp4"})
+
+    other = WorkQueue(tmp_path)
+    first = queue.claim("worker-1")
+    second = other.claim("worker-2")
+    assert first and second
+    assert (first.id, second.id) == ("a", "b")
+    assert other.settings == {"project": ".."}
+    assert queue.claim("worker-1") is None
+    assert queue.counts() == (0, 2, 0)
+
+    queue.complete(first, {"output": 1})
+    other.complete(second, {"error": "broken"})
+    assert queue.all_done()
+    assert [r["data"]["file"] for r in queue.results()] == ["a.mp4", "b.mp4"]
+    assert queue.results()[1]["error"] == "broken"
+
+
+def test_expired_lease_is_given_to_another_worker(tmp_path):
+    queue = WorkQueue.create(tmp_path, settings={}, lease_seconds=10, max_attempts=2)
+    queue.publish("a", {})
+    task = queue.claim("dead-worker")
+    assert task
+    queue.heartbeat(task)
+    assert queue.claim("worker") is None
+
+    old = time.time() - 60
+    os.utime(tmp_path / "leases" / "a.json", (old, old))
+    retried = queue.claim("worker")
+    assert retried and retried.attempts == 1
+
+    os.utime(tmp_path / "leases" / "a.json", (old, old))
+    assert queue.claim("worker") is None
+    assert queue.all_done()
+    assert queue.results()[0]["error"] == "Lease expired too many times"
+
+
+def test_worker_that_lost_its_lease_keeps_off(tmp_path):
+    queue = WorkQueue.create(tmp_path, settings={}, lease_seconds=10)
+    queue.publish("a", {})
+    slow = queue.claim("slow-worker")
+    assert slow
+
+    old = time.time() - 60
+    os.utime(tmp_path / "leases" / "a.json", (old, old))
+    other = queue.claim("worker")
+    assert other
+
+    # Neither refreshes nor removes the new worker's lease, nor stores its result
+    lease = tmp_path / "leases" / "a.json"
+    mtime = lease.stat().st_mtime
+    assert not queue.heartbeat(slow)
+    assert not queue.complete(slow, {"output": "slow"})
+    assert lease.stat().st_mtime == mtime
+    assert queue.owns_lease(other)
+    assert not queue.all_done()
+
+    assert queue.complete(other, {"output": "other"})
+    assert [r["output"] for r in queue.results()] == ["other"]
+    assert not lease.exists()
+
+
+def test_work_stops_when_the_lease_is_lost(tmp_path):
+    queue = WorkQueue.create(tmp_path, settings={}, lease_seconds=0.4)
+    queue.publish("a", {})
+    other = WorkQueue(tmp_path)
+
+    def handle(task: Task) -> dict:
+        old = time.time() - 60
+        os.utime(tmp_path / "leases" / "a.json", (old, old))
+        assert other.claim("worker")
+        # The next heartbeat finds out
+        assert task.lease_lost.wait(timeout=5)
+        return {"output": "slow"}
+
+    assert work(queue, handle, "slow-worker", until=lambda: True) == 0
+    assert queue.results() == []
+    assert queue.counts() == (0, 1, 0)
+
+
+def _handle(task: Task) -> dict:
+    time.sleep(0.2)
+    if task.data["n"] == 3:
+        raise RuntimeError("Can't do 3")
+    return {"pid": os.getpid()}
+
+
+def _worker(folder):
+    work(WorkQueue(folder), _handle, f"worker-{os.getpid()}", poll_seconds=0.05)
+
+
+def test_work_with_several_processes(tmp_path):
+    queue = WorkQueue.create(tmp_path, settings={})
+    for n in range(12):
+        queue.publish(f"{n:02}", {"n": n})
+
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=_worker, args=(tmp_path,)) for _ in range(3)]
+    for process in workers:
+        process.start()
+    # The coordinator works as well, until all are done
+    work(queue, _handle, "coordinator", poll_seconds=0.05, until=queue.all_done)
+    queue.finish()
+    for process in workers:
+        process.join(timeout=30)
+        assert process.exitcode == 0
+
+    results = queue.results()
+    assert [r["data"]["n"] for r in results] == list(range(12))
+    assert [r["data"]["n"] for r in results if "error" in r] == [3]
+    assert len({r["worker"] for r in results}) > 1
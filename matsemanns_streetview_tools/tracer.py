@@ -1,40 +1,266 @@
-from contextlib import contextmanager
+import json
+import os
+import threading
 import time
-from typing import TypedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+# perf_counter is monotonic, but its zero point is arbitrary and differs between
+# processes. Anchor it to the wall clock, so spans from worker processes line up
+# in the exported trace.
+_clock_offset = time.time() - time.perf_counter()
+
+
+@dataclass
+class SpanStats:
+    invocations: int = 0
+    total_time: float = 0.0
+    durations: list[float] = field(default_factory=list)
+    counters: dict[str, float] = field(default_factory=dict)
+
+    def percentile(self, p: float) -> float:
+        """Nearest rank percentile of the durations, p between 0 and 100"""
+        if not self.durations:
+            return 0.0
+        ordered = sorted(self.durations)
+        rank = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))
+        return ordered[rank]
+
+    def record(self, time_used: float, invocations: int) -> None:
+        """time_used spread evenly over the invocations. With no invocations, it's
+        only added to the total"""
+        self.invocations += invocations
+        self.total_time += time_used
+        if invocations:
+            self.durations.extend([time_used / invocations] * invocations)
+
+    def merge(self, other: "SpanStats") -> None:
+        self.invocations += other.invocations
+        self.total_time += other.total_time
+        self.durations.extend(other.durations)
+        for name, amount in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+
+class Tracer:
+    """Collects how long the stages of the program take. Spans can be nested, and
+    are named by their path, like "file/extract frames". Every duration is kept, so
+    it's possible to see p50/p95/max and not only the average, which hides the
+    few slow ones. Counters (bytes, frames, ...) are added to the innermost span.
+
+    Safe to use from multiple threads, each thread has its own nesting. Worker
+    processes can send their snapshot() back, to be merge()'d into the parent.
+    """
+
+    def __init__(self):
+        self.spans: dict[str, SpanStats] = {}
+        # Complete events (name, start, duration, pid, tid) for the chrome trace
+        self.events: list[tuple[str, float, float, int, int]] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self) -> list[str]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _path(self, name: str) -> str:
+        stack = self._stack()
+        return f"{stack[-1]}/{name}" if stack else name
+
+    def current(self) -> str | None:
+        """The innermost span of this thread"""
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def within(self, path: str | None):
+        """Nests the spans of this thread under a span from another thread, for
+        work handed off to a thread pool"""
+        stack = self._stack()
+        if path is None:
+            yield
+            return
+        stack.append(path)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.spans.clear()
+            self.events.clear()
+
+    def add(self, trace: str, time_used: float, invocations: int = 1) -> None:
+        """Adds time used outside of a span, spread evenly over the invocations"""
+        path = self._path(trace)
+        with self._lock:
+            self.spans.setdefault(path, SpanStats()).record(time_used, invocations)
+
+    def count(self, counter: str, amount: float = 1) -> None:
+        stack = self._stack()
+        path = stack[-1] if stack else ""
+        with self._lock:
+            counters = self.spans.setdefault(path, SpanStats()).counters
+            counters[counter] = counters.get(counter, 0) + amount
+
+    @contextmanager
+    def trace(self, trace: str, invocations: int = 1):
+        path = self._path(trace)
+        stack = self._stack()
+        stack.append(path)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            time_used = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                stats = self.spans.setdefault(path, SpanStats())
+                stats.record(time_used, invocations)
+                self.events.append(
+                    (
+                        path,
+                        _clock_offset + start,
+                        time_used,
+                        os.getpid(),
+                        threading.get_ident(),
+                    )
+                )
+
+    def snapshot(self) -> dict:
+        """Everything collected, as plain data that can be pickled or stored"""
+        with self._lock:
+            return {
+                "spans": {
+                    path: {
+                        "invocations": stats.invocations,
+                        "total_time": stats.total_time,
+                        "durations": list(stats.durations),
+                        "counters": dict(stats.counters),
+                    }
+                    for path, stats in self.spans.items()
+                },
+                "events": list(self.events),
+            }
 
+    def merge(self, snapshot: dict) -> None:
+        with self._lock:
+            for path, data in snapshot["spans"].items():
+                stats = self.spans.setdefault(path, SpanStats())
+                stats.merge(SpanStats(**data))
+            self.events.extend(tuple(event) for event in snapshot["events"])
 
-class TraceEntry(TypedDict):
-    invocations: int
-    total_time: float
+    def summary(self) -> dict:
+        """Per span stats, without all the durations"""
+        with self._lock:
+            return {
+                path: {
+                    "invocations": stats.invocations,
+                    "total_time": stats.total_time,
+                    "avg": stats.total_time / stats.invocations
+                    if stats.invocations
+                    else 0.0,
+                    "p50": stats.percentile(50),
+                    "p95": stats.percentile(95),
+                    "max": max(stats.durations, default=0.0),
+                    "counters": dict(stats.counters),
+                }
+                for path, stats in self.spans.items()
+            }
 
+    def out(self) -> str:
+        def render(path: str, entry: dict) -> str:
+            name = path.rsplit("/", 1)[-1] or "(no span)"
+            name = ("  " * path.count("/") + name).ljust(24)
+            counters = "".join(
+                f", {counter}: {amount:g}"
+                for counter, amount in entry["counters"].items()
+            )
+            if not entry["invocations"]:
+                return f"{name}{counters.removeprefix(', ')}"
+            return (
+                f"{name} invocations: {entry['invocations']:>4},"
+                f"    total_time: {entry['total_time']:>8.2f}s"
+                f" ({entry['avg']:.2f}s avg, p50 {entry['p50']:.2f}s,"
+                f" p95 {entry['p95']:.2f}s, max {entry['max']:.2f}s){counters}"
+            )
 
-_traces: dict[str, TraceEntry] = {}
+        # Sorting by the path parts puts the nested spans right after their parent
+        summary = self.summary()
+        paths = sorted(summary, key=lambda path: path.split("/"))
+        traces = "\n".join(render(path, summary[path]) for path in paths)
+        return f"Traces:\n{traces}"
+
+    def write_json(self, file: Path) -> None:
+        file.write_text(json.dumps(self.summary(), indent=2))
+
+    def write_chrome_trace(self, file: Path) -> None:
+        """Can be opened in chrome://tracing or https://ui.perfetto.dev"""
+        with self._lock:
+            events = [
+                {
+                    "name": path.rsplit("/", 1)[-1],
+                    "cat": path,
+                    "ph": "X",
+                    "ts": start * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": pid,
+                    "tid": tid,
+                }
+                for path, start, duration, pid, tid in self.events
+            ]
+        file.write_text(json.dumps({"traceEvents": events}))
+
+
+_tracer = Tracer()
 
 
 def clear():
-    _traces.clear()
+    _tracer.clear()
+
+
+def add(trace: str, time_used: float, invocations: int = 1):
+    _tracer.add(trace, time_used, invocations)
+
+
+def count(counter: str, amount: float = 1):
+    _tracer.count(counter, amount)
+
+
+def trace(trace: str, invocations: int = 1):
+    return _tracer.trace(trace, invocations)
 
 
-def add(trace: str, time_used: float, invocations):
-    value = _traces.setdefault(trace, {"invocations": 0, "total_time": 0})
-    value["invocations"] += 1
-    value["total_time"] += time_used
+def current() -> str | None:
+    return _tracer.current()
+
+
+def within(path: str | None):
+    return _tracer.within(path)
+
+
+def snapshot() -> dict:
+    return _tracer.snapshot()
+
+
+def merge(snapshot: dict):
+    _tracer.merge(snapshot)
+
+
+def summary() -> dict:
+    return _tracer.summary()
 
 
 def out() -> str:
-    def render(name: str, trace_entry: TraceEntry) -> str:
-        invocations = str(trace_entry["invocations"]).rjust(4)
-        total_time = f"{trace_entry["total_time"]:.2f}".rjust(9)
-        avg = f"{(trace_entry["total_time"] / trace_entry["invocations"]):.2f}"
-        return f"{name.ljust(20)} invocations: {invocations},    total_time: {total_time}s ({avg}s avg)"
+    return _tracer.out()
 
-    traces = "\n".join([render(k, v) for k, v in _traces.items()])
-    return f"Traces:\n{traces}"
 
+def write_json(file: Path):
+    _tracer.write_json(file)
 
-@contextmanager
-def trace(trace: str, invocations: int = 1):
-    start = time.time()
-    yield
-    time_used = time.time() - start
-    add(trace, time_used, invocations)
+
+def write_chrome_trace(file: Path):
+    _tracer.write_chrome_trace(file)
@@ -0,0 +1,177 @@
+import random
+import threading
+import time
+from dataclasses import dataclass
+
+MiB = 1024 * 1024
+
+# Statuses that mean "try again later", others won't get better by retrying
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Limits the throughput of everything consuming from it, like a shared bandwidth
+    limit for multiple uploads running in parallel threads.
+
+    Allows bursts of up to capacity bytes (default one second worth), after that
+    consume blocks until enough tokens have been refilled at rate bytes per second.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self, amount: int) -> float:
+        """Takes the tokens, and returns how long to wait before using them.
+        For when the waiting can't block, like in asyncio."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last_refill) * self.rate
+            )
+            self._last_refill = now
+            # Go into debt and sleep it off outside the lock, so other threads queue
+            # up behind with their own (longer) waits instead of all waking at once
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+
+class ThrottledBody:
+    """Request body that sends the data through a token bucket.
+    Requests/http.client reads file-like bodies in blocks, so each block waits
+    for its share of the bandwidth before it's sent. With a memoryview as data,
+    the blocks are slices of it and never copied."""
+
+    def __init__(self, data: bytes | memoryview, bucket: TokenBucket):
+        self._data = data
+        self._bucket = bucket
+        self._position = 0
+
+    def __len__(self) -> int:
+        return len(self._data) - self._position
+
+    def read(self, size: int = -1) -> bytes | memoryview:
+        if size < 0:
+            size = len(self)
+        block = self._data[self._position : self._position + size]
+        self._position += len(block)
+        if block:
+            self._bucket.consume(len(block))
+        return block
+
+
+@dataclass
+class Backoff:
+    """Exponential backoff between retries, with jitter so parallel uploads hitting the
+    same problem don't all retry at the same moment.
+    Attempt n waits between half and all of min(cap, base * 2^n) seconds."""
+
+    base: float = 2.0
+    cap: float = 60.0
+    attempts: int = 10
+
+    def delay(self, attempt: int) -> float:
+        delay = min(self.cap, self.base * 2**attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+class TransferController:
+    """Controls the chunks of one upload.
+
+    Adjusts the chunk size to the measured throughput, so each request takes around
+    target_seconds. Gives few, large requests on a fast connection and keeps small
+    requests far from the timeout on a slow one. A failed chunk halves the size, and it
+    doesn't grow again until a couple of chunks have gone through, so a flaky connection
+    doesn't resend huge chunks. Sizes are kept to multiples of granularity, between
+    minimum and maximum.
+
+    Also waits between retries using the backoff, and keeps stats of the transfer.
+    """
+
+    stable_chunks = 2
+
+    def __init__(
+        self,
+        initial: int,
+        maximum: int,
+        minimum: int = 2 * MiB,
+        granularity: int = 2 * MiB,
+        target_seconds: float = 10.0,
+        backoff: Backoff | None = None,
+    ):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.granularity = granularity
+        self.target_seconds = target_seconds
+        self.backoff = backoff or Backoff()
+        self.throughput: float | None = None  # bytes per second
+        self.size = self._clamp(initial)
+        self._chunks_since_failure = self.stable_chunks
+
+        self.started = time.monotonic()
+        self.bytes_acknowledged = 0
+        self.bytes_failed = 0
+        self.failures = 0
+        self.seconds_waited = 0.0
+
+    def _clamp(self, size: float) -> int:
+        size = int(size) // self.granularity * self.granularity
+        return min(self.maximum, max(self.minimum, size))
+
+    def record(self, size: int, seconds: float) -> None:
+        """A chunk of size bytes was sent and acknowledged in seconds"""
+        self.bytes_acknowledged += size
+        self._chunks_since_failure += 1
+
+        throughput = size / max(seconds, 0.001)
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            # Slow down right away (that's when timeouts happen), speed up gradually
+            self.throughput = min(throughput, 0.7 * self.throughput + 0.3 * throughput)
+
+        # At most double each time, so one lucky measurement can't give a huge chunk
+        wanted = min(self.throughput * self.target_seconds, self.size * 2)
+        if self._chunks_since_failure < self.stable_chunks:
+            wanted = min(wanted, self.size)
+        self.size = self._clamp(wanted)
+
+    def failed(self, size: int) -> None:
+        """Sending a chunk of size bytes failed"""
+        self.failures += 1
+        self.bytes_failed += size
+        self._chunks_since_failure = 0
+        if self.throughput is not None:
+            self.throughput /= 2
+        self.size = self._clamp(self.size // 2)
+
+    def wait(self, attempt: int) -> None:
+        time.sleep(self.delay(attempt))
+
+    def delay(self, attempt: int) -> float:
+        """How long to wait before retry attempt, counted as waited.
+        For when the waiting can't block, like in asyncio."""
+        delay = self.backoff.delay(attempt)
+        self.seconds_waited += delay
+        return delay
+
+    @property
+    def effective_throughput(self) -> float:
+        """Acknowledged bytes per second, including time lost to failures and waiting"""
+        return self.bytes_acknowledged / max(time.monotonic() - self.started, 0.001)
+
+    def summary(self) -> str:
+        return (
+            f"{self.bytes_acknowledged / MiB:.1f} MiB"
+            f" at {self.effective_throughput / MiB:.2f} MiB/s,"
+            f" {self.failures} failed chunks ({self.bytes_failed / MiB:.1f} MiB),"
+            f" waited {self.seconds_waited:.0f}s"
+        )
@@ -0,0 +1,161 @@
+import itertools
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from google.oauth2.credentials import Credentials
+
+from matsemanns_streetview_tools import google_street_view as gsv
+from matsemanns_streetview_tools.benchmarks.generators import START, synthetic_track
+from matsemanns_streetview_tools.gpx import gpx_track_to_xml
+from matsemanns_streetview_tools.mock_street_view import MockStreetViewServer
+from matsemanns_streetview_tools.transfer import MiB
+from matsemanns_streetview_tools.upload_journal import UploadJournal
+from matsemanns_streetview_tools.upload_preflight import gpx_file_for_video
+
+_DURATION_SECONDS = 60
+
+
+@dataclass
+class BenchmarkResult:
+    chunk_size_mib: int
+    max_chunk_size_mib: int | None
+    concurrency: int
+    total_bytes: int
+    seconds: float
+    failed_videos: int
+    injected_failures: int
+    recovery_times: list[float]
+
+    @property
+    def throughput(self) -> float:
+        """MiB/s"""
+        return self.total_bytes / MiB / self.seconds
+
+    @property
+    def mean_recovery_seconds(self) -> float | None:
+        if not self.recovery_times:
+            return None
+        return sum(self.recovery_times) / len(self.recovery_times)
+
+
+def _create_videos(folder: Path, count: int, size_mib: int) -> list[Path]:
+    """Random data as videos, with a gpx covering them"""
+    gpx_xml = gpx_track_to_xml(synthetic_track(_DURATION_SECONDS + 1))
+
+    videos = []
+    for i in range(count):
+        video = folder / f"video_{i}.mp4"
+        with open(video, "wb") as f:
+            for _ in range(size_mib):
+                f.write(os.urandom(MiB))
+        gpx_file_for_video(video).write_text(gpx_xml)
+        videos.append(video)
+    return videos
+
+
+def _reset_journals(videos: list[Path]) -> None:
+    """Starts each run from scratch. The ffprobe result is put in the journal up front,
+    as the random data isn't a video ffprobe can read"""
+    for video in videos:
+        UploadJournal.journal_file(video).unlink(missing_ok=True)
+        journal = UploadJournal.load(video)
+        journal.ffprobe = {
+            "format": {
+                "duration": str(_DURATION_SECONDS),
+                "tags": {"creation_time": START.isoformat()},
+            }
+        }
+        journal.save()
+
+
+def run_upload_benchmark(
+    videos: int = 4,
+    video_size_mib: int = 64,
+    chunk_sizes_mib: tuple[int, ...] = (2, 8, 16),
+    concurrencies: tuple[int, ...] = (1, 2, 4),
+    max_chunk_size_mib: int | None = None,
+    latency: float = 0.05,
+    bandwidth_mib_per_second: float | None = None,
+    failure_rate: float = 0.0,
+    seed: int = 0,
+) -> list[BenchmarkResult]:
+    """Uploads synthetic videos to a local MockStreetViewServer, once for each
+    combination of chunk size and concurrency, and measures the throughput and how
+    long it takes to recover from failed chunks. The server is set up with the given
+    latency, bandwidth and failure rate, to compare settings for a given network
+    without using the real api."""
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        files = _create_videos(Path(folder), videos, video_size_mib)
+        total_bytes = sum(os.path.getsize(file) for file in files)
+
+        for chunk_size, concurrency in itertools.product(
+            chunk_sizes_mib, concurrencies
+        ):
+            _reset_journals(files)
+            server = MockStreetViewServer(
+                latency=latency,
+                bandwidth=bandwidth_mib_per_second * MiB
+                if bandwidth_mib_per_second
+                else None,
+                failure_rate=failure_rate,
+                seed=seed,
+            )
+            previous_url = os.environ.get("STREETVIEW_API_URL")
+            with server:
+                os.environ["STREETVIEW_API_URL"] = server.api_url
+                try:
+                    start = time.perf_counter()
+                    failed = gsv.upload_streetview_videos(
+                        files,
+                        chunk_size_mib=chunk_size,
+                        max_chunk_size_mib=max(max_chunk_size_mib, chunk_size)
+                        if max_chunk_size_mib
+                        else None,
+                        concurrency=concurrency,
+                        credentials=Credentials("benchmark"),
+                    )
+                    seconds = time.perf_counter() - start
+                finally:
+                    if previous_url is None:
+                        del os.environ["STREETVIEW_API_URL"]
+                    else:
+                        os.environ["STREETVIEW_API_URL"] = previous_url
+
+            results.append(
+                BenchmarkResult(
+                    chunk_size_mib=chunk_size,
+                    max_chunk_size_mib=max_chunk_size_mib,
+                    concurrency=concurrency,
+                    total_bytes=total_bytes,
+                    seconds=seconds,
+                    failed_videos=len(failed),
+                    injected_failures=server.injected_failures,
+                    recovery_times=server.recovery_times,
+                )
+            )
+
+    return results
+
+
+def format_results(results: list[BenchmarkResult]) -> str:
+    lines = [
+        "chunk MiB  concurrency  seconds   MiB/s  failures  recovery s  failed videos"
+    ]
+    for r in results:
+        chunk = f"{r.chunk_size_mib}"
+        if r.max_chunk_size_mib:
+            chunk += f"-{max(r.max_chunk_size_mib, r.chunk_size_mib)}"
+        recovery = (
+            f"{r.mean_recovery_seconds:.2f}"
+            if r.mean_recovery_seconds is not None
+            else "-"
+        )
+        lines.append(
+            f"{chunk:>9}  {r.concurrency:>11}  {r.seconds:>7.2f}  {r.throughput:>6.1f}"
+            f"  {r.injected_failures:>8}  {recovery:>10}  {r.failed_videos:>13}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,62 @@
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from matsemanns_streetview_tools.util import file_fingerprint, log
+
+
+@dataclass
+class UploadJournal:
+    """How far the upload of a video has come, stored next to it as
+    <video>.upload.json after every step. Makes it possible to continue an upload
+    after the process has been stopped, instead of sending everything again.
+
+    status is "new" -> "uploading" -> "uploaded" (finalized) -> "published"
+    Also keeps the ffprobe output of the video, so it's only probed once.
+    """
+
+    video: Path
+    fingerprint: str
+    status: str = "new"
+    upload_url: str | None = None
+    resumable_url: str | None = None
+    bytes_uploaded: int = 0
+    sequence_id: str | None = None
+    ffprobe: dict | None = None
+
+    @staticmethod
+    def journal_file(video: Path) -> Path:
+        return video.parent / f"{video.name}.upload.json"
+
+    @classmethod
+    def load(cls, video: Path) -> "UploadJournal":
+        """The stored journal for the video, or a new one if there is none or
+        the video has changed since it was written"""
+        fingerprint = file_fingerprint(video)
+        file = cls.journal_file(video)
+        if file.exists():
+            data = json.loads(file.read_text())
+            if data.get("fingerprint") == fingerprint:
+                data["video"] = video
+                return cls(**data)
+            log(f"{video} has changed since last upload attempt, starting over")
+
+        return cls(video=video, fingerprint=fingerprint)
+
+    def save(self) -> None:
+        data = asdict(self)
+        del data["video"]
+        # Write and rename, so a crash never leaves a half written journal
+        file = self.journal_file(self.video)
+        tmp_file = file.with_suffix(".tmp")
+        tmp_file.write_text(json.dumps(data, indent=2))
+        os.replace(tmp_file, file)
+
+    def reset(self) -> None:
+        """Forget the upload, for when google no longer accepts it"""
+        self.status = "new"
+        self.upload_url = None
+        self.resumable_url = None
+        self.bytes_uploaded = 0
+        self.sequence_id = None
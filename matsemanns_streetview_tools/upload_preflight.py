@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import timedelta
+from functools import partial
+from pathlib import Path
+
+from matsemanns_streetview_tools import metadata
+from matsemanns_streetview_tools.gpx import GpxTrack, read_gpx_file
+from matsemanns_streetview_tools.metadata import FfprobeMetadata
+from matsemanns_streetview_tools.upload_journal import UploadJournal
+from matsemanns_streetview_tools.util import log
+
+
+@dataclass
+class PreflightResult:
+    video: Path
+    gpx_track: GpxTrack | None = None
+    video_metadata: FfprobeMetadata | None = None
+    error: str | None = None
+
+
+def gpx_file_for_video(video: Path) -> Path:
+    return video.parent / f"{video.stem}.gpx"
+
+
+def verify_valid_gpx_for_video(
+    video_metadata: FfprobeMetadata, gpx_track: GpxTrack
+) -> None:
+    video_start = video_metadata.get_creation_time()
+    video_end = video_start + video_metadata.get_duration()
+
+    gpx_start = gpx_track.points[0].utc_time
+    gpx_end = gpx_track.points[-1].utc_time
+    # A small delta to handle that video time is in whole seconds
+    if gpx_start > video_start + timedelta(seconds=1):
+        raise RuntimeError(
+            f"Gpx file starts at {gpx_start}, which is after video starts ({video_start})"
+        )
+    if video_end > gpx_end + timedelta(seconds=1):
+        raise RuntimeError(
+            f"Gpx file ends at {gpx_end}, which is before video ends ({video_end})"
+        )
+
+
+def _cached_ffprobe_metadata(video: Path, save: bool = True) -> FfprobeMetadata:
+    """ffprobe is the slow part of checking a video, so the result is kept in the
+    upload journal, and only probed again if the video changes. Without save, an
+    earlier result is used but a new one isn't kept"""
+    journal = UploadJournal.load(video)
+    if journal.ffprobe is None:
+        journal.ffprobe = metadata.get_ffprobe_metadata(video).data
+        if save:
+            journal.save()
+    return FfprobeMetadata(journal.ffprobe)
+
+
+def preflight_video(video: Path, save: bool = True) -> PreflightResult:
+    """Checks that the video can be uploaded: it has a gpx file matching its name,
+    and the gpx covers the whole video. save is if the probed metadata is kept in
+    the upload journal"""
+    try:
+        gpx_path = gpx_file_for_video(video)
+        if not gpx_path.exists():
+            raise RuntimeError(f"Didn't find a gpx file named {gpx_path}")
+        gpx_track = read_gpx_file(gpx_path)
+        if not gpx_track.points:
+            raise RuntimeError(f"Gpx file {gpx_path} has no points")
+
+        video_metadata = _cached_ffprobe_metadata(video, save)
+        verify_valid_gpx_for_video(video_metadata, gpx_track)
+        return PreflightResult(video, gpx_track, video_metadata)
+    except Exception as err:
+        return PreflightResult(video, error=str(err))
+
+
+def preflight_videos(
+    videos: list[Path], max_workers: int | None = None, save: bool = True
+) -> list[PreflightResult]:
+    """Checks all the videos in parallel, and logs all problems found at once.
+    Returns a result for each video, in the same order"""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(partial(preflight_video, save=save), videos))
+
+    problems = [result for result in results if result.error]
+    log(f"Checked {len(videos)} videos, found {len(problems)} with problems")
+    for result in problems:
+        log(f"  {result.video}: {result.error}")
+
+    return results
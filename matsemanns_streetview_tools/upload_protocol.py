@@ -0,0 +1,169 @@
+import mmap
+import os
+from collections.abc import Callable, Iterator, Mapping
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from pathlib import Path
+
+from tqdm import tqdm
+
+from matsemanns_streetview_tools.transfer import TransferController
+from matsemanns_streetview_tools.upload_journal import UploadJournal
+from matsemanns_streetview_tools.util import DEBUG, log, log_enabled
+
+# The resumable upload protocol of the Street View Publish API, without doing any
+# requests or file writes, so both google_street_view (requests, threads) and
+# google_street_view_async (httpx, asyncio) use the same logic.
+# Based on https://developers.google.com/streetview/publish/resumable-uploads
+
+QUERY_HEADERS = {"X-Goog-Upload-Command": "query"}
+
+
+def upload_status(headers: Mapping[str, str]) -> tuple[str, int]:
+    """The status of an upload, and how many bytes google has received, from the
+    response headers of a query"""
+    return headers["X-Goog-Upload-Status"], int(headers["X-Goog-Upload-Size-Received"])
+
+
+def continue_from_status(
+    journal: UploadJournal, status: str | None, received: int
+) -> None:
+    """Updates the journal of an earlier upload from what google says about it, so
+    the upload continues from there, or starts over if it's gone. status is None if
+    the upload couldn't be queried"""
+    if status == "active":
+        log(f"Continuing earlier upload of {journal.video} from byte {received}")
+        journal.bytes_uploaded = received
+    elif status == "final":
+        journal.status = "uploaded"
+    else:
+        log(f"Earlier upload of {journal.video} can't be continued, starting over")
+        journal.reset()
+
+
+class UploadAttempt:
+    """One try at uploading a video, reporting its progress to a bar shared by all the
+    uploads. What it reported is taken back out if it fails, as the next try starts
+    over. lock is for when the uploads run in threads"""
+
+    def __init__(
+        self, video: Path, pbar: tqdm, lock: AbstractContextManager | None = None
+    ):
+        self.video = video
+        self.pbar = pbar
+        self.lock = lock or nullcontext()
+        self.reported = 0
+
+    def progress(self, n: int) -> None:
+        self.reported += n
+        with self.lock:
+            self.pbar.update(n)
+
+    def failed(self, err: Exception, attempt: int, retries: int) -> None:
+        log(f"Something went wrong uploading {self.video}, {err}")
+        with self.lock:
+            self.pbar.update(-self.reported)
+        if attempt < retries:
+            log(f"Retrying {self.video} ({attempt + 1}/{retries})")
+
+
+@contextmanager
+def mapped_video(video: Path) -> Iterator[memoryview]:
+    """The video mapped into memory, so the chunks are sent straight from the page
+    cache without copying them into new bytes objects first. The chunks taken from
+    it have to be released before leaving, or the map can't be closed"""
+    with open(video, "rb") as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    with mapped, memoryview(mapped) as view:
+        yield view
+
+
+class ChunkedUpload:
+    """Step 2 of an upload, the video sent in chunks to the resumable url. Keeps track
+    of how far it has come in the journal and picks the chunks, while the caller does
+    the requests and saves the journal after each of them:
+
+    with mapped_video(video) as view:
+        while not upload.done:
+            with upload.next_chunk(view) as chunk:
+                send chunk with upload.chunk_headers(chunk), then upload.sent(...)
+                or on failure upload.failed(chunk) and upload.resumed(...)
+            save the journal, then upload.report_progress()
+    """
+
+    def __init__(
+        self,
+        journal: UploadJournal,
+        controller: TransferController,
+        progress: Callable[[int], None],
+    ):
+        self.journal = journal
+        self.controller = controller
+        self.progress = progress
+        self.reported = 0
+        self.total_bytes = os.path.getsize(journal.video)
+        if self.total_bytes == 0:
+            # Can't be mapped, and there's nothing to upload anyways
+            raise RuntimeError(f"{journal.video} is empty")
+
+    def start_headers(self) -> dict[str, str]:
+        """For telling google we want to upload in chunks, to journal.upload_url"""
+        return {
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Header-Content-Length": str(self.total_bytes),
+            "X-Goog-Upload-Header-Content-Type": "video/mp4",
+            "X-Goog-Upload-Command": "start",
+        }
+
+    def started(self, headers: Mapping[str, str]) -> None:
+        self.journal.resumable_url = headers["X-Goog-Upload-URL"]
+        self.journal.bytes_uploaded = 0
+
+    @property
+    def done(self) -> bool:
+        return self.journal.bytes_uploaded >= self.total_bytes
+
+    def next_chunk(self, view: memoryview) -> memoryview:
+        start = self.journal.bytes_uploaded
+        return view[start : min(start + self.controller.size, self.total_bytes)]
+
+    def chunk_headers(self, chunk: memoryview) -> dict[str, str]:
+        chunk_end = self.journal.bytes_uploaded + len(chunk)
+        # If it's the last chunk to upload, different header command
+        command = "upload, finalize" if chunk_end == self.total_bytes else "upload"
+        return {
+            "X-Goog-Upload-Offset": str(self.journal.bytes_uploaded),
+            "X-Goog-Upload-Command": command,
+            "Content-Length": str(len(chunk)),
+        }
+
+    def sent(self, chunk: memoryview, seconds: float) -> None:
+        """The chunk was acknowledged after seconds"""
+        self.controller.record(len(chunk), seconds)
+        self.journal.bytes_uploaded += len(chunk)
+        if self.done:
+            self.journal.status = "uploaded"
+        if log_enabled(DEBUG):
+            log(f"Uploaded {self.journal.bytes_uploaded / 1024 / 1024:.1f} MiB", DEBUG)
+
+    def failed(self, chunk: memoryview, err: Exception) -> None:
+        """Sending the chunk failed in a way worth retrying"""
+        log(f"Something went wrong uploading a chunk {err}, will try to resume")
+        self.controller.failed(len(chunk))
+
+    def resumed(self, status: str, received: int) -> None:
+        """Google's status of the upload after a failed chunk, the upload continues
+        from what it has received"""
+        if status != "active":
+            log("Upload is no longer active, aborting")
+            raise RuntimeError("Upload no longer active")
+        self.journal.bytes_uploaded = received
+        log(f"Success, resuming upload from byte {received}")
+
+    def report_progress(self) -> None:
+        """Reports what has been uploaded since last time, which is negative if google
+        lost some of it. Done after the journal is saved, so what's reported is
+        never lost when the process is stopped"""
+        uploaded = self.journal.bytes_uploaded - self.reported
+        if uploaded:
+            self.progress(uploaded)
+            self.reported += uploaded
@@ -1,36 +1,213 @@
+import atexit
+import hashlib
+import os
+import queue
+import sys
+import threading
+import time
 from datetime import datetime, timezone
 from os import environ
+from functools import cache
 from pathlib import Path
-from dotenv import load_dotenv
 
 
-def _log_tqdm():
-    from tqdm import tqdm
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+_level_names = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+# From LOG_LEVEL, read on the first log
+_log_level: int | None = None
 
-    def logger(str):
-        tqdm.write(str)
 
-    return logger
+class _TqdmLogger:
+    def write(self, lines: list[str]) -> None:
+        from tqdm import tqdm
 
+        for line in lines:
+            tqdm.write(line)
 
-logger_impls = [_log_tqdm()]
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class _FileLogger:
+    def __init__(self, file: Path):
+        self.file_handle = open(file, "a")
+
+    def write(self, lines: list[str]) -> None:
+        self.file_handle.write("".join(line + "\n" for line in lines))
+
+    def flush(self) -> None:
+        self.file_handle.flush()
+
+    def close(self) -> None:
+        self.file_handle.close()
+
+
+logger_impls: list = [_TqdmLogger()]
+
+
+class _LogWriter:
+    """Formats and writes the log lines on a background thread, so log() only has
+    to put the message on a queue. Everything waiting is written in one batch, with
+    a single flush per batch.
+
+    A worker process gets a new queue and thread, and its lines are marked with its
+    pid. The lock is held while writing and while forking, so a fork never copies
+    half written lines."""
+
+    max_batch = 1000
+
+    def __init__(self):
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+
+    def put(self, record) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name="log-writer", daemon=True
+            )
+            self.thread.start()
+        self.queue.put(record)
+
+    def flush(self, timeout: float = 5.0) -> None:
+        """Waits until everything logged so far is written"""
+        if self.thread is None:
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def after_fork_in_child(self) -> None:
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _run(self) -> None:
+        import multiprocessing
+
+        worker = multiprocessing.parent_process() is not None
+        pid = f" ({os.getpid()})" if worker else ""
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.max_batch:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            done = []
+            for record in records:
+                if isinstance(record, threading.Event):
+                    done.append(record)
+                    continue
+                created, level, message = record
+                prefix = "" if level == INFO else f"{_level_name(level)}: "
+                lines.append(
+                    f"[{datetime.fromtimestamp(created)}]{pid} {prefix}{message}"
+                )
+
+            with self.lock:
+                for logger in logger_impls:
+                    try:
+                        if lines:
+                            logger.write(lines)
+                            logger.flush()
+                    except Exception as e:
+                        print(f"Failed writing log: {e}", file=sys.stderr)
+            for event in done:
+                event.set()
+
+
+_writer = _LogWriter()
+os.register_at_fork(
+    before=lambda: _writer.lock.acquire(),
+    after_in_parent=lambda: _writer.lock.release(),
+    after_in_child=_writer.after_fork_in_child,
+)
+
+
+def _level_name(level: int) -> str:
+    return next((k for k, v in _level_names.items() if v == level), str(level))
+
+
+def set_log_level(level: int | str) -> None:
+    """Messages below this level are dropped before doing anything with them"""
+    global _log_level
+    if isinstance(level, str):
+        if level.upper() not in _level_names:
+            names = ", ".join(_level_names)
+            raise RuntimeError(f"Unknown log level {level}, should be one of {names}")
+        level = _level_names[level.upper()]
+    _log_level = level
+
+
+def _min_level() -> int:
+    if _log_level is None:
+        try:
+            set_log_level(_env("LOG_LEVEL", "INFO"))
+        except RuntimeError as e:
+            set_log_level(INFO)
+            log(f"{e}, using INFO", WARNING)
+    return _log_level  # type: ignore
+
+
+def log_enabled(level: int) -> bool:
+    """For skipping building expensive messages that won't be logged"""
+    return level >= _min_level()
+
+
+# Worker processes started with spawn (the default on macOS and Windows) import this
+# module again instead of getting a copy of the loggers like with fork. The log files
+# are passed on to them in the environment, so their lines end up there as well.
+_LOG_FILES_ENV = "STREETVIEW_TOOLS_LOG_FILES"
 
 
 def add_file_logger(file: Path):
     file.touch()
-    file_handle = open(file, "a")
+    logger_impls.append(_FileLogger(file))
+    files = [f for f in environ.get(_LOG_FILES_ENV, "").split(os.pathsep) if f]
+    environ[_LOG_FILES_ENV] = os.pathsep.join(files + [str(file.resolve())])
+
+
+def _add_inherited_file_loggers() -> None:
+    for file in environ.get(_LOG_FILES_ENV, "").split(os.pathsep):
+        if file:
+            logger_impls.append(_FileLogger(Path(file)))
+
+
+_add_inherited_file_loggers()
 
-    def _file_logger(str):
-        file_handle.write(str + "\n")
-        file_handle.flush()
 
-    global logger_impls
-    logger_impls.append(_file_logger)
+def flush_logs() -> None:
+    _writer.flush()
 
 
-def log(str: str) -> None:
-    for logger in logger_impls:
-        logger(f"[{datetime.now()}] {str}")
+def close_logs() -> None:
+    """Writes what's left, and closes the log files"""
+    _writer.flush()
+    with _writer.lock:
+        for logger in logger_impls:
+            logger.close()
+        logger_impls[:] = [
+            logger for logger in logger_impls if not isinstance(logger, _FileLogger)
+        ]
+    environ.pop(_LOG_FILES_ENV, None)
+
+
+atexit.register(close_logs)
+
+
+def log(str: str, level: int = INFO) -> None:
+    if level < _min_level():
+        return
+    _writer.put((time.time(), level, str))
 
 
 def exif_date_to_datetime(exifdate: str) -> datetime:
@@ -50,21 +227,44 @@ def datetime_to_exifdate(dt: datetime) -> str:
     return dt.strftime("%Y:%m:%d")
 
 
-# Paths to tools
-load_dotenv()
+def file_fingerprint(file: Path, sample_size: int = 1024 * 1024) -> str:
+    """Identifies a file by its size and a hash of the start and end of it.
+    Hashing all of a multi-GB video would take too long to do on every run."""
+    size = file.stat().st_size
+    sha = hashlib.sha256()
+    with open(file, "rb") as f:
+        sha.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(sample_size, size - sample_size))
+            sha.update(f.read(sample_size))
+    return f"{size}-{sha.hexdigest()}"
+
 
+@cache
+def _load_dotenv() -> None:
+    # Only when a setting is needed, not on import
+    from dotenv import load_dotenv
 
-def magick_path() -> str:
-    return environ.get("MAGICK_PATH", "magick")
+    load_dotenv()
 
 
+def _env(name: str, default: str) -> str:
+    _load_dotenv()
+    return environ.get(name, default)
+
+
+# Paths to tools
 def ffmpeg_path() -> str:
-    return environ.get("FFMPEG_PATH", "ffmpeg")
+    return _env("FFMPEG_PATH", "ffmpeg")
 
 
 def ffprobe_path() -> str:
-    return environ.get("FFPROBE_PATH", "ffprobe")
+    return _env("FFPROBE_PATH", "ffprobe")
 
 
 def exiftool_path() -> str:
-    return environ.get("EXIFTOOL_PATH", "exiftool")
+    return _env("EXIFTOOL_PATH", "exiftool")
+
+
+def streetview_api_url() -> str:
+    return _env("STREETVIEW_API_URL", "https://streetviewpublish.googleapis.com/v1")
@@ -1,15 +1,105 @@
 import subprocess
+import tempfile
+from dataclasses import dataclass
 from decimal import Decimal
 from datetime import datetime
-from typing import Iterable
+from fractions import Fraction
+from itertools import groupby
+from typing import IO, Generator, Iterable, Literal
 
-from math import ceil
 from pathlib import Path
 
+import numpy as np
+from PIL import Image
 from tqdm import tqdm
 
 from matsemanns_streetview_tools.gpx import GpxTrack
-from matsemanns_streetview_tools.util import log, ffmpeg_path
+from matsemanns_streetview_tools.util import DEBUG, WARNING, log, ffmpeg_path
+
+
+FrameRounding = Literal["next", "previous", "nearest"]
+
+
+@dataclass
+class FrameMapping:
+    # The frame number for each time
+    frames: np.ndarray
+    # Indexes of the times that got the same frame as an earlier time
+    duplicates: np.ndarray
+    # Indexes of the times that are outside the video, their frames are meaningless
+    outside: np.ndarray
+
+
+def epoch_microseconds(times: Iterable[datetime]) -> np.ndarray:
+    """Integer microseconds, so frame math on them is exact"""
+    # timestamp() is a lot faster than timedelta math, and a float64 still has
+    # sub-microsecond precision for the current epoch seconds
+    seconds = np.fromiter((t.timestamp() for t in times), dtype=np.float64)
+    return np.round(seconds * 1_000_000).astype(np.int64)
+
+
+def search_frames(
+    frame_times_us: np.ndarray, offsets_us: np.ndarray, rounding: FrameRounding
+) -> np.ndarray:
+    """Binary searches the sorted frame times (microseconds from the first frame)
+    for the times. The frames can be -1 or len(frame_times_us) when outside."""
+    after = np.searchsorted(frame_times_us, offsets_us, side="left")
+    if rounding == "next":
+        return after
+    before = np.searchsorted(frame_times_us, offsets_us, side="right") - 1
+    if rounding == "previous":
+        return before
+    after_clipped = np.minimum(after, len(frame_times_us) - 1)
+    before_clipped = np.maximum(before, 0)
+    closer_after = np.abs(frame_times_us[after_clipped] - offsets_us) < np.abs(
+        offsets_us - frame_times_us[before_clipped]
+    )
+    return np.where(closer_after, after_clipped, before_clipped)
+
+
+def map_times_to_frames(
+    times: np.ndarray,
+    video_start_time: datetime,
+    video_end_time: datetime,
+    video_fps: Decimal | None = None,
+    frame_times_us: np.ndarray | None = None,
+    rounding: FrameRounding = "next",
+) -> FrameMapping:
+    """Finds the frame for all the times (epoch microseconds) at once.
+
+    With a constant framerate the frames are calculated from video_fps. For a
+    variable framerate, pass frame_times_us instead, the microseconds since the
+    first frame for each frame (see FrameIndex). rounding picks the frame at or
+    after the time, at or before it, or the closest one."""
+    start = epoch_microseconds([video_start_time])[0]
+    end = epoch_microseconds([video_end_time])[0]
+    offsets = times - start
+    outside = (offsets < 0) | (times > end)
+
+    if frame_times_us is not None:
+        frames = search_frames(frame_times_us, offsets, rounding)
+        outside |= (frames < 0) | (frames >= len(frame_times_us))
+    elif video_fps is not None:
+        # frame = seconds * fps, as a fraction to stay in integers. 29.97 fps
+        # is stored as 30000/1001 in the video, but only a float in the metadata.
+        fps = Fraction(video_fps).limit_denominator(10_000)
+        numerator = offsets * fps.numerator
+        denominator = fps.denominator * 1_000_000
+        if rounding == "next":
+            frames = -(-numerator // denominator)
+        elif rounding == "previous":
+            frames = numerator // denominator
+        else:
+            frames = (2 * numerator + denominator) // (2 * denominator)
+    else:
+        raise RuntimeError("Either the fps or the frame times of the video is needed")
+
+    frames = frames.astype(np.int64)
+    # A stable sort keeps the first time for each frame first
+    order = np.argsort(frames, kind="stable")
+    repeated = frames[order][1:] == frames[order][:-1]
+    duplicates = np.sort(order[1:][repeated])
+    return FrameMapping(frames, duplicates, np.flatnonzero(outside))
 
 
 def calculate_frames_to_keep(
@@ -17,6 +107,8 @@ def calculate_frames_to_keep(
     video_start_time: datetime,
     video_end_time: datetime,
     video_fps: Decimal,
+    frame_times_us: np.ndarray | None = None,
+    rounding: FrameRounding = "next",
 ) -> list[int]:
     """Calculates the frame number in the video for each point in the track.
     Mainly to be used with a spaced track, to find the correct video frame
@@ -27,20 +119,32 @@ def calculate_frames_to_keep(
     gpx point is 12:00:15, the first video frame to keep will be after 10 seconds).
 
     All points need to be withing the video times, use the gpx cropper first to control
-    what is included from the video.
+    what is included from the video. Points spaced closer than the frames end up
+    with the same frame, which is kept but logged.
     """
+    mapping = map_times_to_frames(
+        epoch_microseconds(point.utc_time for point in track.points),
+        video_start_time,
+        video_end_time,
+        video_fps,
+        frame_times_us,
+        rounding,
+    )
 
-    frames = []
-
-    for point in track.points:
-        if video_start_time <= point.utc_time <= video_end_time:
-            seconds_since_start = (point.utc_time - video_start_time).total_seconds()
-            frame = ceil(seconds_since_start * float(video_fps))
-            frames.append(frame)
-        else:
-            raise RuntimeError("Gpx contains points outside video, crop it first")
+    if len(mapping.outside):
+        first = track.points[mapping.outside[0]].utc_time
+        raise RuntimeError(
+            f"Gpx contains {len(mapping.outside)} points outside video (first at "
+            f"{first}), crop it first"
+        )
+    if len(mapping.duplicates):
+        log(
+            f"{len(mapping.duplicates)} points got the same frame as the point before,"
+            f" the spacing is shorter than the time between frames",
+            WARNING,
+        )
 
-    return frames
+    return mapping.frames.tolist()
 
 
 def _create_ffmpeg_frame_file_content(frames: list[int]) -> str:
@@ -76,7 +180,7 @@ def run_ffmpeg_with_progress(ffmpeg_command: list[str]) -> Iterable[int]:
 
         assert proc.stdout
         out = proc.stdout.readline().decode("utf-8")
-        # log(out)
+        log(out.rstrip(), DEBUG)
         if out.startswith("frame="):
             frame_num = int(out.split("=")[1])
             yield frame_num
@@ -97,17 +201,22 @@ def save_video_frames(
     quality: int = 2,
     progressbar: bool = True,
     cleanup: bool = True,
-) -> None:
+) -> list[Path]:
     """Saves the specified frames from the video to the folder,
     quality is a number where 2=best, 4=good, etc.
+
+    The frames must be sorted. Returns the file of each of the frames, a frame
+    listed multiple times is only saved once and gets the same file each time.
     """
     if not output_folder.exists():
         output_folder.mkdir(parents=True)
 
     video_name = video_file.stem
+    # Ffmpeg's select outputs each frame once, however many times it's listed
+    unique_frames = [frame for frame, _ in groupby(frames)]
 
     frames_file = output_folder / f"{video_name}_frames.txt"
-    frames_file.write_text(_create_ffmpeg_frame_file_content(frames))
+    frames_file.write_text(_create_ffmpeg_frame_file_content(unique_frames))
 
     output_pattern = output_folder / f"{video_name}-%6d.jpg"
 
@@ -129,7 +238,7 @@ def save_video_frames(
 
     if progressbar:
         with tqdm(
-            total=len(frames), desc="Extract frames from video", leave=True
+            total=len(unique_frames), desc="Extract frames from video", leave=True
         ) as pbar:
             for frame in run_ffmpeg_with_progress(ffmpeg_command):
                 pbar.update(frame - pbar.n)
@@ -139,6 +248,78 @@ def save_video_frames(
     if cleanup:
         frames_file.unlink(missing_ok=True)
 
+    files = {
+        frame: output_folder / f"{video_name}-{i:06}.jpg"
+        for i, frame in enumerate(unique_frames, start=1)
+    }
+    return [files[frame] for frame in frames]
+
+
+def _ffmpeg_error(stderr: IO[bytes]) -> str:
+    stderr.seek(0)
+    return stderr.read().decode("utf-8", errors="replace").strip()
+
+
+def stream_video_frames(
+    video_file: Path, frames: list[int], size: tuple[int, int]
+) -> Generator[Image.Image, None, None]:
+    """Like save_video_frames, but the frames are piped from ffmpeg as raw rgb
+    instead of saved as jpgs. Nothing is written to disk, and ffmpeg waits while
+    a frame is being used, so only a frame or two is in memory at a time.
+
+    size is the (width, height) of the video. The frames must be sorted, a frame
+    listed multiple times is yielded multiple times.
+    """
+    width, height = size
+    frame_bytes = width * height * 3
+    unique_frames = [frame for frame, _ in groupby(frames)]
+
+    with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryFile() as stderr:
+        frames_file = Path(folder) / "frames.txt"
+        frames_file.write_text(_create_ffmpeg_frame_file_content(unique_frames))
+        ffmpeg_command = [
+            ffmpeg_path(),
+            "-loglevel",
+            "error",
+            "-i",
+            str(video_file.resolve()),
+            "-filter_script:v",
+            str(frames_file.resolve()),
+            "-vsync",
+            "0",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-",
+        ]
+        log(f"Running ffmpeg: {' '.join(ffmpeg_command)}")
+        proc = subprocess.Popen(
+            ffmpeg_command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+        )
+        assert proc.stdout
+        try:
+            for frame, repeats in groupby(frames):
+                data = proc.stdout.read(frame_bytes)
+                if len(data) < frame_bytes:
+                    proc.wait()
+                    raise RuntimeError(
+                        f"Ffmpeg stopped before frame {frame} (exit code "
+                        f"{proc.returncode})",
+                        _ffmpeg_error(stderr),
+                    )
+                image = Image.frombuffer("RGB", size, data, "raw", "RGB", 0, 1)
+                for _ in repeats:
+                    yield image
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+
 
 def _create_ffmpeg_image_content(images: list[Path]) -> str:
     lines = [f"file '{p.resolve()}'" for p in images]
@@ -199,6 +380,103 @@ def join_images_to_video(
         images_file.unlink(missing_ok=True)
 
 
+class VideoEncoder:
+    """Encodes images into a video as they're written, by piping them to ffmpeg as
+    raw rgb, instead of saving them and joining them with join_images_to_video.
+
+    with VideoEncoder(output_file, (width, height), creation_time) as encoder:
+        for image in images:
+            encoder.write(image)
+    """
+
+    def __init__(
+        self,
+        output_file: Path,
+        size: tuple[int, int],
+        metadata_create_time: datetime,
+        framerate: int = 1,
+        crf_quality: int = 23,
+        preset: str = "medium",
+    ):
+        self.output_file = output_file
+        self.size = size
+        self.frames = 0
+        time = metadata_create_time.isoformat().replace("+00:00", "Z")
+        self.ffmpeg_command = [
+            ffmpeg_path(),
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-s",
+            f"{size[0]}x{size[1]}",
+            "-r",
+            str(framerate),
+            "-i",
+            "-",
+            # Else x264 keeps the rgb as 4:4:4, which few players support
+            "-pix_fmt",
+            "yuv420p",
+            "-crf",
+            str(crf_quality),
+            "-preset",
+            preset,
+            "-metadata",
+            f"creation_time={time}",
+            str(output_file.resolve()),
+        ]
+        self.proc: subprocess.Popen | None = None
+        self.stderr: IO[bytes] | None = None
+
+    def __enter__(self) -> "VideoEncoder":
+        if not self.output_file.parent.exists():
+            self.output_file.parent.mkdir(parents=True)
+        log(f"Running ffmpeg: {' '.join(self.ffmpeg_command)}")
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(
+            self.ffmpeg_command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=self.stderr,
+        )
+        return self
+
+    def write(self, image: Image.Image) -> None:
+        assert self.proc and self.proc.stdin
+        if image.size != self.size:
+            raise RuntimeError(f"Image is {image.size}, but the video is {self.size}")
+        try:
+            self.proc.stdin.write(image.convert("RGB").tobytes())
+        except BrokenPipeError:
+            self.proc.wait()
+            raise RuntimeError(
+                f"Ffmpeg stopped encoding (exit code {self.proc.returncode})",
+                _ffmpeg_error(self.stderr),  # type: ignore
+            )
+        self.frames += 1
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        assert self.proc and self.proc.stdin and self.stderr
+        try:
+            if exc_type is not None:
+                self.proc.kill()
+                self.proc.wait()
+                return
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            code = self.proc.wait()
+            log(f"Ffmpeg finished (exit code {code}), encoded {self.frames} frames")
+            if code != 0:
+                raise RuntimeError("Error from ffmpeg", _ffmpeg_error(self.stderr))
+        finally:
+            self.stderr.close()
+
+
 def inject_spatial_data(input_file: Path, output_file: Path):
     """Use Googles spatial media injector to inject metadata saying this
     video file should be treated as an equirectangular 360 video"""
@@ -0,0 +1,260 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+from matsemanns_streetview_tools.util import log
+
+DEFAULT_LEASE_SECONDS = 120.0
+
+
+@dataclass
+class Task:
+    id: str
+    data: dict
+    attempts: int = 0
+    # Unique to this claim of the task, written in the lease file
+    lease: str = ""
+    # Set when the lease expired and may be given to another worker, the worker
+    # should stop working on the task then
+    lease_lost: threading.Event = field(
+        default_factory=threading.Event, compare=False, repr=False
+    )
+
+
+class WorkQueue:
+    """A queue of tasks in a shared folder (like a NAS), for running the pipeline
+    on several machines without any other server. Only needs the file operations
+    to be atomic, which they are on local disks, NFS and SMB:
+
+    queue.json           settings, written by the coordinator
+    tasks/<id>.json      published tasks
+    leases/<id>.json     a worker has claimed the task, created exclusively
+    done/<id>.json       the result
+    finished             all tasks are done, the workers can stop
+
+    A worker keeps its lease by touching it (the heartbeat). A lease not touched
+    in lease_seconds is from a worker that died, and the task is given to another
+    worker, up to max_attempts times. If the first worker was only stuck (or cut
+    off from the share) it finds out at its next heartbeat, and sets the task's
+    lease_lost. The task should then stop as soon as it can, as the other worker
+    uses the same files, and its result is thrown away by complete.
+    The expiry compares the lease file's mtime to the local clock, so the
+    machines' clocks must be kept in sync (with NTP).
+    """
+
+    def __init__(self, folder: Path):
+        self.folder = folder
+        self.tasks = folder / "tasks"
+        self.leases = folder / "leases"
+        self.done = folder / "done"
+        settings = json.loads((folder / "queue.json").read_text())
+        self.lease_seconds: float = settings["lease_seconds"]
+        self.max_attempts: int = settings["max_attempts"]
+        self.settings: dict = settings["settings"]
+
+    @classmethod
+    def create(
+        cls,
+        folder: Path,
+        settings: dict,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        max_attempts: int = 3,
+    ) -> "WorkQueue":
+        """A new, empty queue, removing what's left in the folder from earlier runs"""
+        for name in ["tasks", "leases", "done", "finished", "queue.json"]:
+            path = folder / name
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink(missing_ok=True)
+        for name in ["tasks", "leases", "done"]:
+            (folder / name).mkdir(parents=True)
+
+        queue_settings = {
+            "lease_seconds": lease_seconds,
+            "max_attempts": max_attempts,
+            "settings": settings,
+        }
+        _write_json(folder / "queue.json", queue_settings)
+        return cls(folder)
+
+    @staticmethod
+    def exists(folder: Path) -> bool:
+        return (folder / "queue.json").exists()
+
+    def publish(self, task_id: str, data: dict) -> None:
+        _write_json(self.tasks / f"{task_id}.json", {"data": data, "attempts": 0})
+
+    def claim(self, worker: str) -> Task | None:
+        """The next task no one is working on, or None"""
+        self.requeue_expired()
+        for file in sorted(self.tasks.glob("*.json")):
+            lease = uuid.uuid4().hex
+            try:
+                # Only one worker can create it, that's the one getting the task
+                fd = os.open(
+                    self.leases / file.name, os.O_CREAT | os.O_EXCL | os.O_WRONLY
+                )
+            except FileExistsError:
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"worker": worker, "lease": lease}, f)
+
+            try:
+                content = json.loads(file.read_text())
+            except FileNotFoundError:
+                content = None
+            if content is None or (self.done / file.name).exists():
+                # Finished by another worker since listing the tasks
+                (self.leases / file.name).unlink(missing_ok=True)
+                file.unlink(missing_ok=True)
+                continue
+            return Task(file.stem, content["data"], content["attempts"], lease)
+        return None
+
+    def owns_lease(self, task: Task) -> bool:
+        try:
+            lease = json.loads((self.leases / f"{task.id}.json").read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        return lease.get("lease") == task.lease
+
+    def heartbeat(self, task: Task) -> bool:
+        """Keeps the lease, False if it has been lost"""
+        if not self.owns_lease(task):
+            return False
+        try:
+            # Not touch, that would create it again if it was just taken away
+            os.utime(self.leases / f"{task.id}.json")
+        except FileNotFoundError:
+            return False
+        return True
+
+    @contextmanager
+    def heartbeats(self, task: Task):
+        """Keeps the lease of the task while working on it"""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease_seconds / 4):
+                try:
+                    if not self.heartbeat(task):
+                        log(f"Lost the lease of task {task.id}, stopping it")
+                        task.lease_lost.set()
+                        return
+                except OSError as e:
+                    log(f"Heartbeat for task {task.id} failed: {e}")
+
+        thread = threading.Thread(target=beat, name="heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, task: Task, result: dict) -> bool:
+        """Stores the result, unless the lease was lost. Returns if it was stored"""
+        if task.lease_lost.is_set() or not self.owns_lease(task):
+            log(f"Lease of task {task.id} is lost, leaving it to the other worker")
+            return False
+        self._store_result(task, result)
+        (self.leases / f"{task.id}.json").unlink(missing_ok=True)
+        return True
+
+    def _store_result(self, task: Task, result: dict) -> None:
+        _write_json(self.done / f"{task.id}.json", {"data": task.data} | result)
+        (self.tasks / f"{task.id}.json").unlink(missing_ok=True)
+
+    def requeue_expired(self) -> None:
+        """Gives the tasks of dead workers to someone else"""
+        now = time.time()
+        for lease in self.leases.glob("*.json"):
+            try:
+                expired = now - lease.stat().st_mtime > self.lease_seconds
+                if not expired:
+                    continue
+                # Renamed first, so only one worker requeues it
+                stale = lease.with_suffix(f".{uuid.uuid4().hex}.expired")
+                lease.rename(stale)
+            except FileNotFoundError:
+                continue
+            stale.unlink()
+
+            task_file = self.tasks / lease.name
+            try:
+                content = json.loads(task_file.read_text())
+            except FileNotFoundError:
+                continue
+            content["attempts"] += 1
+            task = Task(lease.stem, content["data"], content["attempts"])
+            if task.attempts >= self.max_attempts:
+                log(f"Task {task.id} lost its worker {task.attempts} times, giving up")
+                self._store_result(task, {"error": "Lease expired too many times"})
+            else:
+                log(f"Lease of task {task.id} expired, letting another worker take it")
+                _write_json(task_file, content)
+
+    def counts(self) -> tuple[int, int, int]:
+        """Tasks (waiting, being worked on, done)"""
+        working = len(list(self.leases.glob("*.json")))
+        done = len(list(self.done.glob("*.json")))
+        waiting = len(list(self.tasks.glob("*.json"))) - working
+        return waiting, working, done
+
+    def all_done(self) -> bool:
+        return not any(self.tasks.glob("*.json"))
+
+    def results(self) -> list[dict]:
+        return [json.loads(f.read_text()) for f in sorted(self.done.glob("*.json"))]
+
+    def finish(self) -> None:
+        (self.folder / "finished").touch()
+
+    def is_finished(self) -> bool:
+        return (self.folder / "finished").exists()
+
+
+def _write_json(file: Path, content: dict) -> None:
+    # Write and rename, so no one ever reads a half written file
+    tmp_file = file.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    tmp_file.write_text(json.dumps(content, indent=2))
+    os.replace(tmp_file, file)
+
+
+def work(
+    queue: WorkQueue,
+    handle: Callable[[Task], dict],
+    worker: str,
+    poll_seconds: float = 5.0,
+    until: Callable[[], bool] | None = None,
+) -> int:
+    """Claims and handles tasks until until() is true, by default until the queue
+    is finished. handle returns the result of the task, an exception is stored as
+    its "error". handle should give up when the task's lease_lost is set. Returns
+    how many tasks this worker did."""
+    until = until or queue.is_finished
+    handled = 0
+    while True:
+        task = queue.claim(worker)
+        if task is None:
+            if until():
+                return handled
+            time.sleep(poll_seconds)
+            continue
+
+        log(f"{worker} working on task {task.id}")
+        with queue.heartbeats(task):
+            try:
+                result = handle(task)
+            except Exception as e:
+                result = {"error": str(e)}
+        if queue.complete(task, result | {"worker": worker}):
+            handled += 1